@@ -1,23 +1,25 @@
 import re
+import io
+import functools
 import os
 import glob
 import subprocess
 from chevron import *
 from database_df import review_dose
+import logos_index as li
+import spot_pool as sp
+import spot_render as sr
 import pandas as pd
 import PySimpleGUI as sg
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, TableStyle, Table
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, TableStyle, Table, PageBreak
 from reportlab.lib.styles import ParagraphStyle
 from PyPDF2 import PdfWriter , PdfReader 
 import  spotanalysis
 from spotanalysis.run_me import spot_data
-import spotanalysis.spot_position_mod as spm
 import spotanalysis.spot_position_func as spf
 import spotanalysis.constants as cs
-import spotanalysis.figures as fg
-import spotanalysis.report as rp
 
 
 
@@ -36,21 +38,16 @@ def organise_logos_dirs(values=None):
                 print(f)
                 os.remove(os.path.join(report_dir,f))
     os.makedirs(report_dir,exist_ok=True)
-    fldrs = os.listdir(data_dir)
-    chevron_dir = None
-    spot_dirs = []
-    for d in sorted(fldrs):
-        fldr = os.path.join(data_dir,d)
-        bmps = glob.glob(os.path.join(fldr,'*.bmp'))
-        if len(bmps)==5:
-            chevron_dir = fldr
-        elif len(bmps)==1:
-            spot_dirs.append(fldr)
-    return chevron_dir, spot_dirs, report_dir
+    # index Logos folders once, later stages read from the manifest
+    manifest = li.load_or_build(data_dir, report_dir)
+    chevron_dirs = li.folders_of_type(manifest, 'chevron')
+    chevron_dir = chevron_dirs[-1] if chevron_dirs else None
+    spot_dirs = li.folders_of_type(manifest, 'spot')
+    return chevron_dir, spot_dirs, report_dir, manifest
 
 # create chevron results
-def chevron_results(chevron_dir=None, values=None):
-    chevron_analysis = chevron(chevron_dir).analyse(values['-G-'])
+def chevron_results(chevron_dir=None, values=None, manifest=None):
+    chevron_analysis = chevron(chevron_dir, li.folder_entry(manifest, chevron_dir)).analyse(values['-G-'])
     chev_results = {}
     chev_results['Energy MeV'] = chevron_analysis['MeV'][0]
     chev_results['D80 mm'] = [round(x,2) for x in chevron_analysis['BPD']]
@@ -77,14 +74,19 @@ def output_results(results=None):
     return op_results
 
 # create spot grid results
-def spot_results(spot_dirs=None, spotE=None, values=None, db_cols=db_cols):
-    spotpatterns = {}
+def spot_results(spot_dirs=None, spotE=None, values=None, db_cols=db_cols, manifest=None, workers=sp.SPOT_WORKERS):
+    bmps = {}
     # for i in range(1, nbmp+1):
     print("Processing spots...")
     for E, bmp_loc in zip(spotE,spot_dirs):
         str1 = str(E)
-        str2 = glob.glob(os.path.join(bmp_loc,'*.bmp'))
-        spotpatterns.update({str1: spm.SpotPattern(str2[0])})
+        if manifest is None:
+            str2 = glob.glob(os.path.join(bmp_loc,'*.bmp'))
+        else:
+            str2 = li.bmp_paths(manifest, bmp_loc)
+        bmps[str1] = str2[0]
+    # SpotPattern image processing runs on a process pool (serial if workers<=1)
+    spotpatterns = sp.build_spot_patterns(bmps, workers)
 
     gui_values ={'-GANTRY-': values['-G-'], '-GANTRY_ANGLE-': values['GA']}
     print('Making Spot Data dataset...')
@@ -99,34 +101,18 @@ def spot_results(spot_dirs=None, spotE=None, values=None, db_cols=db_cols):
     return df, device, spotpatterns, all_data
 
 # write spot grid report
-def spot_report(df=None, device=None, report_dir=None, values=None, energies=[240, 200, 150, 100, 70]):
-    # change active dir
+def spot_report(df=None, device=None, report_dir=None, values=None, energies=[240, 200, 150, 100, 70], workers=sr.RENDER_WORKERS):
     current_path = os.path.abspath(os.path.dirname(__file__))
     gr_path = os.path.join(current_path,'spotanalysis','def_gradient_ratio.png')
     prof_path = os.path.join(current_path,'spotanalysis','profiles_per_spot.png')
-    os.chdir(report_dir)
 
     # results to excel
     df.to_excel(os.path.join(report_dir,'result.xlsx'))
 
-    # absolute plot
-    fg.plot_spot_grid(df, device, tolerance = 2)
-    fg.plot_shifts(df, device, tolerance = 2)
-    fg.plot_shifts_by_energy(df, device, tolerance =2 )
-    fg.plot_shifts_by_pos(df, device, tolerance = 2 )
-
-    # relative plot
-    fg.plot_spot_grid(df, device, tolerance=1)
-    fg.plot_shifts(df, device, tolerance=1)
-    fg.plot_shifts_by_energy(df, device, tolerance =1 )
-    fg.plot_shifts_by_pos(df, device, tolerance = 1 )
-    fg.plot_distribution(df)
-    fg.plot_fwhm(df)
-
-    # results tables and report generation
-    rp.make_table(df, energies)
-    rp.spot_report(df, values['-Op1-'], values['-Op2-'], report_dir, gr_path, prof_path, values['-ML-'], energies)
-    os.chdir(current_path)
+    # absolute (tolerance 2) and relative (tolerance 1) plots, results tables and report generation
+    # rendered in worker processes into report_dir, the working directory is never changed
+    # spotanalysis.report reads the figure PNGs back from report_dir by name, so they stay on disk
+    sr.render_spot_report(df, device, report_dir, values['-Op1-'], values['-Op2-'], gr_path, prof_path, values['-ML-'], energies, workers)
     return
 
 
@@ -158,13 +144,9 @@ def _highlight_fails(table=None, column_index=0, fail_threshold=None, warn_thres
             table.setStyle(TableStyle([('BACKGROUND', (0, i), (-1, i), colors.lightsalmon)]))
     return table
 
-# write chevron report
-def chev_report(chev_results=None, values=None, fail_oot=1.0, warn_oot=0.5, pdf_name='chevron_report.pdf', gantry_angle=0):
-    print('staring chevron report')
-    doc = SimpleDocTemplate(pdf_name,pagesize=letter,
-                        rightMargin=72,leftMargin=72,
-                        topMargin=72,bottomMargin=18)
-
+# report paragraph styles, built once
+@functools.lru_cache(maxsize=None)
+def _report_styles():
     hp = ParagraphStyle('Normal')
     hp.textcolor = 'black'
     hp.fontsize = 10
@@ -179,7 +161,7 @@ def chev_report(chev_results=None, values=None, fail_oot=1.0, warn_oot=0.5, pdf_
     bp.fontName = 'Helvetica'
     bp.spaceBefore = 3
     bp.spaceAfter = 3
-    hp.leading = 12
+    bp.leading = 12
 
     sp = ParagraphStyle('Normal')
     sp.textcolor = 'black'
@@ -188,97 +170,86 @@ def chev_report(chev_results=None, values=None, fail_oot=1.0, warn_oot=0.5, pdf_
     sp.spaceBefore = 6
     sp.spaceAfter = 6
     sp.leading = 12
+    return hp, bp, sp
 
-    story = []
 
-    #  chevron report header
-    report_title = '%s Chevron Energy Range Analysis' % values['-G-']
-    story.append(Paragraph(report_title, hp))
-    story.append(Paragraph("Date: "+values['ADate'], bp))
-    story.append(Paragraph("Gantry: "+values['-G-'], bp))
-    story.append(Paragraph("Gantry Angle: "+str(gantry_angle)+" degrees", bp))
-    story.append(Paragraph("Operator(s): "+values['-Op1-']+" "+values['-Op2-'], bp))
-    story.append(Spacer(1, 5))
-    # Chevron results
-    story.append(Paragraph('Result summary:', sp))
-    story.append(Spacer(1, 5))
-    t = _dict_to_table(chev_results)
-    # highlight OOT
-    t = _highlight_fails(table=t, column_index=-1, fail_threshold=fail_oot, warn_threshold=warn_oot)
-    story.append(t)
-    story.append(Spacer(1, 20))
-    # build report
-    doc.build(story)
-    print('Chevron report complete')
-    return
-
-# write output report
-def output_report(results=None, values=None, fail_oot=2.0, warn_oot=0.8, pdf_name='output_report.pdf', gantry_angle=0):
-    print('Starting output report')
-    doc = SimpleDocTemplate(pdf_name,pagesize=letter,
+def _report_doc(pdf_name):
+    # pdf_name may be a filepath or a file-like buffer
+    return SimpleDocTemplate(pdf_name,pagesize=letter,
                         rightMargin=72,leftMargin=72,
                         topMargin=72,bottomMargin=18)
 
-    hp = ParagraphStyle('Normal')
-    hp.textcolor = 'black'
-    hp.fontsize = 10
-    hp.fontName = 'Helvetica-Bold'
-    hp.spaceAfter = 6
-    hp.leading = 16
-    hp.underlineWidth = 1
-
-    bp = ParagraphStyle('Normal')
-    bp.textcolor = 'black'
-    bp.fontsize = 10
-    bp.fontName = 'Helvetica'
-    bp.spaceBefore = 3
-    bp.spaceAfter = 3
-    hp.leading = 12
-
-    sp = ParagraphStyle('Normal')
-    sp.textcolor = 'black'
-    sp.fontsize = 15
-    sp.fontName = 'Helvetica-Bold'
-    sp.spaceBefore = 6
-    sp.spaceAfter = 6
-    sp.leading = 12
 
+# report section with header and result summary table
+def _report_section(title=None, table_dict=None, values=None, fail_oot=None, warn_oot=None, gantry_angle=0):
+    hp, bp, sp = _report_styles()
     story = []
 
-    #  output consistency report header
-    report_title = '%s Output Consistency Analysis' % values['-G-']
+    #  report header
+    report_title = '%s %s' % (values['-G-'], title)
     story.append(Paragraph(report_title, hp))
     story.append(Paragraph("Date: "+values['ADate'], bp))
     story.append(Paragraph("Gantry: "+values['-G-'], bp))
     story.append(Paragraph("Gantry Angle: "+str(gantry_angle)+" degrees", bp))
     story.append(Paragraph("Operator(s): "+values['-Op1-']+" "+values['-Op2-'], bp))
     story.append(Spacer(1, 5))
-    # output consistency results
+    # results
     story.append(Paragraph('Result summary:', sp))
     story.append(Spacer(1, 5))
-    t = _dict_to_table(results)
+    t = _dict_to_table(table_dict)
     # highlight OOT
     t = _highlight_fails(table=t, column_index=-1, fail_threshold=fail_oot, warn_threshold=warn_oot)
     story.append(t)
     story.append(Spacer(1, 20))
-    # build report
-    doc.build(story)
-    print('output report complete')
+    return story
+
+
+def _chev_story(chev_results=None, values=None, fail_oot=1.0, warn_oot=0.5, gantry_angle=0):
+    return _report_section('Chevron Energy Range Analysis', chev_results, values, fail_oot, warn_oot, gantry_angle)
+
+
+def _output_story(results=None, values=None, fail_oot=2.0, warn_oot=0.8, gantry_angle=0):
+    return _report_section('Output Consistency Analysis', results, values, fail_oot, warn_oot, gantry_angle)
+
+
+# write combined session report
+def session_report(results=None, chev_results=None, values=None, report_name='_PostISM_Report.pdf', spot_pdfs=[],
+                   output_oot=(2.0, 0.8), chev_oot=(1.0, 0.5), gantry_angle=0):
+    '''
+        Write the output consistency and chevron sections as one ReportLab story, followed by
+        the pages of the spot grid report(s). The document is built in memory and the final
+        PDF is written once. The output and chevron sections are tables only; the spot grid
+        figures are saved as PNG files by spotanalysis and placed by spotanalysis.report,
+        which reads them back by file name, so they reach this report through its PDF on disk
+        rather than as in-memory images.
+
+        Input:
+            results         output consistency table dict (output_results)
+            chev_results    chevron table dict (chevron_results)
+            values          GUI values dict
+            report_name     filepath of the combined report
+            spot_pdfs       filepaths of spot grid report PDFs written by spotanalysis.report
+            output_oot      (fail, warn) thresholds for output consistency
+            chev_oot        (fail, warn) thresholds for chevron ranges
+    '''
+    print('Starting session report')
+    story = _output_story(results, values, output_oot[0], output_oot[1], gantry_angle)
+    story.append(PageBreak())
+    story.extend(_chev_story(chev_results, values, chev_oot[0], chev_oot[1], gantry_angle))
+    buffer = io.BytesIO()
+    _report_doc(buffer).build(story)
+
+    if not spot_pdfs:
+        with open(report_name, 'wb') as f:
+            f.write(buffer.getvalue())
+    else:
+        # spot grid report is produced as a PDF by the spotanalysis submodule, append its pages
+        output = PdfWriter()
+        output.append_pages_from_reader(PdfReader(buffer))
+        for spot_pdf in spot_pdfs:
+            with open(spot_pdf, 'rb') as f:
+                output.append_pages_from_reader(PdfReader(io.BytesIO(f.read())))
+        with open(report_name, 'wb') as f:
+            output.write(f)
+    print('Session report complete')
     return
-
-
-# merge all three reports
-def merge_reports(reports=[], report_name='PostISM_Report.pdf'):
-    # initialise pdf writer
-    output = PdfWriter()
-    # read existing PDF reports to writer
-    for report_pdf in reports:
-        existingPdf = PdfReader(open(report_pdf, 'rb'))
-        output.append_pages_from_reader(existingPdf)
-    # write merged report to file
-    outputStream = open(report_name, 'wb')
-    output.write(outputStream)
-    outputStream.close()
-    return
-
-
@@ -0,0 +1,97 @@
+"""
+Calibration factor timeline
+
+Holds the full calibration history of every chamber, electrometer and gantry
+indexed by validity interval: a calibration is valid from its date until the
+next calibration of the same equipment. Factors valid at a time are found by
+binary search, so changing the session date does not query the database.
+Serial numbers are parsed from the equipment names ('Roos [3126]') once, when
+the history is loaded.
+
+Dates are 'YYYY-MM-DD HH:MM:SS' strings (see ref_cache), which sort in time order.
+"""
+
+import re
+import bisect
+
+# serial number between square brackets in Calibration.Equipment / Assets.Item
+SERIAL_RE = re.compile(r'\[([^\]]+)\]')
+
+
+class CalTimeline():
+    '''
+        Calibration history indexed by equipment serial number and date.
+
+        input:
+            cal_records - (list) [Equipment, CalFactor, Kpol, Cal Date, Operator] Calibration records of assets
+            ks_records  - (list) [MachineName, ks, CalDate] gantry ks records
+    '''
+    def __init__(self, cal_records=(), ks_records=()):
+        # equipment name: sorted dates and the records of each date
+        history = {}
+        for equipment, cal_factor, kpol, cal_date, operator in cal_records:
+            history.setdefault(equipment, {}).setdefault(cal_date, []).append((cal_factor, kpol, operator))
+        # serial: list of (dates, records) of every equipment name containing the serial
+        self._serials = {}
+        for equipment in sorted(history):
+            dates = sorted(history[equipment])
+            entry = (dates, [history[equipment][d] for d in dates])
+            for serial in SERIAL_RE.findall(equipment):
+                self._serials.setdefault(serial, []).append(entry)
+        ks = {}
+        for machine, value, cal_date in ks_records:
+            ks.setdefault(machine, []).append((cal_date, value))
+        self._ks = {}
+        for machine, values in ks.items():
+            values.sort(key=lambda v: v[0])
+            self._ks[machine] = ([v[0] for v in values], [v[1] for v in values])
+
+    def calibration(self, serial=None, date=None):
+        '''
+            Return the (CalFactor, Kpol) of serial valid at date, None if there is none.
+            As in the QA database queries, the most recent calibration on or before date
+            must have an operator, otherwise the equipment has no valid calibration.
+        '''
+        found = None
+        for dates, records in self._serials.get(serial, []):
+            i = bisect.bisect_right(dates, date)
+            if i==0:
+                continue
+            for cal_factor, kpol, operator in records[i-1]:
+                if operator is not None:
+                    found = (cal_factor, kpol)
+        return found
+
+    def ks(self, machine=None, date=None):
+        '''
+            Return the ks of machine valid at date, or its earliest ks if date precedes every record
+        '''
+        if machine not in self._ks:
+            return None
+        dates, values = self._ks[machine]
+        return values[max(bisect.bisect_right(dates, date)-1, 0)]
+
+    def factors(self, date=None, chambers=(), electrometers=()):
+        '''
+            Calibration factors valid at date
+
+            Return dicts:
+                kpol        chamber serial: kpol
+                ndw         chamber serial: NDW
+                kelec       electrometer serial: kelec
+                ks          gantry: ks
+        '''
+        kpol = {}
+        ndw = {}
+        kelec = {}
+        for serial in chambers:
+            cal = self.calibration(serial, date)
+            if cal is not None:
+                ndw[serial] = int(cal[0])
+                kpol[serial] = int(cal[1])
+        for serial in electrometers:
+            cal = self.calibration(serial, date)
+            if cal is not None:
+                kelec[serial] = int(cal[0])
+        ks = {machine: self.ks(machine, date) for machine in self._ks}
+        return kpol, ndw, kelec, ks
@@ -0,0 +1,119 @@
+import os
+import json
+import copy
+import threading
+import numpy as np
+
+DEFAULT_JSON = os.path.abspath(os.path.join(os.path.dirname(__file__), 'logos_config.json'))
+N_WEDGES = 6
+
+# required logos_config.json fields
+_NUMBERS = ['SAD_X', 'SAD_Y', 'Chevron_WER', 'Target_WER', 'Target_l', 'LCW_half_width']
+_LISTS = ['MeV', 'h', 'D80_NIST', 'D80_TPS', 'SpotE']
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class Calibration():
+    '''
+        Validated Logos calibration loaded from logos_config.json.
+
+        The json fields are available as attributes with their original values
+        (e.g. cal.MeV, cal.h, cal.D80_NIST); the instance is shared by every caller
+        of get_calibration, so copy these before returning or changing them.
+        Chevron model constants and reference ranges are also precomputed as
+        numpy arrays:
+            heights     - (array) wedge heights h for wedges A-F
+            scaling     - (array) optical scaling per wedge
+            bpd_offset  - (float) Target_l*Target_WER
+            sad_x2      - (float) SAD_X^2
+            sad_y2      - (float) 4*SAD_Y^2
+            energies    - (array) chevron energies (MeV)
+            nist        - (array) D80_NIST ordered as energies
+            tps         - (array) D80_TPS ordered as energies
+            baseline    - (dict) gantry: D80_Baseline array ordered as energies
+    '''
+    def __init__(self, cfg_dict, json_name=None, mtime=None):
+        validate(cfg_dict)
+        self._raw = copy.deepcopy(cfg_dict)
+        self.json_name = json_name
+        self.mtime = mtime
+        for k, v in cfg_dict.items():
+            setattr(self, k, v)
+
+        self.heights = np.asarray(self.h, dtype=float)
+        self.scaling = (self.SAD_Y - (self.heights-self.LCW_half_width)) / self.SAD_Y
+        self.bpd_offset = self.Target_l*self.Target_WER
+        self.sad_x2 = self.SAD_X*self.SAD_X
+        self.sad_y2 = 4*self.SAD_Y*self.SAD_Y
+
+        self.energies = np.asarray(self.MeV, dtype=float)
+        self.nist = np.asarray(self.D80_NIST, dtype=float)
+        self.tps = np.asarray(self.D80_TPS, dtype=float)
+        self.baseline = {g: np.asarray(v, dtype=float) for g, v in self.D80_Baseline.items()}
+        self._index = {e: i for i, e in enumerate(self.MeV)}
+
+    def index(self, energy):
+        '''
+            Position of a chevron energy (MeV) in the reference arrays
+        '''
+        return self._index[energy]
+
+    def to_dict(self):
+        '''
+            Copy of the json contents
+        '''
+        return copy.deepcopy(self._raw)
+
+
+def validate(cfg_dict):
+    '''
+        Check logos_config.json contents, raises ValueError listing any problems
+    '''
+    errors = []
+    for k in _NUMBERS:
+        if not _is_number(cfg_dict.get(k)):
+            errors.append(k+' must be a number')
+    for k in _LISTS:
+        v = cfg_dict.get(k)
+        if not isinstance(v, list) or not all(_is_number(x) for x in v):
+            errors.append(k+' must be a list of numbers')
+    if not errors:
+        n = len(cfg_dict['MeV'])
+        if len(cfg_dict['h']) != N_WEDGES:
+            errors.append('h must have %d values' % N_WEDGES)
+        for k in ['D80_NIST', 'D80_TPS']:
+            if len(cfg_dict[k]) != n:
+                errors.append(k+' must have one value per MeV')
+    baseline = cfg_dict.get('D80_Baseline')
+    if not isinstance(baseline, dict):
+        errors.append('D80_Baseline must map gantry names to lists')
+    elif not errors:
+        for g, v in baseline.items():
+            if not isinstance(v, list) or len(v) != len(cfg_dict['MeV']) or not all(_is_number(x) for x in v):
+                errors.append('D80_Baseline '+g+' must have one value per MeV')
+    if errors:
+        raise ValueError('Invalid Logos calibration: '+'; '.join(errors))
+
+
+def get_calibration(json_name=None):
+    '''
+        Return the process-wide Calibration for json_name (default logos_config.json).
+        The file is only re-read when its modification time changes.
+    '''
+    if json_name is None:
+        json_name = DEFAULT_JSON
+    json_name = os.path.abspath(json_name)
+    mtime = os.stat(json_name).st_mtime_ns
+    with _lock:
+        cal = _cache.get(json_name)
+        if cal is None or cal.mtime != mtime:
+            with open(json_name, 'r') as j:
+                cal = Calibration(json.load(j), json_name, mtime)
+            _cache[json_name] = cal
+    return cal
+
+
+def _is_number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
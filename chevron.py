@@ -1,12 +1,15 @@
 import glob
 import os
-import json
-import csv
 import re
 import numpy as np
 import cv2
 import pandas as pd
-from types import SimpleNamespace   
+from logos_output import read_output
+from calibration import get_calibration
+
+# number of .bmp images identifying each type of Logos acquisition folder
+CHEVRON_BMPS = 5
+SPOT_BMPS = 1
 
 class chevron():
     '''
@@ -16,13 +19,17 @@ class chevron():
             logos_config.json
             Logos acquisition files (.bmp, activescript,txt, output.txt)
     '''
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, entry=None):
         '''
             initiates chevron class
 
             input:
                 data_dir - (str) filepath to Logos acquisition folder
 
+            optional input:
+                entry    - (dict) folder entry from a Logos manifest (see logos_index.py),
+                           used instead of listing and reading the folder again
+
             returns:
                 dir          - (str) filepath to Logos directory
                 bmp_list     - (str) filepaths to Logos .bmp images
@@ -32,7 +39,11 @@ class chevron():
         '''
         # specify Logos file paths
         self.dir = data_dir
-        bmp_list = glob.glob(os.path.join(data_dir,"*.bmp"))
+        self.entry = entry
+        if entry is None:
+            bmp_list = glob.glob(os.path.join(data_dir,"*.bmp"))
+        else:
+            bmp_list = [os.path.join(data_dir,f) for f in entry['bmp']]
         #output file
         output_name = os.path.join(data_dir,"output.txt")
         #activescript file
@@ -44,25 +55,20 @@ class chevron():
         self.MachineNames = ['Gantry 1', 'Gantry 2', 'Gantry 3', 'Gantry 4']
 
 
-    def analyse(self, gantry=None):
+    def analyse(self, gantry=None, json_name=None):
         '''
             Analyses Logos data specified when initiating chevron class. Requires logos_config.cfg.
 
             optional input:
-                gantry - (str) should match item in MachineNames
+                gantry    - (str) should match item in MachineNames
+                json_name - (str) filepath to an alternative logos_config.json
 
             returns:
                 r - (dict) range in mm, also acquisition and model parameters used to calculate range
         '''
         # load Logos calibration params
-        cal_dict = self._load_calibration()
-        cal = SimpleNamespace(**cal_dict)
+        cal = self._load_calibration(json_name)
                 
-        #calculate chevron-specific params
-        scaling = []
-        for i in cal.h:
-            scaling.append( (cal.SAD_Y - (i-cal.LCW_half_width)) / cal.SAD_Y )
-
         # initialise results dict
         r = {
             'X': [],
@@ -94,43 +100,17 @@ class chevron():
         HRatio, VRatio = self._load_activescript()
 
         # read output.txt and write to results dict
-        with open(self.output_name, 'r', newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
-            c=1000
-            for i,row in enumerate(reader):
-                if i==0:
-                    X = float(row[5].strip())
-                    Y = float(row[6].strip())
-                    fps = float(row[8].strip())
-                    dB = float(row[12].strip())
-                
-                if 'Image:' in row:
-                    image = int(row[1].strip())
-                    c = i
-                
-                if 0 < i-c <= 1:
-                    r['A'].append(float(row[4].strip()))
-                    r['Acntr'].append(float(row[3].strip()))
-                
-                if 1 < i-c <= 2:
-                    r['B'].append(float(row[4].strip()))
-                    r['Bcntr'].append(float(row[3].strip()))
-                
-                if 2 < i-c <= 3:
-                    r['C'].append(float(row[4].strip()))
-                    r['Ccntr'].append(float(row[3].strip()))
-                
-                if 3 < i-c <= 4:
-                    r['D'].append(float(row[4].strip()))
-                    r['Dcntr'].append(float(row[3].strip()))
-                
-                if 4 < i-c <= 5:
-                    r['E'].append(float(row[4].strip()))
-                    r['Ecntr'].append(float(row[3].strip()))
-                
-                if 5 < i-c <= 6:
-                    r['F'].append(float(row[4].strip()))
-                    r['Fcntr'].append(float(row[3].strip()))
+        wedges = ['A', 'B', 'C', 'D', 'E', 'F']
+        output_stat = None
+        if self.entry is not None and self.entry['output']:
+            f = self.entry['files'][self.entry['output']]
+            output_stat = (f['size'], f['mtime_ns'])
+        logos_output = read_output(self.output_name, output_stat=output_stat)
+        X, Y, fps, dB = logos_output.X, logos_output.Y, logos_output.fps, logos_output.dB
+        width, cntr, _ = logos_output.matrix()
+        for j, c in enumerate(wedges):
+            r[c] = width[:, j].tolist()
+            r[c+'cntr'] = cntr[:, j].tolist()
 
         # write remaining vars to results dict
         r['X'] = [X]*len(r['A'])
@@ -143,62 +123,85 @@ class chevron():
         r['HeightD'] = [cal.h[3]]*len(r['D'])
         r['HeightE'] = [cal.h[4]]*len(r['E'])
         r['HeightF'] = [cal.h[5]]*len(r['F'])
-        r['MeV'] = [cal.MeV]*len(r['A'])
+        # copies, the calibration lists are shared by every caller of get_calibration
+        r['MeV'] = [list(cal.MeV) for _ in r['A']]
         r['fldr'] = [self.json_dir]*len(r['A'])
         r['HRatio'] = [HRatio]*len(r['A'])
         r['VRatio'] = [VRatio]*len(r['A'])
-        r['NIST'] = cal.D80_NIST
-        r['TPS'] = cal.D80_TPS
+        r['NIST'] = list(cal.D80_NIST)
+        r['TPS'] = list(cal.D80_TPS)
 
         # calculate range (BPD)
-        for i in range(len(r['A'])):
-            BPD = []
-            for j, c in enumerate(['A', 'B', 'C', 'D', 'E', 'F']):
-                #optical scaling
-                s = scaling[j]
-                #BPD
-                bpd = cal.Target_l*cal.Target_WER+cal.Chevron_WER*(cal.h[j]-(r[c][i]*s)/2)
-                #SAD correction
-                sady = r[c][i]*r[c][i] / (4*cal.SAD_Y*cal.SAD_Y) + 1
-                sadx = r[c+'cntr'][i]*r[c+'cntr'][i] / (cal.SAD_X*cal.SAD_X) + 1
-                sad = np.sqrt(sady+sadx-1)
-                bpd_corr = bpd*sad
-                if r[c][i] != 0:
-                    BPD.append(bpd_corr)
-            r['BPD'].append(np.mean(BPD))        
+        r['BPD'] = list(calc_bpd(width, cntr, cal))
         
         # calculate difference from references
+        bpd = np.array(r['BPD'])
         if gantry in self.MachineNames:
-            r['Baseline'] = cal.D80_Baseline[gantry]
-            r['Diff_Baseline'] = list(np.array(r['BPD']) - np.array(r['Baseline']))
-        r['Diff_NIST'] = list(np.array(r['BPD']) - np.array(r['NIST']))
-        r['Diff_TPS'] = list(np.array(r['BPD']) - np.array(r['TPS']))
+            r['Baseline'] = list(cal.D80_Baseline[gantry])
+            r['Diff_Baseline'] = list(bpd - cal.baseline[gantry])
+        r['Diff_NIST'] = list(bpd - cal.nist)
+        r['Diff_TPS'] = list(bpd - cal.tps)
         return r
     
 
     def _load_calibration(self,json_name=None):
-        # load Logos config file
-        if json_name is None:
-            json_name = os.path.abspath(os.path.join(os.path.dirname(__file__), 'logos_config.json')) 
-        with open(json_name, 'r') as j:
-            jsonDict = json.load(j)
-        
-        self.json_dir = json_name
-        return jsonDict
+        # load Logos config file (cached across chevron instances)
+        cal = get_calibration(json_name)
+        self.json_dir = cal.json_name
+        return cal
     
 
-    def _load_bmp(self):        
+    def _load_bmp(self, dtype=np.float32):        
         # load images to list of 2D numpy arrays
-        img = [cv2.imread(i, cv2.IMREAD_GRAYSCALE).astype(float) for i in self.bmp_list]
+        # 8-bit greyscale images: float32 (not float64) halves the copy, None keeps the decoded uint8
+        img = [cv2.imread(i, cv2.IMREAD_GRAYSCALE) for i in self.bmp_list]
+        if dtype is not None:
+            img = [i.astype(dtype) for i in img]
         return img
 
 
     def _load_activescript(self):
-        CameraHRatio=None
-        CameraVRatio=None
-        flag=0
-        # read activescript.txt file
-        f = open(self.activescript)
+        # camera ratios already captured in the Logos manifest
+        if self.entry is not None and self.entry['ratios']:
+            return self.entry['ratios']['HRatio'], self.entry['ratios']['VRatio']
+        return read_activescript(self.activescript)
+    
+
+    def analyse_to_df(self, gantry=None):
+        r = self.analyse(gantry)
+        df = pd.DataFrame.from_dict(r)
+        df.to_excel('here.xlsx')
+
+
+### helper functions
+def acquisition_type(bmp_list=None):
+    '''
+        Classify a Logos acquisition folder by the number of .bmp images it contains
+
+        input:
+            bmp_list - (list) .bmp filepaths in the folder
+
+        returns:
+            'chevron', 'spot' or None
+    '''
+    if len(bmp_list)==CHEVRON_BMPS:
+        return 'chevron'
+    elif len(bmp_list)==SPOT_BMPS:
+        return 'spot'
+    return None
+
+
+def read_activescript(activescript=None):
+    '''
+        Read camera ratios from a Logos activescript.txt file
+
+        returns:
+            CameraHRatio, CameraVRatio - (float) None if not found
+    '''
+    CameraHRatio=None
+    CameraVRatio=None
+    flag=0
+    with open(activescript) as f:
         for line in f:
             if "CameraHRatio" in line:
                 CameraHRatio = float(re.findall("\d+\.\d+", line)[0])
@@ -207,25 +210,41 @@ class chevron():
                 CameraVRatio = float(re.findall("\d+\.\d+", line)[0])
                 flag += 1
             elif flag==2:
-                break        
-        return CameraHRatio, CameraVRatio
-    
-
-    def analyse_to_df(self, gantry=None):
-        r = self.analyse(gantry)
-        df = pd.DataFrame.from_dict(r)
-        df.to_excel('here.xlsx')
+                break
+    return CameraHRatio, CameraVRatio
 
 
-### helper function
 def load_calibration(json_name=None):
     # load Logos config file
-    if json_name is None:
-        json_name = os.path.abspath(os.path.join(os.path.dirname(__file__), 'logos_config.json')) 
-    with open(json_name, 'r') as j:
-        jsonDict = json.load(j)    
-    return jsonDict
-
-
+    return get_calibration(json_name).to_dict()
 
 
+def calc_bpd(width=None, cntr=None, cal=None):
+    '''
+        Vectorised range (BPD) calculation for chevron wedge measurements.
+        Optical scaling, SAD correction and the zero width filter are applied to every
+        image and wedge in one pass, so a stack of acquisitions can be processed at once.
+
+        input:
+            width - (array) wedge widths, shape (..., images, 6) with wedges A-F on the last axis
+            cntr  - (array) wedge centres, same shape as width
+            cal   - (Calibration) Logos calibration params from calibration.get_calibration
+
+        returns:
+            bpd   - (array) mean range in mm for each image, shape (..., images)
+                    NaN where every wedge width of an image is zero
+    '''
+    width = np.asarray(width, dtype=float)
+    cntr = np.asarray(cntr, dtype=float)
+    #BPD with optical scaling
+    bpd = cal.bpd_offset + cal.Chevron_WER*(cal.heights-(width*cal.scaling)/2)
+    #SAD correction
+    sady = width*width / cal.sad_y2 + 1
+    sadx = cntr*cntr / cal.sad_x2 + 1
+    bpd_corr = bpd*np.sqrt(sady+sadx-1)
+    # mean over non-zero wedges
+    mask = width != 0
+    n = mask.sum(axis=-1)
+    total = np.where(mask, bpd_corr, 0.0).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, total/np.maximum(n, 1), np.nan)
@@ -0,0 +1,191 @@
+"""
+Import of CSV session exports into the QA database
+
+The Export to CSV button writes session.csv and result.csv into a timestamped
+folder per session when the database cannot be reached. This finds every such
+folder below a root directory, validates the files against the output
+consistency session and results columns written by Submit (see
+database_df.session_columns and results_columns), skips sessions already in
+the database (same ADate and gantry) and inserts the rest: all sessions in one
+transaction, then all results in one transaction. If the results cannot be
+written the imported sessions are deleted again, so a later run imports them
+in full; if that delete fails too the affected folders are listed.
+
+The tables default to those Submit writes (database_df.OUTPUT_SESSION_TABLE
+and OUTPUT_RESULTS_TABLE).
+
+usage:
+    python csv_import.py ROOT [--session-table LogosOPSession] [--results-table LogosOPResults] [--dry-run]
+"""
+
+import os
+import sys
+import argparse
+import pandas as pd
+import database_df as db
+
+SESSION_FILE = 'session.csv'
+RESULTS_FILE = 'result.csv'
+# session columns that may be empty
+OPTIONAL = ['Humidity', 'Comments']
+# result columns inserted as numbers
+NUMERIC = ['Energy', 'R', 'RGy']
+
+
+def find_export_dirs(root=None):
+    '''
+        Walk root and return sorted list of folders containing session.csv and result.csv
+    '''
+    export_dirs = []
+    for dirpath, _, filenames in os.walk(root):
+        if SESSION_FILE in filenames and RESULTS_FILE in filenames:
+            export_dirs.append(os.path.abspath(dirpath))
+    return sorted(export_dirs)
+
+
+def read_export(fldr=None):
+    '''
+        Read and validate the session and results of an export folder
+
+        Returns:
+            session     dict of the session row (session.csv columns)
+            results     dataframe of result.csv
+        Raises ValueError if the files do not match the exported columns
+    '''
+    # strings exactly as exported, empty cells as ''
+    sess = pd.read_csv(os.path.join(fldr, SESSION_FILE), dtype=str, keep_default_na=False)
+    res = pd.read_csv(os.path.join(fldr, RESULTS_FILE), dtype=str, keep_default_na=False)
+    humidity = 'Humidity' in sess.columns
+    _, sess_cols = db.session_columns(humidity)
+    _, res_cols = db.results_columns()
+    if list(sess.columns)!=sess_cols:
+        raise ValueError("%s columns %s, expected %s" % (SESSION_FILE, list(sess.columns), sess_cols))
+    if list(res.columns)!=res_cols:
+        raise ValueError("%s columns %s, expected %s" % (RESULTS_FILE, list(res.columns), res_cols))
+    if len(sess)!=1:
+        raise ValueError("%s has %d rows, expected 1" % (SESSION_FILE, len(sess)))
+    if res.empty:
+        raise ValueError(RESULTS_FILE+" has no results")
+    session = sess.iloc[0].to_dict()
+    missing = [c for c in sess_cols if session[c]=='' and c not in OPTIONAL]
+    if missing:
+        raise ValueError("session values missing: "+", ".join(missing))
+    if pd.isnull(pd.to_datetime(session['Adate'], errors='coerce')):
+        raise ValueError("invalid session date "+session['Adate'])
+    if (res['ADate']!=session['Adate']).any():
+        raise ValueError("result dates do not match the session date "+session['Adate'])
+    for c in NUMERIC:
+        values = pd.to_numeric(res[c], errors='coerce')
+        if values.isnull().any():
+            raise ValueError("non-numeric %s in %s" % (c, RESULTS_FILE))
+        res[c] = values
+    return session, res
+
+
+def existing_sessions(sessions=None, session_table=db.OUTPUT_SESSION_TABLE):
+    '''
+        Set of (ADate, gantry) of sessions already in session_table, ADate as a Timestamp
+    '''
+    if not sessions:
+        return set()
+    start = min(pd.to_datetime(s['Adate']) for s in sessions).to_pydatetime()
+    records = db.DB.fetchall('SELECT ADate, MachineName FROM %s WHERE ADate >= ?' % session_table, [start],
+                             name='existing_sessions')
+    return set((pd.to_datetime(adate), gantry) for adate, gantry in records)
+
+
+def import_exports(root=None, session_table=db.OUTPUT_SESSION_TABLE, results_table=db.OUTPUT_RESULTS_TABLE,
+                   dry_run=False):
+    '''
+        Import every export folder below root into session_table and results_table
+
+        Returns:
+            imported    list of folders imported
+            skipped     dict of folder: reason for folders not imported (invalid, existing or duplicate)
+    '''
+    if not db.DB_PATH:
+        raise ValueError("Provide a path to the QA database in db_config.cfg")
+    skipped = {}
+    exports = []
+    for fldr in find_export_dirs(root):
+        try:
+            session, res = read_export(fldr)
+        except Exception as e:
+            skipped[fldr] = 'invalid: '+str(e)
+            continue
+        exports.append((fldr, session, res))
+
+    existing = existing_sessions([s for _, s, _ in exports], session_table)
+    todo = []
+    keys = {}
+    for fldr, session, res in exports:
+        key = (pd.to_datetime(session['Adate']), session['Gantry'])
+        if key in existing:
+            skipped[fldr] = 'session already in '+session_table
+        elif key in keys:
+            # an export saved twice is imported once
+            skipped[fldr] = 'same session as '+keys[key]
+        else:
+            keys[key] = fldr
+            todo.append((fldr, session, res))
+    print('%d export folders to import, %d skipped' % (len(todo), len(skipped)))
+    if dry_run or not todo:
+        return [fldr for fldr, _, _ in todo], skipped
+
+    # one insert per session column set, sessions with and without humidity
+    session_writes = []
+    for humidity in [True, False]:
+        cols, names = db.session_columns(humidity)
+        rows = [[s[c] if s[c]!='' else None for c in names] for _, s, _ in todo if ('Humidity' in s)==humidity]
+        if rows:
+            session_writes.append([session_table, cols, rows])
+    res_cols, res_names = db.results_columns()
+    results_rows = [row for _, _, res in todo for row in res[res_names].values.tolist()]
+
+    db.submit_session(session_writes)
+    try:
+        db.submit_session([[results_table, res_cols, results_rows]])
+    except Exception:
+        # sessions without results would be skipped as existing on the next run
+        remaining = todo
+        try:
+            remaining = []
+            with db.DB.cursor(commit=True) as cursor:
+                for fldr, s, res in todo:
+                    # dates bound as datetimes, as existing_sessions compares them
+                    cursor.execute('DELETE FROM %s WHERE ADate = ? AND MachineName = ?' % session_table,
+                                   [pd.to_datetime(s['Adate']).to_pydatetime(), s['Gantry']])
+                    if cursor.rowcount!=1:
+                        remaining.append((fldr, s, res))
+        except Exception as e:
+            remaining = todo
+            print("Imported sessions could not be removed from %s (%s)." % (session_table, e))
+        if remaining:
+            print("Results not written; delete the sessions of these folders from %s before importing them again:"
+                  % session_table)
+            for fldr, s, _ in remaining:
+                print('    %s (%s, %s)' % (fldr, s['Adate'], s['Gantry']))
+        raise
+    return [fldr for fldr, _, _ in todo], skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import CSV session exports into the QA database.')
+    parser.add_argument('root', help='folder searched recursively for session.csv/result.csv exports')
+    parser.add_argument('--session-table', default=db.OUTPUT_SESSION_TABLE, help='session table (default: %(default)s)')
+    parser.add_argument('--results-table', default=db.OUTPUT_RESULTS_TABLE, help='results table (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='validate and list the folders without writing')
+    args = parser.parse_args(argv)
+
+    imported, skipped = import_exports(args.root, args.session_table, args.results_table, args.dry_run)
+    for fldr in imported:
+        print(('would import ' if args.dry_run else 'imported ')+fldr)
+    for fldr, reason in skipped.items():
+        print('skipped %s: %s' % (fldr, reason))
+    if any(reason.startswith('invalid') for reason in skipped.values()):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
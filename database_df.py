@@ -8,79 +8,171 @@ import re
 import os
 import sys
 import PySimpleGUI as sg
-import pypyodbc
-from pypyodbc import IntegrityError
 import pandas as pd
 import matplotlib
-import matplotlib.figure as figure
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.ticker import FormatStrFormatter
 from PIL import ImageGrab
-import seaborn as sns
 import configparser
 import datetime
+import time
+import threading
+import atexit
+import db_backend
+from db_session import ConnectionManager
+from ref_cache import RefCache
+from cal_timeline import CalTimeline
+from history_store import HistoryStore
+import heatmap_viewer as hv
 matplotlib.use('TkAgg')
 
 
 cfg = os.path.abspath(os.path.join(os.path.dirname(__file__), 'db_config.cfg'))
 config = configparser.ConfigParser()
 config.readfp(open(file=cfg))
-SESSION_TABLE = config.get('DB_DETAILS','SESSION_TABLE')
-RESULTS_TABLE = config.get('DB_DETAILS','RESULTS_TABLE')
 DB_PATH = config.get('DB_DETAILS','DB_PATH')
 PASSWORD = config.get('DB_DETAILS','PASSWORD')
+# output consistency tables written by Submit
+OUTPUT_SESSION_TABLE = 'LogosOPSession'
+OUTPUT_RESULTS_TABLE = 'LogosOPResults'
+# rows sent per executemany call when writing results
+BATCH_SIZE = config.getint('DB_DETAILS','BATCH_SIZE',fallback=100)
+
+# Access QA database or its SQLite stand-in, see db_backend
+BACKEND = db_backend.from_config(config)
+
+# pooled connections to the QA database, every read and write goes through DB
+DB = ConnectionManager(BACKEND.connect,
+                       errors=BACKEND.errors,
+                       size=2,
+                       max_open=4,
+                       ping_sql=BACKEND.ping_sql)
+atexit.register(DB.close)
+# output consistency session and results columns: database column, session/result dataframe (and CSV export) column
+SESSION_COLUMNS = [
+    ('ADate', 'Adate'), ('[Op1]', 'Op1'), ('[Op2]', 'Op2'), ('[T]', 'Temp'), ('[P]', 'P'),
+    ('Electrometer', 'Electrometer'), ('[V]', 'V'), ('MachineName', 'Gantry'), ('GA', 'GA'),
+    ('Chamber', 'Chamber'), ('kQ', 'kQ'), ('ks', 'ks'), ('kelec', 'kelec'), ('kpol', 'kpol'),
+    ('NDW', 'NDW'), ('TPC', 'TPC'), ('Humidity', 'Humidity'), ('Comments', 'Comments'),
+    ]
+RESULTS_COLUMNS = [('Rindex', 'Rindex'), ('ADate', 'ADate'), ('Energy', 'Energy'), ('[R]', 'R'), ('RGy', 'RGy')]
+
+
+def session_columns(humidity=True):
+    '''
+        (database columns string, dataframe columns) of an output consistency session, with or without Humidity
+    '''
+    columns = [c for c in SESSION_COLUMNS if humidity or c[0]!='Humidity']
+    return ','.join(c[0] for c in columns), [c[1] for c in columns]
+
+
+def results_columns():
+    '''
+        (database columns string, dataframe columns) of output consistency results
+    '''
+    return ','.join(c[0] for c in RESULTS_COLUMNS), [c[1] for c in RESULTS_COLUMNS]
+
+# named, parameterised read queries run on the QA database with run_query
+QUERIES = {
+    # most recent OutputConsRef dose of each energy of a gantry: MachineName
+    'output_cons_ref': '''
+                    Select A.Energy, A.RefDose
+                    From OutputConsRef As A
+                    Inner Join (
+                                Select Energy, MachineName, Max(RefDate) As MRefDate
+                                From OutputConsRef
+                                Group By Energy, MachineName) As B
+                    On A.Energy = B.Energy
+                    And A.MachineName = B.MachineName
+                    And A.RefDate = B.MRefDate
+                    WHERE  A.MachineName = ?
+                ''',
+    }
+
+
+def run_query(name=None, params=None):
+    '''
+        Run the named query of QUERIES with parameters params and return all records.
+        The statement is prepared once per pooled connection and its timings are
+        recorded under name (see DB.timing_report).
+    '''
+    return DB.fetchall(QUERIES[name], params, name=name)
+
+# local copy of the reference tables, read by populate_fields, update_cal and update_ref
+REF_CACHE = RefCache(DB.fetchall, errors=DB.errors)
+# local mirror of the result tables for trend views
+HISTORY = HistoryStore(DB.query, errors=DB.errors)
+# calibration timeline built from REF_CACHE and the cache load times it was built from
+_timeline = [None, None]
+_timeline_lock = threading.Lock()
+
 
-def populate_fields():
+def _popup(*args):
+    # tkinter popups are only safe on the GUI thread, background loaders print instead
+    if threading.current_thread() is threading.main_thread():
+        sg.popup(*args)
+    else:
+        print(" ".join(str(a) for a in args))
+
+
+def populate_fields(cached_only=False):
     '''
-        Populate dropdown boxes from database
+        Populate dropdown boxes from the local copy of the database (see ref_cache),
+        the offline snapshot ref_cache.SEED until the database has been read
+        input:
+            cached_only True reads the local copy without revalidating it against the database
         return:
             Op          list of operator initials
             Roos        list of Roos chamber serials
             Semiflex    list of semiflex serials
             El          list of electrrometer serials
     '''
-    print("Connecting to database...")
+    refresh = not cached_only
     connection_flag = True
     # operators list
-    fields = {'table': 'Operators', 'target': 'Initials', 'filter_var': None}
-    Op = read_db_data(fields)
+    Op = [r[0] for r in REF_CACHE.query('SELECT Initials FROM Operators', tables=['Operators'], refresh=refresh)]
     if not Op:
         print("Operator initials could not be retrieved from database!")
-        Op = ['AB', 'AG', 'AGr', 'AJP', 'AK', 'AM', 'AT', 'AW', 'CB', 'CG', 'LHC', 'PI', 'RM', 'SC', 'SG', 'SavC', 'TNC', 'VMA', 'VR']
         connection_flag = False
     Op.sort()
     # chamber list
-    fields = {'table': 'Assets', 'target': "[Serial Number]", 'filter_var': "Model", 'filter_val': 'TW34001SC'}
-    Roos = read_db_data(fields)
+    sql = 'SELECT [Serial Number] FROM Assets WHERE Model = ?'
+    Roos = [r[0] for r in REF_CACHE.query(sql, ['TW34001SC'], tables=['Assets'], refresh=refresh)]
     if not Roos:
         print("Roos serial numbers could not be retrieved from database!")
-        Roos = ['003126', '003128', '003131', '003132']
         connection_flag = False
     else:
         Roos = [str(int(i)) for i in Roos]
-    fields['filter_val'] = 'TW31021'
-    Semiflex = read_db_data(fields)
+    Semiflex = [r[0] for r in REF_CACHE.query(sql, ['TW31021'], tables=['Assets'], refresh=refresh)]
     if not Semiflex:
         print("Semiflex serial numbers could not be retrieved from database!")
-        Semiflex = ['142438', '142586', '142587']
         connection_flag = False
     # electrometer list
-    fields['filter_val'] = 'UnidosE'
-    El = read_db_data(fields)
+    El = [r[0] for r in REF_CACHE.query(sql, ['UnidosE'], tables=['Assets'], refresh=refresh)]
     if not El:
         print("Electrometer serial numbers could not be retrieved from database!")
-        El = ['92579', '92580', '92581']
         connection_flag = False
     if connection_flag:
         print("Connected...")
     return Op, Roos, Semiflex, El
 
 
-def update_ref(valtype):
+def empty_ref():
+    '''
+        ref_data dict (see update_ref) with every reference dose set to zero
+    '''
+    e_lst = list(range(240,69,-10))
+    return {'Energy': e_lst,
+        'Gantry 1': [0]*len(e_lst),
+        'Gantry 2': [0]*len(e_lst),
+        'Gantry 3': [0]*len(e_lst),
+        'Gantry 4': [0]*len(e_lst),
+        }
+
+
+def update_ref(valtype, cached_only=False):
     '''
         Create a dictionary ref_data of most recent reference dose values
-        in OutputConsRef table.
+        in the local copy of the LogosRef table (see ref_cache).
+        cached_only True reads the local copy without revalidating it against the database.
 
         list of reference dose energies:
             ref_data['Energy']
@@ -92,159 +184,158 @@ def update_ref(valtype):
             ref_data['Gantry 4']
     '''
     # instantiate reference data
-    e_lst = list(range(240,69,-10))
-    ref_data = {'Energy': e_lst,
-        'Gantry 1': [0]*len(e_lst),
-        'Gantry 2': [0]*len(e_lst),
-        'Gantry 3': [0]*len(e_lst),
-        'Gantry 4': [0]*len(e_lst),
-        }
-    # connect to DB
-    conn=None
-    if not DB_PATH:
-        sg.popup("Path Error.","Provide a path to the Access Database.")
-        print("Database Path Missing!")
-        return None
-    if PASSWORD:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-    else:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(DB_PATH)   
-    try:  
-        conn = pypyodbc.connect(new_connection)               
-    except:
-        print("Connection to QA database failed...")
-        sg.popup("Could not connect to database","WARNING")
-    if isinstance(conn,pypyodbc.Connection):
-        # retrieve most recent reference data from DB
-        sql =   '''
-                    Select A.Energy, A.MachineName, A.RefVal 
-                    From (  Select Energy
+    ref_data = empty_ref()
+    e_lst = ref_data['Energy']
+    # retrieve most recent reference data
+    sql =   '''
+                Select A.Energy, A.MachineName, A.RefVal 
+                From (  Select Energy
+                        , MachineName
+                        , RefVal
+                        , RefDate
+                        , RefType
+                        From LogosRef Where RefType = ?
+                    ) As A
+                Inner Join (
+                            Select Energy
                             , MachineName
-                            , RefVal
-                            , RefDate
                             , RefType
-                            From LogosRef Where RefType = '%s'
-                        ) As A
-                    Inner Join (
-                                Select Energy
-                                , MachineName
-                                , RefType
-                                , Max(RefDate) As MRefDate
-                                From LogosRef
-                                Group By Energy, MachineName, RefType
-                                ) As B
-                    On A.Energy = B.Energy
-                    And A.MachineName = B.MachineName
-                    And A.RefType = B.RefType
-                    And A.RefDate = B.MRefDate
-                ''' %(valtype)
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        records = cursor.fetchall()
-        cursor.close()
-        conn.commit()
-        conn = None        
-        #write to dict
-        for row in records:
-            en = row[0]
-            machine = row[1]
-            refdose = row[2]
-            if en in e_lst:
-                idx = e_lst.index(en)
-                ref_data[machine][idx]=refdose
+                            , Max(RefDate) As MRefDate
+                            From LogosRef
+                            Group By Energy, MachineName, RefType
+                            ) As B
+                On A.Energy = B.Energy
+                And A.MachineName = B.MachineName
+                And A.RefType = B.RefType
+                And A.RefDate = B.MRefDate
+            '''
+    records = REF_CACHE.query(sql, [valtype], tables=['LogosRef'], refresh=not cached_only)
+    if not records:
+        print("Reference doses could not be retrieved from database!")
+    #write to dict
+    for row in records:
+        en = row[0]
+        machine = row[1]
+        refdose = row[2]
+        if en in e_lst:
+            idx = e_lst.index(en)
+            ref_data[machine][idx]=refdose
     return ref_data
 
 
-def update_cal(Adate,roos,semiflex,elect):
+def update_cal(Adate,roos,semiflex,elect,cached_only=False):
     '''
-        Retrieve valid calibration factors from database
+        Retrieve valid calibration factors from the local copy of the database (see ref_cache)
         Input:
             Adate       string timestamp in the format dd/mm/yyyy hh:mm:ss
             roos        list of roos serial numbers
             semiflex    list of semiflex serial numbers
             elect       list of electrometer serial numbers
+            cached_only True reads the local copy without revalidating it against the database
 
-        Return int values for:
+        Return dicts of values valid on the Adate day (see cal_timeline):
             kpol
             ndw
             kelec
+            ks
     '''
     # concatenate all serial numbers
     roos = [str(int(i)) for i in roos]
     ch_numbers = roos + semiflex
 
-    # instantiate cal factor dicts
-    kpol = {}
-    ndw = {}
-    kelec = {}
     if Adate=='':
-        sg.popup("Date required","Please enter a date to retrieve the latest calibration factors.")
+        _popup("Date required","Please enter a date to retrieve the latest calibration factors.")
         return False
     else:
         # reformat date
         y = Adate[0:4]
         m = Adate[5:7]
         d = Adate[8:10]
-        #query_date = y+'-'+m+'-'+d
-        query_date = "'%s-%s-%s'"%(y,m,d)
-        # query database for most recent calibration factors
-        sql = '''SELECT CQ2.*, Assets.Category \
-            FROM Assets INNER JOIN \
-            (SELECT Calibration.Equipment, Calibration.[CalFactor], Calibration.Kpol, Calibration.[Cal Date] \
-            FROM (SELECT A.[Equipment], Max(A.[Cal Date]) AS [MaxOfCal Date] \
-            FROM Calibration AS A WHERE A.[Cal Date] <= CDate(%s) \
-            GROUP BY A.[Equipment])  AS CQ1 INNER JOIN Calibration \
-            ON (CQ1.[MaxOfCal Date] = Calibration.[Cal Date]) AND (CQ1.Equipment = Calibration.Equipment) \
-            WHERE ((Calibration.Operator) Is Not Null))  AS CQ2 ON Assets.Item = CQ2.Equipment;'''%(query_date)
-        try:
-            new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-            conn = pypyodbc.connect(new_connection) 
-        except:
-            return 1,1,1,1
-         
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        records = cursor.fetchall()
-        cursor.close()
-        conn.commit()
-        #conn = None
-        # cal factors to dicts
-        for k in records:
-            for x in ch_numbers:
-                if "["+x+"]" in k[0]:
-                    ndw[x]=int(k[1])
-                    kpol[x]=int(k[2])
-            for y in elect:
-                if "["+y+"]" in k[0]:
-                    kelec[y]=int(k[1])
-
-        # query database for most recent gantry-specific cal factors
+        # cached dates are 'YYYY-MM-DD HH:MM:SS' strings, start of the session day as CDate did
+        query_date = "%s-%s-%s 00:00:00"%(y,m,d)
+        timeline = calibration_timeline(cached_only)
+        return timeline.factors(query_date, ch_numbers, elect)
+
+
+def calibration_timeline(cached_only=False):
+    '''
+        Return the CalTimeline of the cached Calibration, Assets and Outputcons_ks tables.
+        The timeline is built once and rebuilt only when one of the tables is downloaded again.
+        cached_only True reads the local copy without revalidating it against the database.
+    '''
+    tables = ['Assets', 'Calibration', 'Outputcons_ks']
+    refresh = not cached_only
+    if refresh:
+        # an empty query revalidates expired tables (see RefCache.query)
+        REF_CACHE.query('SELECT 1', tables=tables)
+    meta = REF_CACHE.meta()
+    version = [meta.get(t, {}).get('loaded') for t in tables]
+    with _timeline_lock:
+        if _timeline[0] is not None and _timeline[1]==version:
+            return _timeline[0]
+        # full calibration history of every asset
+        sql = '''SELECT Calibration.Equipment, Calibration.[CalFactor], Calibration.Kpol, Calibration.[Cal Date], Calibration.Operator \
+            FROM Assets INNER JOIN Calibration ON Assets.Item = Calibration.Equipment'''
+        cal_records = REF_CACHE.query(sql, refresh=False)
+        sql = '''SELECT MachineName, CorrFactorVal, CalDate FROM Outputcons_ks WHERE CorrFactor = 'ks' '''
+        ks_records = REF_CACHE.query(sql, refresh=False)
+        _timeline[0] = CalTimeline(cal_records, ks_records)
+        _timeline[1] = version
+        return _timeline[0]
+
+
+# review_data results for the life of the session, keyed by gantry, angle and session day
+_review_cache = {}
+
+
+def review_data(gantry=None, angle=None, adate=None):
+    '''
+        Prefetch the data shown by review_dose, kept in memory for the rest of the session.
+        LogosRef is read from the local reference table copy (ref_cache) and the daily mean
+        doses from the local history store (history_store) after an incremental sync; only
+        the OutputConsRef doses are queried directly.
+
+        Input:
+            gantry      MachineName e.g. 'Gantry 1'
+            angle       gantry angle
+            adate       session timestamp, days from 12 months before to the session day are returned
+
+        Return:
+            df_ref      dataframe of current LogosRef DoseGy references: Energy, RefGy
+            df_hist     dataframe of historic daily mean doses: ADate (day), MachineName, GA, Energy,
+                        RGy, RGy_min, RGy_max, n, RefGy (OutputConsRef dose) and Diff (%)
+    '''
+    day = pd.Timestamp(adate).normalize()
+    key = (gantry, float(angle), day)
+    if key not in _review_cache:
         sql = '''
-                SELECT
-                    Outputcons_ks.MachineName, Outputcons_ks.CorrFactorVal
-                FROM
-                    (   SELECT
-                        MachineName, Max(CalDate) AS MCalD
-                        FROM
-                        Outputcons_ks
-                        GROUP BY
-                        MachineName) AS B
-                INNER JOIN
-                    Outputcons_ks
-                ON
-                    Outputcons_ks.MachineName = B.MachineName AND
-                    Outputcons_ks.CalDate = B.MCalD
-                WHERE
-                    Outputcons_ks.CorrFactor = 'ks'
+                Select A.Energy, A.RefVal
+                    From LogosRef As A
+                    Inner Join (
+                                Select Energy, MachineName, RefType, Max(RefDate) As MRefDate
+                                From LogosRef
+                                Group By Energy, MachineName, RefType
+                                ) As B
+                    On A.Energy = B.Energy
+                    And A.MachineName = B.MachineName
+                    And A.RefType = B.RefType
+                    And A.RefDate = B.MRefDate
+                    WHERE A.RefType = 'DoseGy' AND A.MachineName = ?
             '''
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        records = cursor.fetchall()
-        cursor.close()
-        conn.commit()
-        conn = None
-        ks = dict(records)
-        return kpol, ndw, kelec, ks
+        df_ref = pd.DataFrame(REF_CACHE.query(sql, [gantry], tables=['LogosRef']), columns=['Energy','RefGy'])
+
+        # daily mean doses of the 12 months before the session day
+        HISTORY.sync(['output'])
+        start = day - pd.DateOffset(years=1)
+        df = HISTORY.daily('output', gantry, float(angle), start, day).rename(columns={'Day': 'ADate'})
+
+        # most recent OutputConsRef doses of the gantry
+        refs = pd.DataFrame(list(run_query('output_cons_ref', [gantry])), columns=['Energy','RefGy'])
+        df = df.join(refs.set_index('Energy'), on='Energy')
+        df['Diff (%)'] = (df['RGy'].astype(float)-df['RefGy'])/df['RefGy']*100 # calculate percent diff from ref
+        _review_cache[key] = (df_ref, df)
+    df_ref, df = _review_cache[key]
+    return df_ref.copy(), df.copy()
 
 
 def review_dose(session_df=pd.DataFrame(), results_df=pd.DataFrame(), png_dir=None):
@@ -264,204 +355,34 @@ def review_dose(session_df=pd.DataFrame(), results_df=pd.DataFrame(), png_dir=No
     
     # retrieve current session's data
     query_gantry = session_df['Gantry'][0]
+    query_angle = session_df['GA'][0]
+    adate = pd.to_datetime(session_df['Adate'][0], format='%Y/%m/%d %H:%M:%S')
     dfrec = pd.DataFrame()
     dfrec['Energy']=results_df['Energy'].astype(int)
     dfrec['RGy']=results_df['RGy'].astype(float)
-    dfrec['ADate']=[pd.to_datetime(session_df['Adate'][0], format='%Y/%m/%d %H:%M:%S') for x in range(len(dfrec.index))]
+    dfrec['ADate']=[adate for x in range(len(dfrec.index))]
 
-    # retrieve previous Logos session's data
-    # Append to current session's data
-    # consider finding group average dose across readings (df.groupby ADate Energy mean RGy)
-
-    # retireve reference readings and join onto dataframe
-    sql =   '''
-                Select A.Energy, A.RefVal 
-                    From (  Select Energy
-                            , MachineName
-                            , RefVal
-                            , RefDate
-                            , RefType
-                            From LogosRef Where RefType = 'DoseGy'
-                        ) As A
-                    Inner Join (
-                                Select Energy
-                                , MachineName
-                                , RefType
-                                , Max(RefDate) As MRefDate
-                                From LogosRef
-                                Group By Energy, MachineName, RefType
-                                ) As B
-                    On A.Energy = B.Energy
-                    And A.MachineName = B.MachineName
-                    And A.RefType = B.RefType
-                    And A.RefDate = B.MRefDate
-                    WHERE  A.MachineName = '%s'
-            '''%(query_gantry)
-    
-    new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD)   
+    # reference and historic readings, fetched once per gantry, angle and date
     try:
-        conn = pypyodbc.connect(new_connection)
-        cursor = conn.cursor()
-        cursor.execute(sql)
-    except:
+        df_ref, df = review_data(query_gantry, query_angle, adate)
+    except DB.errors:
         sg.popup("Database Could Not Be Read","Check nobody is viewing the database and try again.")
         return
-    records = cursor.fetchall()
-    if len(records)==0:
+    if df_ref.empty:
         sg.popup("No Database Matches","No records in database match the equipment specified for this session")
         return
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    records = cursor.fetchall()
-    cursor.close()
-    conn.commit()
-    cols = ['Energy','RefGy']
-    df_ref = pd.DataFrame(list(records), columns=cols)
-    dfrec['ADate']=[pd.to_datetime(session_df['Adate'][0], format='%Y/%m/%d %H:%M:%S') for x in range(len(dfrec.index))]
+    G = query_gantry
+    GA = str(int(float(query_angle)))
+
+    # join reference readings onto current session's data
     dfrec = dfrec.join(df_ref.set_index('Energy'), on='Energy')
     dfrec['Diff (%)'] = (dfrec['RGy'].astype(float)-dfrec['RefGy'])/dfrec['RefGy']*100 # calculate percent diff from ref
-    
-    # retrieve historic readings from database
-    query_angle = session_df['GA'][0]  
-    y = session_df['Adate'][0][0:4]
-    m = session_df['Adate'][0][5:7]
-    d = session_df['Adate'][0][8:10]
-    query_date = "%s-%s-%s"%(int(y)-1,m,d) #confine historic record to previous 12 months
-    query_date2 = "%s-%s-%s"%(y,m,int(d))  
-    sql =   '''
-            SELECT  A.Adate
-                , A.[MachineName]
-                , A.[GA]
-                , A.[kQ]
-                , A.[ks]
-                , A.[kelec]
-                , A.[kpol]
-                , A.[NDW]
-                , A.[TPC]
-                , B.Energy
-                , B.[R]
-            FROM OutputConsSession A
-            INNER JOIN OutputConsResults B
-            ON A.Adate = B.ADate
-            WHERE A.[MachineName] LIKE '%%%s%%'
-            AND A.[GA]= %s
-            AND (A.Adate BETWEEN #%s# AND #%s#)
-            '''%(query_gantry, query_angle, query_date, query_date2)
-
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    records = cursor.fetchall()
-    cursor.close()
-    conn.commit()
-    G = records[0][1]
-    GA = str(int(records[0][2])) 
-    cols = [
-        'ADate',
-        'MachineName',
-        'GA',
-        'kQ',
-        'ks',
-        'kelec',
-        'kpol',
-        'NDW',
-        'TPC',
-        'Energy',
-        'R'
-    ]
-    df = pd.DataFrame(list(records), columns=cols)
-    df['RGy'] = df['R'] * df['kelec']*df['TPC']*df['ks']*df['NDW']*df['kpol']*df['kQ']*1.1/1000000000
-    df[['ADate','Energy','RGy']]
-
-    # retireve reference readings and join onto dataframe
-    sql =   '''
-                Select A.Energy, A.RefDose
-                From OutputConsRef As A
-                Inner Join (
-                            Select Energy, MachineName, Max(RefDate) As MRefDate
-                            From OutputConsRef
-                            Group By Energy, MachineName) As B
-                On A.Energy = B.Energy
-                And A.MachineName = B.MachineName
-                And A.RefDate = B.MRefDate
-                WHERE  A.MachineName = '%s'
-            '''%(query_gantry)
-
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    records = cursor.fetchall()
-    cursor.close()
-    conn.commit()
-    conn = None
-    cols = ['Energy','RefGy']
-    df_ref = pd.DataFrame(list(records), columns=cols)
-    df = df.join(df_ref.set_index('Energy'), on='Energy')
-    df['Diff (%)'] = (df['RGy'].astype(float)-df['RefGy'])/df['RefGy']*100 # calculate percent diff from ref
     df = pd.concat([df, dfrec])
-    df['ADate'] = df['ADate'].dt.floor('1d')
-    df['ADate'] = df['ADate'].dt.strftime('%Y/%m/%d')
-
-    # plot the output consistency results in a new window
-    vmax = max([abs(df['Diff (%)'].min()),abs(df['Diff (%)'].max())])
-    vmin = vmax*-1
-    df = df.pivot_table(index="Energy",columns="ADate",values="Diff (%)", aggfunc="mean")
-    cmap = 'vlag'
-    size_x = 500
-    size_y = 700
-    fig, axes = plt.subplots(1,2,
-                           gridspec_kw={'height_ratios':[1],
-                                  'width_ratios' :[1,0.01]},
-                            constrained_layout=True)
-    DPI = fig.get_dpi()
-    fig.set_size_inches(size_x * 2 / float(DPI), size_y / float(DPI))
-    sns.heatmap(df, cmap=cmap, square=False, 
-                ax=axes[0],
-                cbar_ax=axes[1],
-                vmax=vmax,
-                vmin=vmin)
-    axes[1].yaxis.set_major_formatter(FormatStrFormatter('%.1f'))
-    axes[1].yaxis.tick_left()
-    plt.sca(axes[1])    
-    plt.yticks(fontsize=6)
-    plt.ylabel("Difference From Dose Ref (%)", fontsize=10)
-    ax=axes[0]
-    ax.invert_yaxis()
-    plt.sca(ax)
-    plt.xlabel("Date (YYYY/MM/DD)", fontsize=8)
-    plt.xticks(rotation=45, ha='right', fontsize=6)
-    plt.ylabel("Energy (MeV)", fontsize=8)
-    plt.yticks(fontsize=6)
-    plt.title(G+" Outputs at GA"+GA, fontsize=10)
-
-    if os.path.isdir(png_dir):
-        fig.savefig(os.path.join('output_heatmap.png'))
-
-    # generate heatmap in popup window
-    layout = [
-        [sg.Canvas(key='controls_cv')],
-        [sg.Column(
-            layout=[[sg.Canvas(key='-CANVAS-', size=(size_x * 2, size_y))]],
-            background_color='#DAE0E6',
-            pad=(0, 0)
-            )
-        ],
-    ]
-    window = sg.Window("OUTPUT CONSISTENCY RESULTS", layout, modal=True, finalize=True)
-    choice = None
-    while True:
-        fig_canvas_agg = _draw_figure(window['-CANVAS-'].TKCanvas, fig)
-        event, values = window.read()
-        if event == "Exit" or event == sg.WIN_CLOSED:
-            break
-        
-    window.close()
-    return None
-
 
-def _draw_figure(canvas, figure):
-    figure_canvas_agg = FigureCanvasTkAgg(figure, canvas)
-    figure_canvas_agg.draw()
-    figure_canvas_agg.get_tk_widget().pack(side='top', fill='both', expand=1)
-    return figure_canvas_agg
+    # plot the output consistency results in a new window, rendered once per data set
+    viewer = hv.get_viewer(df, G, GA, title=G+" Outputs at GA"+GA)
+    hv.show(viewer, png_dir)
+    return None
 
 
 def save_element_as_file(element, filename):
@@ -510,196 +431,67 @@ def review_range(chev_results=None, png_file=None, fail_threshold=1.0, warn_thre
     window2.close()
     return
 
-def read_db_data(fields):
-    '''
-        Helper function
-        Return record from a table as a list
-        If DB connection fails, return None
-        Input dict fields:
-            fields['target']        desired record field(s)
-            fields['table']         table containing the records
-            fields['filter_var']    field to filter records
-            fields['filter_val']    value of filter field
-        
-        Return:
-            data                    list of records
-    '''
 
-    target = fields['target']
-    table = fields['table']
-    filter_var = fields['filter_var']
-    if filter_var:
-        filter_val = fields['filter_val']
+def _insert_sql(table, cols, n_cols):
+    # parameterised INSERT, every column in table order if cols is None
+    if cols:
+        vals = re.sub(r"([^,]+)", "?", cols)
+        return 'INSERT INTO "%s" (%s) VALUES (%s)'%(table, cols, vals)
+    return 'INSERT INTO "%s" VALUES (%s)'%(table, ", ".join(["?"]*n_cols))
 
-    conn=None
 
-    if not DB_PATH:
-        sg.popup("Path Error.","Provide a path to the Access Database.")
-        print("Database Path Missing!")
-        return None
-    if PASSWORD:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-    else:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(DB_PATH)   
-    try:  
-        conn = pypyodbc.connect(new_connection)               
-    except:
-        print("Connection to table '"+table+"' failed...")
-        sg.popup("Could not connect to database","WARNING")
-        return None
-    if isinstance(conn,pypyodbc.Connection):
-        if filter_var:
-            sql = '''
-                    SELECT %s FROM %s WHERE %s = '%s'
-                '''%(target, table, filter_var, filter_val)
-        else:
-            sql = '''
-                    SELECT %s FROM %s
-                '''%(target, table)
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        records = cursor.fetchall()
-        cursor.close()
-        conn.commit()
-        conn = None
-        data = []
-        for row in records:
-            if len(row)==1:
-                data.append(row[0])
-            else:
-                data.append(list(row))
-        return data
-    else:
-        return None
-
-def write_session_data(conn,df_session,session_table,cols):
-    '''
-        Helper function
-        Write to session table and return True if successful, else false
-        Input:
-            conn            database connection object
-            df_session      dataframe of session table values
-    ''' 
-    cursor = conn.cursor() 
-    vals = re.sub(r"([^,]+)", "?", cols) 
-    sql = '''
-            INSERT INTO "%s" (%s)
-            VALUES (%s)
-            '''%(session_table, cols, vals)
-    data = df_session.values.tolist()[0] 
-    print(data)
-    print(cols)
-    try:
-        print("Writing session to database...")
-        cursor.execute(sql, data)
-        conn.commit()
-        cursor.close()
-        return True
-    except IntegrityError:
-        sg.popup("Session Write Error","WARNING: Write to database failed.")
-        print("Integrity Error, nothing written to database")
-        cursor.close()
-        return False  
-
-
-def write_results_data(conn,df_results,results_table,cols):
+def submit_session(writes, batch_size=BATCH_SIZE):
     '''
-        Helper function
-        Write results to table and return True if successful
+        Write several tables as one all-or-nothing transaction over a single connection.
+        Nothing is committed unless every row of every table is written; on any
+        failure the transaction is rolled back and the error is raised.
         Input:
-            conn            database connection object
-            df_results      dataframe of results table values
-            cols            string of comma separated database column names
-        
+            writes          list of [table, cols, rows] in write order (session tables before their results),
+                            cols is a string of comma separated column names or None for every column,
+                            rows a list of row value lists
+            batch_size      rows per executemany call
+
         Return:
-            write_flag      True if write successful, else False
+            stats           list of dicts per table: 'table', 'rows' (rows written), 'seconds' (write time)
     '''
-
-    cursor = conn.cursor() 
-    vals = re.sub(r"([^,]+)", "?", cols) 
-    sql = '''
-            INSERT INTO "%s" (%s)
-            VALUES (%s)
-            '''%(results_table, cols, vals)
-    print("Writing results to database...")
-    write_flag = True
-    for row in df_results.values.tolist():
+    stats = []
+    batch_size = max(int(batch_size), 1)
+    with DB.connection() as conn:
+        cursor = conn.cursor()
         try:
-            cursor.execute(sql, row)
-        except IntegrityError:
-            sg.popup("Results Write Error","WARNING: Write to database failed.")
-            print("Integrity Error, record not written to database:"+str(row))
-            write_flag = False        
-    conn.commit()
-    cursor.close()
-    return write_flag
+            for table, cols, rows in writes:
+                t0 = time.perf_counter()
+                rows = [list(row) for row in rows]
+                if rows:
+                    sql = _insert_sql(table, cols, len(rows[0]))
+                    for i in range(0, len(rows), batch_size):
+                        cursor.executemany(sql, rows[i:i+batch_size])
+                stats.append({'table': table, 'rows': len(rows), 'seconds': time.perf_counter()-t0})
+            t0 = time.perf_counter()
+            conn.commit()
+            stats.append({'table': 'COMMIT', 'rows': sum(st['rows'] for st in stats), 'seconds': time.perf_counter()-t0})
+        finally:
+            cursor.close()
+    return stats
 
 
-def write_to_db(df_session,df_results,session_table,results_table,sess_cols,res_cols):
+def session_exists(adate=None, gantry=None):
     '''
-        Write session and results dataframes to tables
-        Input:
-            df_session      dataframe of session table values   
-            df_results      dataframe of results table values
-            sess_cols       string of comma separated database session column names
-            res_cols        string of comma separated database results column names
+        True if the session of ADate adate on gantry is in the OUTPUT_SESSION_TABLE table
     '''
-    
-    conn=None
-
-    if not DB_PATH:
-        sg.popup("Write Failed.","Provide a path to the Access Database.")
-        return
-
-    if PASSWORD:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-    else:
-        new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(DB_PATH)   
-
-    try:  
-        print('trying to connect')
-        conn = pypyodbc.connect(new_connection)                 
-    except:
-        #sg.popup("Could not connect to database, nothing written","WARNING")
-        print("Could not connect to database; nothing written")
-    
-    if isinstance(conn,pypyodbc.Connection):
-        session_written = write_session_data(conn,df_session,session_table,sess_cols)
-        print("Session "+session_table+" Write Status: "+str(session_written))
-        if session_written:
-            results_written = write_results_data(conn,df_results,results_table,res_cols)
-            print("Results "+results_table+" Write Status: "+str(results_written))
-
-
-
-def push_spot_session(session_data, conn, cursor):
     sql = '''
-          INSERT INTO SpotPositionSession VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-          '''
-    try:
-        cursor.execute(sql, session_data)
-        conn.commit()
-        return True
-    except:
-        conn = None
-        return False
-
-
-def push_spot_results(spot_results, conn, cursor):
-    sql = '''
-          INSERT INTO SpotPositionResults VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-          '''
-    try:
-        for i, val in enumerate(spot_results):
-            cursor.execute(sql, val)
-            conn.commit()
-    except:
-        conn = None
+            SELECT COUNT(*) FROM %s WHERE ADate = ? AND MachineName = ?
+        ''' % OUTPUT_SESSION_TABLE
+    return DB.fetchall(sql, [adate, gantry], name='session_exists')[0][0] > 0
 
 
-### write spot grid data to DB
-def spots_to_db(all_data=None, spotpatterns=None, values=None, values2={'-COMMENT2-': " PostISM"}):
-    #adate = values['ADate'].strftime("%Y/%m/%d %H:%M:%S")
+def spot_rows(all_data=None, spotpatterns=None, values=None):
+    '''
+        SpotPositionSession and SpotPositionResults rows of a spot grid session
+        Return:
+            sess_data       SpotPositionSession row (8 entries)
+            rows            SpotPositionResults rows (20 entries each) for every energy
+    '''
     if len(values['-ML-'])<255:
         session_comment = values['-ML-']
     else:
@@ -708,28 +500,10 @@ def spots_to_db(all_data=None, spotpatterns=None, values=None, values2={'-COMMEN
     gantry = values['-G-']
     # SpotPositionSession (8 entries)
     sess_data = [values['ADate'], gantry, device, values['GA'], values['-Op1-'], values['-Op2-'], session_comment, None]
-    # push the session data to database
-    new_connection = 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(DB_PATH,PASSWORD) 
-    conn = pypyodbc.connect(new_connection) 
-    cursor = conn.cursor()
-    print("Writing session to database...")
-    try:
-        push_session = push_spot_session(sess_data, conn, cursor)
-        print('Session SpotPositionSession Write Status: True')
-    except:
-        print('Session SpotPositionSession Write Status: False')
-    if push_session == True:
-        # push results data to database
-        print("Writing results to database...")
-        try:
-            for key in all_data.keys():
-                for i,_ in enumerate(all_data[key]):
-                    all_data[key][i][0]=values['ADate']
-                    all_data[key][i][1]=gantry
-                push_spot_results(all_data[key], conn, cursor)
-            print('Session SpotPositionResults Write Status: True')
-            conn=None
-        except:
-            print('Session SpotPositionResults Write Status: False')
-            conn=None
-
+    rows = []
+    for key in all_data.keys():
+        for i,_ in enumerate(all_data[key]):
+            all_data[key][i][0]=values['ADate']
+            all_data[key][i][1]=gantry
+        rows.extend(all_data[key])
+    return sess_data, rows
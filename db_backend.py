@@ -0,0 +1,208 @@
+"""
+QA database backends
+
+A backend provides the connections used by database_df (see db_session), the
+exception classes its driver raises and the SQL dialect differences:
+
+    AccessBackend   the Access QA database through the Microsoft Access ODBC driver
+    SQLiteBackend   a local SQLite stand-in created from db_schema.sql, with
+                    optional latency injected per round trip, so the read and
+                    write paths can be run and timed away from the QA database
+
+The backend is chosen with the BACKEND option of db_config.cfg (access or
+sqlite, default access); DB_PATH is the Access database or the SQLite file.
+
+SQLite has no date type, so the SQLite backend stores dates as
+'YYYY-MM-DD HH:MM:SS' strings: datetime parameters and the GUI date strings
+('YYYY/MM/DD HH:MM:SS') are converted on every execute, and dates compare in SQL
+as they do in Access.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import datetime
+
+SCHEMA = os.path.abspath(os.path.join(os.path.dirname(__file__), 'db_schema.sql'))
+BACKENDS = ['access', 'sqlite']
+# GUI date strings, e.g. 2024/01/31 09:30:00
+GUI_DATE_RE = re.compile(r'^\d{4}/\d{2}/\d{2}( \d{2}:\d{2}:\d{2})?$')
+
+
+class AccessBackend():
+    '''
+        Access QA database over ODBC.
+
+        input:
+            db_path     - (str) Access database file
+            password    - (str) database password, empty for none
+    '''
+    name = 'access'
+    ping_sql = 'SELECT TOP 1 Initials FROM Operators'
+
+    def __init__(self, db_path=None, password=None):
+        # the ODBC driver is only needed by this backend
+        import pypyodbc
+        self._driver = pypyodbc
+        self.db_path = db_path
+        self.password = password
+        self.errors = (pypyodbc.Error,)
+        self.integrity_errors = (pypyodbc.IntegrityError,)
+
+    def connection_string(self):
+        if self.password:
+            return 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s;PWD=%s'%(self.db_path, self.password)
+        return 'DRIVER={Microsoft Access Driver (*.mdb, *.accdb)};DBQ=%s'%(self.db_path)
+
+    def connect(self):
+        '''
+            Open a new connection to the QA database
+        '''
+        return self._driver.connect(self.connection_string())
+
+
+class SQLiteBackend():
+    '''
+        SQLite stand-in for the QA database, the tables of schema are created if missing
+        and dates written before they were converted (GUI date strings) are converted.
+
+        input:
+            db_path     - (str) SQLite file
+            schema      - (str) SQL file of CREATE TABLE IF NOT EXISTS statements
+            latency     - (float) seconds added to every round trip (execute, executemany,
+                          fetch, commit and rollback), 0 for none
+    '''
+    name = 'sqlite'
+    ping_sql = 'SELECT Initials FROM Operators LIMIT 1'
+    errors = (sqlite3.Error,)
+    integrity_errors = (sqlite3.IntegrityError,)
+
+    def __init__(self, db_path=None, schema=SCHEMA, latency=0.0):
+        self.db_path = db_path
+        self.latency = latency
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with open(schema) as f:
+            sql = f.read()
+        con = sqlite3.connect(db_path)
+        try:
+            con.executescript(sql)
+            with con:
+                _convert_dates(con)
+        finally:
+            con.close()
+
+    def connect(self):
+        '''
+            Open a new connection to the SQLite file, delayed by latency per round trip
+        '''
+        # pooled connections are handed between threads, one at a time
+        con = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        return _Connection(con, self.latency)
+
+
+class _Connection():
+    # connection proxy converting date parameters and sleeping latency seconds on every round trip
+    def __init__(self, con, latency):
+        self._con = con
+        self._latency = latency
+
+    def cursor(self):
+        return _Cursor(self._con.cursor(), self._latency)
+
+    def commit(self):
+        self._wait()
+        self._con.commit()
+
+    def rollback(self):
+        self._wait()
+        self._con.rollback()
+
+    def _wait(self):
+        if self._latency:
+            time.sleep(self._latency)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+class _Cursor():
+    # cursor proxy converting date parameters and sleeping latency seconds on every round trip
+    def __init__(self, cursor, latency):
+        self._cursor = cursor
+        self._latency = latency
+
+    def execute(self, sql, params=()):
+        self._wait()
+        self._cursor.execute(sql, [sqlite_param(v) for v in params or ()])
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._wait()
+        self._cursor.executemany(sql, [[sqlite_param(v) for v in params] for params in seq_of_params])
+        return self
+
+    def fetchone(self):
+        self._wait()
+        return self._cursor.fetchone()
+
+    def fetchmany(self, *args):
+        self._wait()
+        return self._cursor.fetchmany(*args)
+
+    def fetchall(self):
+        self._wait()
+        return self._cursor.fetchall()
+
+    def _wait(self):
+        if self._latency:
+            time.sleep(self._latency)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def sqlite_param(v):
+    '''
+        Query parameter as the SQLite backend stores it: datetimes and GUI date strings
+        as 'YYYY-MM-DD HH:MM:SS' strings, other values unchanged
+    '''
+    if isinstance(v, datetime.datetime):
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(v, datetime.date):
+        return v.strftime('%Y-%m-%d 00:00:00')
+    if isinstance(v, str) and GUI_DATE_RE.match(v):
+        v = v.replace('/', '-')
+        return v if len(v)>10 else v+' 00:00:00'
+    return v
+
+
+def _convert_dates(con):
+    # GUI date strings stored in the ADate columns by earlier versions
+    tables = [r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for table in tables:
+        columns = [r[1] for r in con.execute('PRAGMA table_info("%s")' % table)]
+        if 'ADate' in columns:
+            con.execute('''UPDATE OR IGNORE "%s" SET ADate = REPLACE(ADate, '/', '-')
+                           WHERE ADate LIKE '____/__/__ __:__:__' ''' % table)
+
+
+def from_config(config=None, section='DB_DETAILS'):
+    '''
+        Return the backend configured in section of config (a ConfigParser):
+            BACKEND         access (default) or sqlite
+            DB_PATH         Access database or SQLite file
+            PASSWORD        Access database password
+            LATENCY         SQLite backend seconds per round trip (default 0)
+    '''
+    name = config.get(section, 'BACKEND', fallback='access').strip().lower()
+    db_path = config.get(section, 'DB_PATH')
+    if name=='access':
+        return AccessBackend(db_path, config.get(section, 'PASSWORD', fallback=''))
+    if name=='sqlite':
+        return SQLiteBackend(db_path, latency=config.getfloat(section, 'LATENCY', fallback=0.0))
+    raise ValueError("Unknown database backend: "+name+" (expected one of "+", ".join(BACKENDS)+")")
@@ -0,0 +1,143 @@
+-- QA database tables used by PostISM, created by db_backend.SQLiteBackend
+-- Column names and order follow the Access QA database; dates are stored as
+-- 'YYYY-MM-DD HH:MM:SS' strings.
+
+-- reference tables
+CREATE TABLE IF NOT EXISTS Operators (
+    Initials TEXT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS Assets (
+    Item TEXT,
+    [Serial Number] TEXT,
+    Model TEXT,
+    Category TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Calibration (
+    Equipment TEXT,
+    CalFactor REAL,
+    Kpol REAL,
+    [Cal Date] TEXT,
+    Operator TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Outputcons_ks (
+    MachineName TEXT,
+    CorrFactor TEXT,
+    CorrFactorVal REAL,
+    CalDate TEXT
+);
+
+CREATE TABLE IF NOT EXISTS LogosRef (
+    Energy INTEGER,
+    MachineName TEXT,
+    RefVal REAL,
+    RefDate TEXT,
+    RefType TEXT
+);
+
+CREATE TABLE IF NOT EXISTS OutputConsRef (
+    Energy INTEGER,
+    MachineName TEXT,
+    RefDose REAL,
+    RefDate TEXT
+);
+
+-- output consistency sessions (Giraffe and Logos)
+CREATE TABLE IF NOT EXISTS OutputConsSession (
+    ADate TEXT PRIMARY KEY,
+    Op1 TEXT,
+    Op2 TEXT,
+    T REAL,
+    P REAL,
+    Electrometer TEXT,
+    V REAL,
+    MachineName TEXT,
+    GA INTEGER,
+    Chamber TEXT,
+    kQ REAL,
+    ks REAL,
+    kelec REAL,
+    kpol REAL,
+    NDW REAL,
+    TPC REAL,
+    Humidity REAL,
+    Comments TEXT
+);
+
+CREATE TABLE IF NOT EXISTS OutputConsResults (
+    Rindex TEXT,
+    ADate TEXT,
+    Energy INTEGER,
+    R REAL,
+    RGy REAL
+);
+
+CREATE TABLE IF NOT EXISTS LogosOPSession (
+    ADate TEXT PRIMARY KEY,
+    Op1 TEXT,
+    Op2 TEXT,
+    T REAL,
+    P REAL,
+    Electrometer TEXT,
+    V REAL,
+    MachineName TEXT,
+    GA INTEGER,
+    Chamber TEXT,
+    kQ REAL,
+    ks REAL,
+    kelec REAL,
+    kpol REAL,
+    NDW REAL,
+    TPC REAL,
+    Humidity REAL,
+    Comments TEXT
+);
+
+CREATE TABLE IF NOT EXISTS LogosOPResults (
+    Rindex TEXT,
+    ADate TEXT,
+    Energy INTEGER,
+    R REAL,
+    RGy REAL
+);
+
+-- chevron range sessions
+CREATE TABLE IF NOT EXISTS ChevronSession (
+    ADate TEXT PRIMARY KEY,
+    Op1 TEXT,
+    Op2 TEXT,
+    MachineName TEXT,
+    GA INTEGER,
+    Comments TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ChevronResults (
+    ADate TEXT,
+    Energy INTEGER,
+    D80 REAL,
+    DiffTPS REAL,
+    DiffNIST REAL,
+    DiffBaseline REAL
+);
+
+-- spot grid sessions, written positionally (see database_df.spot_rows)
+CREATE TABLE IF NOT EXISTS SpotPositionSession (
+    ADate TEXT PRIMARY KEY,
+    MachineName TEXT,
+    Device TEXT,
+    GA INTEGER,
+    Op1 TEXT,
+    Op2 TEXT,
+    Comments TEXT,
+    Notes TEXT
+);
+
+-- results columns after MachineName follow spotanalysis.constants.db_cols
+CREATE TABLE IF NOT EXISTS SpotPositionResults (
+    ADate TEXT,
+    MachineName TEXT,
+    C3, C4, C5, C6, C7, C8, C9, C10,
+    C11, C12, C13, C14, C15, C16, C17, C18, C19, C20
+);
@@ -0,0 +1,266 @@
+"""
+Pooled, reusable database connections
+
+Opening an ODBC connection to the Access QA database on the network share is
+slow, so a small pool of live connections is kept and handed out through
+context managers. Idle connections are health checked before reuse and broken
+connections are replaced. At most max_open connections are checked out at
+once; further callers wait for one to be returned.
+
+Read queries are parameterised and run on a cursor kept per connection and SQL
+statement, so the driver prepares each statement once per connection and
+reuses it on later calls. The time of every read query, and of every execute,
+executemany and commit made through connection() or cursor(), is recorded
+under its name (or SQL) and can be printed with timing_report.
+"""
+
+import time
+import threading
+import contextlib
+
+
+class ConnectionManager():
+    '''
+        Pool of database connections.
+
+        input:
+            connect     - (callable) returns a new DB-API connection
+            errors      - (tuple) exception classes raised by the database driver
+            size        - (int) maximum number of idle connections kept open
+            max_open    - (int) maximum number of connections checked out at once
+            max_idle    - (float) seconds after which an idle connection is health checked before reuse
+            ping_sql    - (str) cheap query used for the health check, None to skip the query
+            statements  - (int) maximum number of prepared statements kept per connection
+    '''
+    def __init__(self, connect=None, errors=(Exception,), size=2, max_open=4, max_idle=60.0, ping_sql=None,
+                 statements=32):
+        self._connect = connect
+        self.errors = errors
+        self.size = size
+        self.max_open = max_open
+        self._open = threading.BoundedSemaphore(max_open)
+        self.max_idle = max_idle
+        self.ping_sql = ping_sql
+        self.statements = statements
+        self._idle = []
+        self._lock = threading.Lock()
+        # id(connection): {sql: cursor} of the statements prepared on the connection
+        self._prepared = {}
+        # query name: [calls, total seconds, max seconds]
+        self._timings = {}
+
+    @contextlib.contextmanager
+    def connection(self):
+        '''
+            Context manager yielding a pooled connection.
+            Uncommitted work is rolled back if the block raises; connections that
+            cannot be rolled back are discarded instead of returned to the pool.
+            execute, executemany and commit are timed under their SQL ('COMMIT').
+        '''
+        with self._checkout() as conn:
+            yield _TimedConnection(conn, self._record)
+
+    @contextlib.contextmanager
+    def cursor(self, commit=False):
+        '''
+            Context manager yielding a cursor on a pooled connection, committed on exit if commit is True
+        '''
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                if commit:
+                    conn.commit()
+            finally:
+                _close(cursor)
+
+    def fetchall(self, sql=None, params=None, retries=1, name=None):
+        '''
+            Run a read query and return all records.
+            The statement is prepared once per connection and reused; driver errors
+            are retried on a fresh connection. The run time is recorded under name (default sql).
+        '''
+        return self.query(sql, params, retries, name)[1]
+
+    def query(self, sql=None, params=None, retries=1, name=None):
+        '''
+            As fetchall, but return (column names, records)
+        '''
+        for attempt in range(retries+1):
+            try:
+                with self._checkout() as conn:
+                    t0 = time.perf_counter()
+                    cursor = self._statement(conn, sql)
+                    if params is None:
+                        cursor.execute(sql)
+                    else:
+                        cursor.execute(sql, params)
+                    columns = [d[0] for d in cursor.description]
+                    records = cursor.fetchall()
+                    self._record(name or sql, time.perf_counter()-t0)
+                    return columns, records
+            except self.errors:
+                if attempt == retries:
+                    raise
+                # connection may have dropped, start again on a new one
+                self.clear()
+
+    def timings(self):
+        '''
+            Dict of query name: {'calls', 'seconds' (total), 'max'} of the queries and writes run so far
+        '''
+        with self._lock:
+            return {k: {'calls': v[0], 'seconds': v[1], 'max': v[2]} for k, v in self._timings.items()}
+
+    def timing_report(self):
+        '''
+            Print the query and write timings, slowest total first
+        '''
+        timings = self.timings()
+        for name in sorted(timings, key=lambda k: -timings[k]['seconds']):
+            t = timings[name]
+            print("%-40s %5d calls %8.3f s total %8.3f s max" % (' '.join(name.split())[:40], t['calls'], t['seconds'], t['max']))
+
+    def clear(self):
+        '''
+            Close all idle connections
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    close = clear
+
+    @contextlib.contextmanager
+    def _checkout(self):
+        # unwrapped pooled connection, one of the max_open slots is held until it is returned
+        self._open.acquire()
+        try:
+            conn = self._acquire()
+            try:
+                yield conn
+            except BaseException:
+                try:
+                    conn.rollback()
+                except Exception:
+                    self._discard(conn)
+                    raise
+                self._release(conn)
+                raise
+            else:
+                self._release(conn)
+        finally:
+            self._open.release()
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if self._healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+        return self._connect()
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._discard(conn)
+
+    def _healthy(self, conn, last_used):
+        if not getattr(conn, 'connected', True):
+            return False
+        if time.monotonic()-last_used < self.max_idle or not self.ping_sql:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.ping_sql)
+            cursor.fetchall()
+            _close(cursor)
+            return True
+        except Exception:
+            return False
+
+
+    def _statement(self, conn, sql):
+        # cursor holding sql prepared on conn, oldest statements are closed beyond self.statements
+        with self._lock:
+            prepared = self._prepared.setdefault(id(conn), {})
+            cursor = prepared.pop(sql, None)
+            if cursor is None:
+                cursor = conn.cursor()
+                if len(prepared) >= self.statements:
+                    _close(prepared.pop(next(iter(prepared))))
+            prepared[sql] = cursor
+        return cursor
+
+    def _record(self, name, seconds):
+        with self._lock:
+            t = self._timings.setdefault(name, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    def _discard(self, conn):
+        # close a connection and the statements prepared on it
+        with self._lock:
+            prepared = self._prepared.pop(id(conn), {})
+        for cursor in prepared.values():
+            _close(cursor)
+        _close(conn)
+
+
+class _TimedConnection():
+    # connection proxy handing out timed cursors and timing commit
+    def __init__(self, conn, record):
+        self._conn = conn
+        self._record = record
+
+    def cursor(self):
+        return _TimedCursor(self._conn.cursor(), self._record)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        self._conn.commit()
+        self._record('COMMIT', time.perf_counter()-t0)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class _TimedCursor():
+    # cursor proxy timing execute and executemany under their SQL
+    def __init__(self, cursor, record):
+        self._cursor = cursor
+        self._record = record
+
+    def execute(self, sql, *args):
+        t0 = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, *args)
+        finally:
+            self._record(sql, time.perf_counter()-t0)
+
+    def executemany(self, sql, *args):
+        t0 = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, *args)
+        finally:
+            self._record(sql, time.perf_counter()-t0)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _close(obj):
+    try:
+        obj.close()
+    except Exception:
+        pass
@@ -114,10 +114,13 @@ def build_window(Op, kq, rbe, El, G, Chtype, V, Rng, Ch, layers):
     #buttons
     button_layout = [
         [sg.B('Check Session', key='-AnalyseS-'),
+         sg.Checkbox('Re-analyse', key='-NoCache-', default=False, tooltip='Ignore cached results and analyse all Logos data again'),
          sg.B('Submit to Database', disabled=True, key='-Submit-'),
          sg.FolderBrowse('Export to CSV', key='-CSV_WRITE-', disabled=True, target='-Export-', visible=False), sg.In(key='-Export-', enable_events=True, visible=False),
          sg.B('Clear Results', button_color='red', key='-NxtSess-'),
-         sg.ProgressBar(max_value=10, orientation='h', size=(48, 20), key='progress')],
+         sg.ProgressBar(max_value=10, orientation='h', size=(48, 20), key='progress'),
+         sg.B('Queue', key='-Queue-', tooltip='Sessions waiting to be written to the database'),
+         sg.Text('', key='-QueueStatus-', size=(24,1))],
     ]
 
     #combine layout elements
@@ -0,0 +1,137 @@
+"""
+Output consistency heatmap viewer
+
+The percentage dose differences are pivoted once per session data set into an
+energy x day table. Heatmaps are rendered off screen with the Agg backend to
+PNG images, which are cached per date window, and shown in the popup window as
+an image, so window events do not redraw the figure. Zooming into a date window
+slices the pivot table's columns instead of pivoting the data again, and the
+colour scale stays that of the full year.
+
+Viewers are cached by gantry, gantry angle, latest session date and a hash of
+the data, and reused while the data is unchanged.
+"""
+
+import io
+import os
+import hashlib
+import pandas as pd
+import PySimpleGUI as sg
+import seaborn as sns
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.ticker import FormatStrFormatter
+
+SIZE_X = 1000
+SIZE_Y = 700
+CMAP = 'vlag'
+# date windows offered in the viewer: label, months before the latest session (None = all)
+WINDOWS = [('All', None), ('6 months', 6), ('3 months', 3), ('1 month', 1)]
+# viewers of the session: key -> HeatmapViewer
+_viewers = {}
+
+
+class HeatmapViewer():
+    '''
+        Cached heatmap renderer of output consistency differences.
+
+        input:
+            df          - (dataframe) ADate (datetime), Energy and Diff (%) columns
+            title       - (str) plot title
+    '''
+    def __init__(self, df=None, title=''):
+        days = pd.to_datetime(df['ADate']).dt.floor('1d')
+        self.table = pd.pivot_table(df.assign(ADate=days), index='Energy', columns='ADate',
+                                    values='Diff (%)', aggfunc='mean').sort_index(axis=1)
+        self.title = title
+        self.vmax = max([abs(df['Diff (%)'].min()), abs(df['Diff (%)'].max())])
+        self.latest = self.table.columns.max()
+        self._images = {}
+
+    def window(self, months=None):
+        '''
+            (start, end) days of the window ending at the latest session, start None for all dates
+        '''
+        if months is None:
+            return None, self.latest
+        return self.latest - pd.DateOffset(months=months), self.latest
+
+    def png(self, start=None, end=None):
+        '''
+            Return the heatmap of days start to end (inclusive, None = unbounded) as PNG bytes
+        '''
+        key = (start, end)
+        if key not in self._images:
+            fig = self._figure(self.table.loc[:, start:end])
+            buf = io.BytesIO()
+            fig.savefig(buf, format='png')
+            self._images[key] = buf.getvalue()
+        return self._images[key]
+
+    def save(self, filename=None, start=None, end=None):
+        '''
+            Write the heatmap of days start to end to filename
+        '''
+        with open(filename, 'wb') as f:
+            f.write(self.png(start, end))
+
+    def _figure(self, table):
+        fig = Figure(constrained_layout=True)
+        FigureCanvasAgg(fig)
+        DPI = fig.get_dpi()
+        fig.set_size_inches(SIZE_X / float(DPI), SIZE_Y / float(DPI))
+        axes = fig.subplots(1, 2, gridspec_kw={'height_ratios': [1], 'width_ratios': [1, 0.01]})
+        table = table.copy()
+        table.columns = [d.strftime('%Y/%m/%d') for d in table.columns]
+        sns.heatmap(table, cmap=CMAP, square=False, ax=axes[0], cbar_ax=axes[1], vmax=self.vmax, vmin=-self.vmax)
+        axes[1].yaxis.set_major_formatter(FormatStrFormatter('%.1f'))
+        axes[1].yaxis.tick_left()
+        axes[1].tick_params(axis='y', labelsize=6)
+        axes[1].set_ylabel("Difference From Dose Ref (%)", fontsize=10)
+        ax = axes[0]
+        ax.invert_yaxis()
+        ax.set_xlabel("Date (YYYY/MM/DD)", fontsize=8)
+        ax.tick_params(axis='x', labelsize=6, labelrotation=45)
+        for label in ax.get_xticklabels():
+            label.set_ha('right')
+        ax.set_ylabel("Energy (MeV)", fontsize=8)
+        ax.tick_params(axis='y', labelsize=6)
+        ax.set_title(self.title, fontsize=10)
+        return fig
+
+
+def get_viewer(df=None, gantry=None, angle=None, title=''):
+    '''
+        Return the HeatmapViewer of df, reusing the session's viewer if the data is unchanged
+    '''
+    digest = hashlib.sha256(pd.util.hash_pandas_object(df[['ADate', 'Energy', 'Diff (%)']], index=False).values.tobytes())
+    key = (gantry, angle, pd.to_datetime(df['ADate']).max(), digest.hexdigest())
+    if key not in _viewers:
+        _viewers[key] = HeatmapViewer(df, title)
+    return _viewers[key]
+
+
+def show(viewer=None, png_dir=None):
+    '''
+        Show the heatmap in a modal window with date window zoom buttons.
+        The full heatmap is saved to png_dir/output_heatmap.png if png_dir is a folder.
+    '''
+    if png_dir and os.path.isdir(png_dir):
+        viewer.save(os.path.join(png_dir, 'output_heatmap.png'), *viewer.window())
+    layout = [
+        [sg.B(label, key=('-ZOOM-', months)) for label, months in WINDOWS],
+        [sg.Column(
+            layout=[[sg.Image(data=viewer.png(*viewer.window()), key='-HEATMAP-', size=(SIZE_X, SIZE_Y))]],
+            background_color='#DAE0E6',
+            pad=(0, 0)
+            )
+        ],
+    ]
+    window = sg.Window("OUTPUT CONSISTENCY RESULTS", layout, modal=True, finalize=True)
+    while True:
+        event, values = window.read()
+        if event == "Exit" or event == sg.WIN_CLOSED:
+            break
+        if isinstance(event, tuple) and event[0] == '-ZOOM-':
+            window['-HEATMAP-'].update(data=viewer.png(*viewer.window(event[1])))
+    window.close()
@@ -0,0 +1,181 @@
+"""
+Local history store of the QA database result tables
+
+Keeps a SQLite mirror of the output consistency session and results tables so
+the output history (review_dose heatmap) does not scan the Access database.
+Each sync only fetches rows with an ADate on or after the last synced ADate
+(less an overlap window, to pick up sessions submitted late with an earlier
+date); the overlap is deleted locally and replaced.
+
+Daily aggregates are kept per day, gantry, gantry angle and energy:
+    output_daily    RGy mean, min, max and number of readings
+
+Mirrored column names are those returned by the database driver. Dates are
+stored as 'YYYY-MM-DD HH:MM:SS' strings (see ref_cache).
+"""
+
+import os
+import time
+import sqlite3
+import datetime
+import threading
+import contextlib
+import pandas as pd
+from ref_cache import sqlite_value
+
+DEFAULT_NAME = os.path.join(os.path.expanduser('~'), '.postism', 'history.sqlite')
+# mirrored tables of each result type, session table first
+MIRRORS = {
+    'output': ['OutputConsSession', 'OutputConsResults'],
+    }
+DATE_COLUMN = 'ADate'
+DEFAULT_OVERLAP_DAYS = 7
+# daily aggregate tables rebuilt from the mirrors
+AGGREGATES = {
+    'output': ('output_daily', '''
+        SELECT substr(A.ADate, 1, 10) AS Day, A.MachineName, A.GA, B.Energy,
+            AVG(B.R*A.kelec*A.TPC*A.ks*A.NDW*A.kpol*A.kQ*1.1/1000000000) AS RGy,
+            MIN(B.R*A.kelec*A.TPC*A.ks*A.NDW*A.kpol*A.kQ*1.1/1000000000) AS RGy_min,
+            MAX(B.R*A.kelec*A.TPC*A.ks*A.NDW*A.kpol*A.kQ*1.1/1000000000) AS RGy_max,
+            COUNT(*) AS n
+        FROM OutputConsSession A INNER JOIN OutputConsResults B ON A.ADate = B.ADate
+        WHERE A.ADate >= ?
+        GROUP BY Day, A.MachineName, A.GA, B.Energy
+        '''),
+    }
+
+
+class HistoryStore():
+    '''
+        SQLite mirror of the result tables.
+
+        input:
+            read            - (callable) read(sql, params) returns (column names, records) of a QA database query
+            errors          - (tuple) exception classes raised by read when the database cannot be read
+            store_name      - (str) SQLite file
+            overlap_days    - (float) days before the last synced ADate fetched again on every sync
+    '''
+    def __init__(self, read=None, errors=(Exception,), store_name=DEFAULT_NAME, overlap_days=DEFAULT_OVERLAP_DAYS):
+        self.read = read
+        self.errors = errors
+        self.store_name = store_name
+        self.overlap_days = overlap_days
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(store_name), exist_ok=True)
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS _sync (name TEXT PRIMARY KEY, last_adate TEXT, synced REAL)')
+
+    def sync(self, kinds=None):
+        '''
+            Fetch new rows of the mirrored tables of kinds (see MIRRORS; default all)
+            and update their daily aggregates.
+            Returns False if the database could not be read, the store is then left as it was.
+        '''
+        if kinds is None:
+            kinds = list(MIRRORS)
+        ok = True
+        with self._lock:
+            for kind in kinds:
+                try:
+                    # earliest ADate replaced in any of the kind's tables
+                    cutoff = min(self._sync_table(table) for table in MIRRORS[kind])
+                except self.errors as e:
+                    print("History store: could not sync "+kind+" ("+str(e)+")")
+                    ok = False
+                    continue
+                if kind in AGGREGATES:
+                    self._aggregate(kind, cutoff)
+        return ok
+
+    def daily(self, kind='output', gantry=None, angle=None, start=None, end=None):
+        '''
+            Daily aggregates of kind (see AGGREGATES), optionally for one gantry,
+            angle and a date range (start, end inclusive days)
+
+            Return dataframe with a Day column of datetimes, see module docstring for the values
+        '''
+        conditions = []
+        params = []
+        for column, value in [('MachineName', gantry), ('GA', angle)]:
+            if value is not None:
+                conditions.append(column+' = ?')
+                params.append(value)
+        if start is not None:
+            conditions.append('Day >= ?')
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            conditions.append('Day <= ?')
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+        sql = 'SELECT * FROM "%s"' % AGGREGATES[kind][0]
+        if conditions:
+            sql += ' WHERE '+' AND '.join(conditions)
+        with self._connect() as con:
+            try:
+                cursor = con.execute(sql+' ORDER BY Day', params)
+            except sqlite3.OperationalError:
+                # never synced
+                return pd.DataFrame(columns=['Day', 'MachineName', 'GA', 'Energy'])
+            df = pd.DataFrame(cursor.fetchall(), columns=[d[0] for d in cursor.description])
+        df['Day'] = pd.to_datetime(df['Day'])
+        return df
+
+    def _sync_table(self, table):
+        # fetch rows from the overlap cutoff onwards and replace them locally, returns the cutoff ('' = full copy)
+        local = self._columns(table)
+        last = self._last(table) if local else None
+        if last:
+            cutoff = pd.Timestamp(last).to_pydatetime() - datetime.timedelta(days=self.overlap_days)
+            columns, records = self.read('SELECT * FROM %s WHERE %s >= ?' % (table, DATE_COLUMN), [cutoff])
+            cutoff = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            cutoff = ''
+            columns, records = self.read('SELECT * FROM %s' % table, None)
+        if last and local!=[c.lower() for c in columns]:
+            # table changed in the database, copy it again in full
+            with self._connect() as con:
+                con.execute('DROP TABLE "%s"' % table)
+            return self._sync_table(table)
+        rows = [[sqlite_value(v) for v in row] for row in records]
+        with self._connect() as con:
+            if not last:
+                con.execute('DROP TABLE IF EXISTS "%s"' % table)
+                con.execute('CREATE TABLE "%s" (%s)' % (table, ', '.join('"'+c+'"' for c in columns)))
+                con.execute('CREATE INDEX "%s_date" ON "%s" (%s)' % (table, table, DATE_COLUMN))
+            else:
+                con.execute('DELETE FROM "%s" WHERE %s >= ?' % (table, DATE_COLUMN), (cutoff,))
+            con.executemany('INSERT INTO "%s" VALUES (%s)' % (table, ', '.join(['?']*len(columns))), rows)
+            last = con.execute('SELECT MAX(%s) FROM "%s"' % (DATE_COLUMN, table)).fetchone()[0]
+            con.execute('INSERT OR REPLACE INTO _sync VALUES (?, ?, ?)', (table, last, time.time()))
+        return cutoff
+
+    def _columns(self, table):
+        # lower case column names of a mirrored table, empty if it does not exist
+        with self._connect() as con:
+            return [r[1].lower() for r in con.execute('PRAGMA table_info("%s")' % table)]
+
+    def _aggregate(self, kind, cutoff):
+        # rebuild the daily aggregates from the first day touched by the sync
+        name, sql = AGGREGATES[kind]
+        day = cutoff[:10]
+        with self._connect() as con:
+            cursor = con.execute(sql, (day,))
+            columns = [d[0] for d in cursor.description]
+            records = cursor.fetchall()
+            con.execute('CREATE TABLE IF NOT EXISTS "%s" (%s)' % (name, ', '.join('"'+c+'"' for c in columns)))
+            con.execute('DELETE FROM "%s" WHERE Day >= ?' % name, (day,))
+            con.executemany('INSERT INTO "%s" VALUES (%s)' % (name, ', '.join(['?']*len(columns))), records)
+
+    def _last(self, table):
+        with self._connect() as con:
+            record = con.execute('SELECT last_adate FROM _sync WHERE name = ?', (table,)).fetchone()
+        return record[0] if record else None
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # committed and closed on exit
+        con = sqlite3.connect(self.store_name, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
@@ -0,0 +1,197 @@
+"""
+Logos acquisition indexer
+
+Walks a Logos data directory once with os.scandir and records every acquisition
+folder's files (size, mtime, role), its type (chevron/spot, see
+chevron.acquisition_type), the activescript camera ratios and the output.txt
+header. The result is written as a JSON manifest into the results folder and is
+reused while the data directory is unchanged, so later stages do not need to
+list or open the (network) Logos folders again. Files rewritten in place do not
+always change their folder's mtime (NTFS, SMB shares), so every recorded file
+is stat'ed and the folders whose files changed are indexed again.
+"""
+
+import os
+import json
+import datetime
+from chevron import acquisition_type, read_activescript
+from logos_output import read_header
+
+MANIFEST_NAME = 'logos_manifest.json'
+MANIFEST_VERSION = 1
+# results folders created by analysis.organise_logos_dirs are not acquisitions
+RESULTS_PREFIX = 'results_'
+
+
+def file_role(name=None):
+    '''
+        Role of a file in a Logos acquisition folder: bmp, output, activescript or other
+    '''
+    lname = name.lower()
+    if lname.endswith('.bmp'):
+        return 'bmp'
+    elif lname=='output.txt':
+        return 'output'
+    elif lname=='activescript.txt':
+        return 'activescript'
+    return 'other'
+
+
+def build_index(data_dir=None):
+    '''
+        Scan data_dir and its acquisition subfolders
+
+        Return manifest dict:
+            manifest['data_dir']            scanned directory
+            manifest['mtime_ns']            modification time of data_dir
+            manifest['folders'][name]       folder entry:
+                ['mtime_ns']                    folder modification time
+                ['type']                        'chevron', 'spot' or None
+                ['files'][name]                 {'size', 'mtime_ns', 'role'} for every file
+                ['bmp']                         sorted .bmp file names
+                ['output']                      output.txt file name or None
+                ['activescript']                activescript.txt file name or None
+                ['ratios']                      activescript {'HRatio', 'VRatio'} or None
+                ['output_header']               output.txt {'X', 'Y', 'fps', 'dB'} or None
+    '''
+    data_dir = os.path.abspath(data_dir)
+    folders = {}
+    with os.scandir(data_dir) as it:
+        for d in it:
+            if d.is_dir() and not d.name.startswith(RESULTS_PREFIX):
+                folders[d.name] = _index_folder(d)
+    return {
+        'version': MANIFEST_VERSION,
+        'created': datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
+        'data_dir': data_dir,
+        'mtime_ns': os.stat(data_dir).st_mtime_ns,
+        'folders': folders,
+        }
+
+
+def _index_folder(d):
+    entry = {'mtime_ns': d.stat().st_mtime_ns, 'type': None, 'files': {}, 'bmp': [],
+             'output': None, 'activescript': None, 'ratios': None, 'output_header': None}
+    with os.scandir(d.path) as it:
+        for f in it:
+            if not f.is_file():
+                continue
+            st = f.stat()
+            role = file_role(f.name)
+            entry['files'][f.name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'role': role}
+            if role=='bmp':
+                entry['bmp'].append(f.name)
+            elif role!='other':
+                entry[role] = f.name
+    entry['bmp'].sort()
+    entry['type'] = acquisition_type(entry['bmp'])
+    if entry['type'] is not None:
+        if entry['activescript']:
+            HRatio, VRatio = read_activescript(os.path.join(d.path, entry['activescript']))
+            entry['ratios'] = {'HRatio': HRatio, 'VRatio': VRatio}
+        if entry['output']:
+            try:
+                entry['output_header'] = read_header(os.path.join(d.path, entry['output']))
+            except (ValueError, IndexError, StopIteration):
+                entry['output_header'] = None
+    return entry
+
+
+def stale_folders(manifest=None, data_dir=None):
+    '''
+        Folders of manifest whose files changed since they were indexed
+
+        Return:
+            sorted list of folder names whose folder mtime or any file's size or mtime changed,
+            None if the manifest does not describe data_dir (folders added, removed or renamed)
+    '''
+    if not manifest or manifest.get('version')!=MANIFEST_VERSION:
+        return None
+    data_dir = os.path.abspath(data_dir)
+    if manifest['data_dir']!=data_dir or os.stat(data_dir).st_mtime_ns!=manifest['mtime_ns']:
+        return None
+    # one scandir of data_dir gives every folder's mtime
+    seen = set()
+    stale = []
+    with os.scandir(data_dir) as it:
+        for d in it:
+            if d.is_dir() and not d.name.startswith(RESULTS_PREFIX):
+                entry = manifest['folders'].get(d.name)
+                if entry is None:
+                    return None
+                seen.add(d.name)
+                if entry['mtime_ns']!=d.stat().st_mtime_ns or not _files_current(d.path, entry):
+                    stale.append(d.name)
+    if seen!=set(manifest['folders']):
+        return None
+    return sorted(stale)
+
+
+def _files_current(path, entry):
+    # files rewritten in place keep their folder mtime, stat each one
+    for name, f in entry['files'].items():
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            return False
+        if st.st_size!=f['size'] or st.st_mtime_ns!=f['mtime_ns']:
+            return False
+    return True
+
+
+def is_current(manifest=None, data_dir=None):
+    '''
+        True if manifest still describes data_dir (no folders or files added, removed, renamed or changed)
+    '''
+    return stale_folders(manifest, data_dir)==[]
+
+
+def load_or_build(data_dir=None, report_dir=None):
+    '''
+        Return manifest for data_dir, reusing report_dir/logos_manifest.json if it is still current.
+        Folders whose files changed are indexed again, any other change rebuilds the manifest.
+    '''
+    manifest_name = os.path.join(report_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_name, 'r') as j:
+            manifest = json.load(j)
+        stale = stale_folders(manifest, data_dir)
+        if stale==[]:
+            return manifest
+    except (OSError, ValueError, KeyError):
+        stale = None
+    if stale is None:
+        manifest = build_index(data_dir)
+    else:
+        with os.scandir(manifest['data_dir']) as it:
+            for d in it:
+                if d.name in stale:
+                    manifest['folders'][d.name] = _index_folder(d)
+    with open(manifest_name, 'w') as j:
+        json.dump(manifest, j, indent=1)
+    return manifest
+
+
+def folders_of_type(manifest=None, fldr_type=None):
+    '''
+        Sorted full paths of the manifest folders of a given type ('chevron' or 'spot')
+    '''
+    return [os.path.join(manifest['data_dir'], name) for name in sorted(manifest['folders'])
+            if manifest['folders'][name]['type']==fldr_type]
+
+
+def folder_entry(manifest=None, fldr=None):
+    '''
+        Manifest entry for folder path fldr, None if there is no manifest or entry
+    '''
+    if manifest is None or fldr is None:
+        return None
+    return manifest['folders'].get(os.path.basename(os.path.normpath(fldr)))
+
+
+def bmp_paths(manifest=None, fldr=None):
+    '''
+        Full paths of the .bmp images in folder fldr
+    '''
+    entry = folder_entry(manifest, fldr)
+    return [os.path.join(fldr, name) for name in entry['bmp']]
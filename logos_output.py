@@ -0,0 +1,181 @@
+import os
+import csv
+import numpy as np
+
+# column positions of the acquisition parameters in the first row of output.txt
+HEADER_FIELDS = {'X': 5, 'Y': 6, 'fps': 8, 'dB': 12}
+# number of wedge rows (A-F) written after each 'Image:' row
+N_WEDGES = 6
+# bump when the sidecar layout changes so stale caches are ignored
+CACHE_VERSION = 1
+
+
+class LogosOutput():
+    '''
+        Columnar representation of a Logos output.txt file written by BraggPeakCapture4000.scr.
+
+        attributes:
+            X, Y, fps, dB - (float) acquisition parameters from the header row
+            width         - (array) wedge widths, one entry per wedge row
+            centre        - (array) wedge centres, one entry per wedge row
+            wedge         - (array) wedge index 0-5 (A-F) of each row
+            image         - (array) Logos image number of each row
+            seq           - (array) order in which the row's image appears in the file
+    '''
+    def __init__(self, header, width, centre, wedge, image, seq):
+        self.X = float(header['X'])
+        self.Y = float(header['Y'])
+        self.fps = float(header['fps'])
+        self.dB = float(header['dB'])
+        self.width = width
+        self.centre = centre
+        self.wedge = wedge
+        self.image = image
+        self.seq = seq
+
+    @property
+    def header(self):
+        return {k: getattr(self, k) for k in HEADER_FIELDS}
+
+    @property
+    def n_images(self):
+        return int(self.seq[-1])+1 if len(self.seq) else 0
+
+    def matrix(self):
+        '''
+            Wedge widths and centres arranged as images x wedges.
+            Wedges missing from a truncated image are returned as zero width.
+
+            returns:
+                width  - (array) shape (images, 6)
+                centre - (array) shape (images, 6)
+                images - (array) Logos image number of each row
+        '''
+        width = np.zeros((self.n_images, N_WEDGES))
+        centre = np.zeros((self.n_images, N_WEDGES))
+        width[self.seq, self.wedge] = self.width
+        centre[self.seq, self.wedge] = self.centre
+        images = np.zeros(self.n_images, dtype=self.image.dtype)
+        images[self.seq] = self.image
+        return width, centre, images
+
+
+def parse_output(output_name=None):
+    '''
+        Parse output.txt in a single pass into preallocated arrays
+
+        input:
+            output_name - (str) filepath to Logos output.txt file
+
+        returns:
+            LogosOutput object
+    '''
+    with open(output_name, 'r', newline='') as f:
+        lines = f.read().splitlines()
+
+    # every wedge row is a line of the file, so the line count bounds the array size
+    n = len(lines)
+    width = np.empty(n)
+    centre = np.empty(n)
+    wedge = np.empty(n, dtype=np.int8)
+    image = np.empty(n, dtype=np.int32)
+    seq = np.empty(n, dtype=np.int32)
+
+    header = None
+    k = 0           # rows written
+    s = -1          # image sequence number
+    w = N_WEDGES    # next wedge to read, N_WEDGES when outside an image block
+    img = 0
+    for i, row in enumerate(csv.reader(lines, delimiter=',')):
+        if i == 0:
+            header = {key: float(row[col]) for key, col in HEADER_FIELDS.items()}
+        if 'Image:' in row:
+            img = int(row[1])
+            w = 0
+            s += 1
+        elif w < N_WEDGES:
+            width[k] = float(row[4])
+            centre[k] = float(row[3])
+            wedge[k] = w
+            image[k] = img
+            seq[k] = s
+            k += 1
+            w += 1
+
+    if header is None:
+        raise ValueError("Empty Logos output file: "+str(output_name))
+    return LogosOutput(header, width[:k], centre[:k], wedge[:k], image[:k], seq[:k])
+
+
+def read_output(output_name=None, use_cache=True, output_stat=None):
+    '''
+        Read output.txt, using a .npz sidecar when the text file is unchanged.
+        The sidecar is keyed on the size and modification time of output.txt and
+        is (re)written after parsing. Read-only data folders are tolerated.
+
+        input:
+            output_name - (str) filepath to Logos output.txt file
+            use_cache   - (bool) False forces the text file to be parsed
+            output_stat - (tuple) known (size, mtime_ns) of output.txt, e.g. from a Logos manifest
+
+        returns:
+            LogosOutput object
+    '''
+    if output_stat is None:
+        st = os.stat(output_name)
+        output_stat = (st.st_size, st.st_mtime_ns)
+    cache_name = _cache_name(output_name)
+    if use_cache:
+        out = _load_cache(cache_name, output_stat)
+        if out is not None:
+            return out
+    out = parse_output(output_name)
+    if use_cache:
+        _save_cache(cache_name, output_stat, out)
+    return out
+
+
+def read_header(output_name=None):
+    '''
+        Read only the acquisition parameters (X, Y, fps, dB) from the first row of output.txt
+    '''
+    with open(output_name, 'r', newline='') as f:
+        row = next(csv.reader([f.readline()], delimiter=','))
+    return {key: float(row[col]) for key, col in HEADER_FIELDS.items()}
+
+
+def _cache_name(output_name):
+    return os.path.splitext(output_name)[0] + '_cache.npz'
+
+
+def _load_cache(cache_name, output_stat):
+    try:
+        with np.load(cache_name) as npz:
+            key = npz['key']
+            if key.tolist() != [CACHE_VERSION, *output_stat]:
+                return None
+            header = dict(zip(HEADER_FIELDS, npz['header'].tolist()))
+            return LogosOutput(header, npz['width'], npz['centre'], npz['wedge'], npz['image'], npz['seq'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _save_cache(cache_name, output_stat, out):
+    tmp_name = cache_name + '.tmp'
+    try:
+        with open(tmp_name, 'wb') as f:
+            np.savez_compressed(f,
+                                key=np.array([CACHE_VERSION, *output_stat], dtype=np.int64),
+                                header=np.array([out.X, out.Y, out.fps, out.dB]),
+                                width=out.width,
+                                centre=out.centre,
+                                wedge=out.wedge,
+                                image=out.image,
+                                seq=out.seq)
+        os.replace(tmp_name, cache_name)
+    except OSError:
+        print("Could not write Logos output cache: "+cache_name)
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
@@ -1,598 +1,464 @@
 import datetime
 import os
-import pandas as pd
-import numpy as np
 import PySimpleGUI as sg
 import database_df as db
 import re
-import glob
 import subprocess
+import multiprocessing
 from checks import *
 from chevron import *
-import analysis as ana
+from calibration import get_calibration
+import stage_cache as sc
+import startup_data as sd
+import submit_queue as sq
+import output_model as om
+import session_pipeline as pipe
 from gui import *
 import splash_screen as sph
 import spotanalysis.constants as cs
 
-### import data from database
-Op, Roos, Semiflex, El = db.populate_fields()
-currdatetime = datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S")
-kpol, ndw, kelec, ks = db.update_cal(currdatetime,Roos,Semiflex,El)
-kq=1.001
-rbe=1.1
-# Gantry specific reference data from database
-ref_data = db.update_ref('DoseGy')
-# Spot grid specific database labels
-db_cols = cs.db_cols
-# Spot grid energies from json file
-cfg_dict = load_calibration()
-spotE = cfg_dict['SpotE']
-# Calibration data (kpol, ndw, kelec will update from database when Adate is generated)
-selected_ks=None
-selected_kpol=None
-selected_kelec=None
-selected_ndw=None
-
-### Initialise session and results dicts
-session = {}
-# output consistency results
-results = {}
-results['Rindex']=[]
-results['ADate']=[]
-results['Energy']=[]
-results['R']=[]
-results['Ravg']=[]
-results['Rrange prcnt']=[]
-results['RGy']=[]
-results['RavgGy']=[]
-results['Rref']=[]
-results['Rdelta']=[]
-# chevron results
-chev_results = {}
-# spot grid results
-spot_results = {}
-
-
-### Helper function
-# calculate output consistency values
-def calc_metrics(i):
-    '''
-        Calculate mean dose from readings for energy layer i and update GUI display
-        Input:
-            i           int index of energy layer in GUI
-        Return:
-            r_mean      mean reading
-            r_range     range betwen reading max-min
-            d_mean      mean dose
-            d_diff      percentage difference between mean reference dose values
-            d           list of calculated dose values
-    '''
-    r = [float(x) for x in [values['r'+i+'1'],values['r'+i+'2']] if re.fullmatch(r'^(?:[0-9]+(?:\.[0-9]*)?)$', x)]
-    r_mean=None
-    r_range=None
-    d = []
-    d_mean=None
-    d_diff=None
-    diff_color='lightgray'
-    if len(r)>0:
-        # mean R
-        r_mean = np.mean(r)
-        window['rm'+i]('%.4f' % r_mean)
-        # R range
-        eps = np.finfo(float).eps # remove risk of dividing by zero
-        r_range = (max(r)-min(r)) / (r_mean+eps) * 100
-        window['rang'+i]('%.2f' % r_range)
-        if len(window['rr'+i].get())>0:
-            energy = int(window['E'+i].get())
-            idx = ref_data['Energy'].index(energy)
-            dref = ref_data[values['-G-']][idx]
-            # Dose measured
+if __name__ == '__main__':
+    # required for process pools in the PyInstaller executable
+    multiprocessing.freeze_support()
+
+    ### database data from the local copy, refreshed in the background once the window is open
+    currdatetime = datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S")
+    cached = sd.load_cached(currdatetime)
+    Op, Roos, Semiflex, El = [cached['fields'][k] for k in ['Op','Roos','Semiflex','El']]
+    kpol, ndw, kelec, ks = cached['cal']
+    kq=1.001
+    rbe=1.1
+    # Gantry specific reference data from database
+    ref_data = cached['ref']
+    # Spot grid specific database labels
+    db_cols = cs.db_cols
+    # Spot grid energies from json file
+    spotE = get_calibration().SpotE
+    # Cache of Check Session stage results
+    stage_cache = sc.StageCache()
+    # Calibration data (kpol, ndw, kelec will update from database when Adate is generated)
+    selected_ks=None
+    selected_kpol=None
+    selected_kelec=None
+    selected_ndw=None
+
+    ### Initialise session and results dicts
+    session = {}
+    # output consistency results
+    results = {}
+    results['Rindex']=[]
+    results['ADate']=[]
+    results['Energy']=[]
+    results['R']=[]
+    results['Ravg']=[]
+    results['Rrange prcnt']=[]
+    results['RGy']=[]
+    results['RavgGy']=[]
+    results['Rref']=[]
+    results['Rdelta']=[]
+    # chevron results
+    chev_results = {}
+    # spot grid results
+    spot_results = {}
+
+
+    ### Helper function
+    # update output consistency values of the energy layers whose inputs changed
+    def refresh_metrics():
+        '''
+            Set the reference doses and dose coefficient of the output model (see output_model)
+            from the selected gantry and calibration factors, and update the GUI cells that changed
+        '''
+        metrics.set_reference(ref_data, values['-G-'])
+        metrics.set_coefficient(tpc, selected_ndw, kq, selected_ks, selected_kelec, selected_kpol, rbe)
+        metrics.push(window)
+
+
+    # show calibration factors of the selected equipment
+    def show_cal_factors():
+        '''
+            Update the selected ks, kelec, kpol and ndw and their GUI fields from the calibration dicts
+        '''
+        global selected_ks, selected_kpol, selected_kelec, selected_ndw
+        if values['-G-'] in ks:
+            selected_ks = ks[values['-G-']]
+            window['ks'](str(selected_ks))
+        else:
+            window['ks']('')
+        if values['-El-'] in kelec:
+            selected_kelec = kelec[values['-El-']]
+            window['kelec'](str(selected_kelec))
+        else:
+            window['kelec']('')
+        if values['-Ch-'] in ndw and values['-Ch-'] in kpol:
+            selected_ndw = ndw[values['-Ch-']]
+            selected_kpol = kpol[values['-Ch-']]
+            window['kpol'](str(selected_kpol))
+            window['ndw'](str(selected_ndw))
+        else:
+            window['kpol']('')
+            window['ndw']('')
+
+
+    # show the number of sessions waiting to be written to the database
+    def show_queue_status(counts):
+        if counts[sq.FAILED]:
+            window['-QueueStatus-']('DB queue: %d waiting, %d failed' % (counts[sq.QUEUED], counts[sq.FAILED]), text_color='red')
+        elif counts[sq.QUEUED]:
+            window['-QueueStatus-']('DB queue: %d waiting' % counts[sq.QUEUED], text_color='orange')
+        else:
+            window['-QueueStatus-']('DB queue: empty', text_color='green')
+
+
+    ### Close splash screen if one exists
+    try:
+        sph.close_splash()
+    except:
+        print("Splash screen error")
+
+    ### Generate GUI
+    # dropdown list data
+    G = ['Gantry 1', 'Gantry 2', 'Gantry 3', 'Gantry 4']
+    Chtype = ['Roos', 'Semiflex']
+    V = [-400,-200,0,200,400]
+    Rng = ['Low','Medium','High']
+    Ch = Roos
+    en_layers = ['5']
+    layers = [[240,200,150,100,70]]
+    humidity=''
+    # create GUI window
+    window = build_window(Op, kq, rbe, El, G, Chtype, V, Rng, Ch, layers)
+    # output consistency values of the energy layers, recomputed as readings and factors change
+    metrics = om.OutputModel(layers[0])
+    reading_keys = ['r'+str(i)+str(j) for i,_ in enumerate(layers[0]) for j in range(1,3)]
+    # progress bar
+    progress_bar = window['progress']
+    # GUI flags
+    tpc=None
+    session_analysed = False
+    export_flag=False
+    db_flag=False
+    # keyboard buttons move cursor in the GUI (up, down, enter)
+    window.bind('<Return>', '-NEXTE-') 
+    window.bind('<Down>', '-NEXT-')
+    window.bind('<Up>', '-PREV-')
+    # fetch fresh database data without blocking the GUI
+    sd.start_loading(window, currdatetime)
+    # write submitted sessions to the database in the background, status changes are posted as '-DBQueue-'
+    submit_queue = sq.SubmitQueue(db.submit_session, exists=db.session_exists)
+    submit_queue.start(on_change=lambda counts: window.write_event_value('-DBQueue-', counts))
+    show_queue_status(submit_queue.counts())
+
+    ### Event Loop listens out for GUI events e.g. button presses
+    while True:
+        event, values = window.read()
+
+        ### handle exit events
+        if event == sg.WIN_CLOSED or event == 'Exit': ### user closes window or clicks cancel
+            break
+
+        ### clear fields on button press
+        if event == '-NxtSess-':
+            # deactivate buttons
+            window['-Submit-'](disabled=True)
+            window['-CSV_WRITE-'](disabled=True)
+            # clear readings
+            window['ADate'].Update('')
+            window['GA'].Update('')
+            window['-ML-'].Update('Post-ISM')
+            for key in reading_keys:
+                window[key].update('')
+            metrics.clear_readings()
+            metrics.push(window)
+
+        ### handle keyboard events
+        if event == '-NEXT-':
             try:
-                dose_coeff = tpc*float(selected_ndw)*float(kq)*float(selected_ks)*float(selected_kelec)*float(selected_kpol)*float(rbe)*1e-9
-                # calc dose for each reading
-                for reading in r:
-                    d.append(reading*dose_coeff)
-                # mean dose
-                d_mean = np.mean(d)
-                window['ad'+i]('%.4f' % d_mean)
-                # Dose diff
-                d_diff = (d_mean - dref)/dref*100
-                # Conditional formatting
-                if abs(d_diff)>=2.0:
-                    diff_color='red'
-                elif abs(d_diff)>=0.8:
-                    diff_color='orange'
-                else:
-                    diff_color='green'
-                window['diff'+i]('%.3f' % d_diff, background_color=diff_color, text_color='white')
+                next_element = window.find_element_with_focus().get_next_focus()
+                next_element.set_focus()
             except:
-                window['ad'+i]('')
-                window['diff'+i]('', background_color=diff_color, text_color='black')
-        
-        return r_mean, r_range, d_mean, d_diff, d, r
-    else:
-        window['rm'+i].Update('')
-        window['rang'+i]('')
-        window['diff'+i]('',background_color=diff_color, text_color='black')
-        window['ad'+i]('')
-
-
-### Close splash screen if one exists
-try:
-    sph.close_splash()
-except:
-    print("Splash screen error")
-
-### Generate GUI
-# dropdown list data
-G = ['Gantry 1', 'Gantry 2', 'Gantry 3', 'Gantry 4']
-Chtype = ['Roos', 'Semiflex']
-V = [-400,-200,0,200,400]
-Rng = ['Low','Medium','High']
-Ch = Roos
-en_layers = ['5']
-layers = [[240,200,150,100,70]]
-humidity=''
-# create GUI window
-window = build_window(Op, kq, rbe, El, G, Chtype, V, Rng, Ch, layers)
-# progress bar
-progress_bar = window['progress']
-# GUI flags
-tpc=None
-session_analysed = False
-export_flag=False
-db_flag=False
-# keyboard buttons move cursor in the GUI (up, down, enter)
-window.bind('<Return>', '-NEXTE-') 
-window.bind('<Down>', '-NEXT-')
-window.bind('<Up>', '-PREV-')
-
-### Event Loop listens out for GUI events e.g. button presses
-while True:
-    event, values = window.read()
-
-    ### handle exit events
-    if event == sg.WIN_CLOSED or event == 'Exit': ### user closes window or clicks cancel
-        break
-
-    ### clear fields on button press
-    if event == '-NxtSess-':
-        # deactivate buttons
-        window['-Submit-'](disabled=True)
-        window['-CSV_WRITE-'](disabled=True)
-        # clear readings
-        window['ADate'].Update('')
-        window['GA'].Update('')
-        window['-ML-'].Update('Post-ISM')
-        for i,E in enumerate(layers[0]):
-            for r in range(1,3):
-                window['r'+str(i)+str(r)].update('') 
-            window['rm'+str(i)].update('') 
-            window['rang'+str(i)].update('') 
-            window['ad'+str(i)].update('') 
-            window['diff'+str(i)].update('', background_color='light gray')  
-
-    ### handle keyboard events
-    if event == '-NEXT-':
-        try:
-            next_element = window.find_element_with_focus().get_next_focus()
-            next_element.set_focus()
-        except:
-            "pass"
-    if event == '-NEXTE-':
-        try:
-            next_element = window.find_element_with_focus().get_next_focus()
-            next_element.set_focus()
-        except:
-            "pass"
-    if event == '-PREV-':
-        try:
-            prev_element = window.find_element_with_focus().get_previous_focus()
-            prev_element.set_focus()
-        except:
-            "pass"
-
-    ### reset analysed flag if there is just about any event
-    if event in window.key_dict.keys() and event not in ['-Submit-','-AnalyseS-','-Export-','-ML-','-NEXT-','-NEXTE-','-PREV-',sg.WIN_CLOSED]:
-        session_analysed=False
-        progress_bar.update_bar(0)
-        window['-CSV_WRITE-'](disabled=True) # disable csv export button
-        window['-Submit-'](disabled=True) # disable access export button
-        
-    ### Button event actions
-    if event == '-AnalyseS-': ### Analyse results 
-        progress_bar.update_bar(0)
-        window['-AnalyseS-'](disabled=True)
-        # initialise session integrity flag
-        session_analysed=True       
-        progress_bar.update_bar(1)
-        # output consistency session dict
-        session = {}
-        # output consistency results dict
-        results = {}
-        results['Rindex']=[]
-        results['ADate']=[]
-        results['Energy']=[]
-        results['R']=[]
-        results['Ravg']=[]
-        results['Rrange prcnt']=[]
-        results['RGy']=[]
-        results['RavgGy']=[]
-        results['Rref']=[]
-        results['Rdelta']=[]
-
-        # check data integrity
-        print('Analysing...')
-        anal_flag = pre_analysis_check(values, layers)
-        progress_bar.update_bar(2)
-        if anal_flag[-1][0]:
-            session_analysed = False
-            print('ERROR: Session not analysed - check all information is entered correctly (Err Code: '+str(anal_flag[-1])+')')
-            progress_bar.update_bar(0)
-
-        if session_analysed:
+                "pass"
+        if event == '-NEXTE-':
             try:
-                ### POPULATE SESSION DICT
-                session['Adate']=[values['ADate']]
-                session['Op1']=[values['-Op1-']]
-                session['Op2']=[values['-Op2-']]
-                session['Temp']=[values['Temp']]
-                session['P']=[values['Press']]
-                session['Electrometer']=[values['-El-']]
-                session['V']=[values['-V-']]
-                session['Gantry']=[values['-G-']]
-                session['GA']=[values['GA']]
-                session['Chamber']=[values['-Ch-']]
-                session['kQ']=[window['kq'].get()]
-                session['ks']=[window['ks'].get()]
-                session['kelec']=[window['kelec'].get()]
-                session['kpol']=[window['kpol'].get()]
-                session['NDW']=[window['ndw'].get()]
-                session['TPC']=[str(tpc)]
-                humidity=values['H']
-                if humidity != '':
-                    session['Humidity']=[humidity]
-                if len(values['-ML-'])<255:
-                    session['Comments']=[values['-ML-']]
-                else:
-                    session['Comments']=[values['-ML-'][:255]]
-                progress_bar.update_bar(3)
+                next_element = window.find_element_with_focus().get_next_focus()
+                next_element.set_focus()
             except:
-                session_analysed = False
-                print('ERROR: Session not analysed - check session data is complete')
-                progress_bar.update_bar(0)
-
-        if session_analysed:
+                "pass"
+        if event == '-PREV-':
             try:
-                ### POPULATE OUTPUT CONSISTENCY RESULTS DICT
-                refs = [ref_data[values['-G-']],ref_data['Energy']]
-                tstamp = values['ADate']
-                cnt=0
-                for i,_ in enumerate(layers[0]):
-                    if window['diff'+str(i)].get() != '':
-                        en = int(window['E'+str(i)].get())
-                        idx = refs[1].index(en)
-                        r_mean, r_range, d_mean, d_diff, d, r = calc_metrics(str(i))
-                        for j, (rn, dn) in enumerate(zip(r,d)):
-                            cnt += 1
-                            #results['Rindex'].append("%02d_%01d"%(i,j))
-                            results['Rindex'].append(str(cnt))
-                            results['ADate'].append(values['ADate'])
-                            results['Energy'].append(window['E'+str(i)].get())
-                            results['R'].append(str(rn))
-                            results['Ravg'].append(str(r_mean))
-                            results['Rrange prcnt'].append(str(r_range))
-                            results['RGy'].append(str(dn))
-                            results['RavgGy'].append(str(d_mean))
-                            results['Rref'].append(str(refs[0][idx]))
-                            results['Rdelta'].append(str(d_diff))
-                progress_bar.update_bar(4)
+                prev_element = window.find_element_with_focus().get_previous_focus()
+                prev_element.set_focus()
             except:
-                session_analysed = False
-                print('ERROR: Results not analysed - check all information is entered correctly')
-                progress_bar.update_bar(0)
-                sg.popup("Session not analysed","Check you have entered all information correctly")
+                "pass"
 
-        if len(results['R'])==0 and session_analysed:
-            # Catch if no output measurements have been recorded
-            session_analysed = False
-            print('ERROR: Session not analysed - check output measurements')
+        ### reset analysed flag if there is just about any event
+        if event in window.key_dict.keys() and event not in ['-Submit-','-Queue-','-AnalyseS-','-Export-','-ML-','-NEXT-','-NEXTE-','-PREV-',sg.WIN_CLOSED]:
+            session_analysed=False
             progress_bar.update_bar(0)
-            sg.popup("No Results","Enter some results before clicking Check Session")
-
-
-        ### LOGOS ANALYSIS
-        if not os.path.isdir(values['-Logos-']):
-            session_analysed = False
-            print('ERROR: Selected Logos directory does not exist')
+            window['-CSV_WRITE-'](disabled=True) # disable csv export button
+            window['-Submit-'](disabled=True) # disable access export button
+        
+        ### Button event actions
+        if event == '-AnalyseS-': ### Analyse results 
             progress_bar.update_bar(0)
-            sg.popup("Invalid directory","Select a folder containing valid Logos data")
-
-        if session_analysed:
-            logos_dir=values['-Logos-']
-            try:
-                ### CHEVRON and SPOT GRID FOLDER SORTING
-                chevron_dir, spot_dirs, report_dir = \
-                    ana.organise_logos_dirs(values)
-                progress_bar.update_bar(5)
-            except:
+            window['-AnalyseS-'](disabled=True)
+            # initialise session integrity flag
+            session_analysed=True       
+            # recompute every stage if requested
+            stage_cache.refresh = values['-NoCache-']
+            progress_bar.update_bar(1)
+            # check data integrity
+            print('Analysing...')
+            anal_flag = pre_analysis_check(values, layers)
+            progress_bar.update_bar(2)
+            if anal_flag[-1][0]:
                 session_analysed = False
-                print('ERROR: Results not analysed - check Logos data')
+                print('ERROR: Session not analysed - check all information is entered correctly (Err Code: '+str(anal_flag[-1])+')')
                 progress_bar.update_bar(0)
-                sg.popup("No Results","Enter path to valid Logos data before clicking Check Session")
 
-        if session_analysed:
-            try:
-                ### CHEVRON DATA ANALYSIS
-                chev_results = ana.chevron_results(chevron_dir, values)
-                progress_bar.update_bar(6)
-            except:
-                session_analysed = False
-                print('ERROR: Chevron results')
-                progress_bar.update_bar(0)
-                sg.popup("No Chevron Results","Unable to process Chevron data, check Logos files")
-        
-        if session_analysed:
-            try:
-                ### SPOT GRID DATA ANALYSIS
-                df_spot, device, spotpatterns, all_data = ana.spot_results(spot_dirs, spotE, values, cs.db_cols)
-                progress_bar.update_bar(7)
-            except:
-                session_analysed = False
-                print('ERROR: Spot grid results')
+            if session_analysed:
+                ### RUN THE CHECK SESSION STAGES (see session_pipeline)
+                # session description: GUI values and the calibration factors shown
+                description = dict(values, kQ=window['kq'].get(), ks=window['ks'].get(), kelec=window['kelec'].get(),
+                                   kpol=window['kpol'].get(), NDW=window['ndw'].get(), TPC=tpc, RBE=rbe)
+                try:
+                    out = pipe.run_session(description, ref_data, stage_cache,
+                                           lambda step, stage: progress_bar.update_bar(step),
+                                           layers[0], spotE, cs.db_cols)
+                except pipe.StageError as e:
+                    session_analysed = False
+                    progress_bar.update_bar(0)
+                    if e.title:
+                        sg.popup(e.title, e.message)
+                else:
+                    session, results, chev_results = out['session'], out['results'], out['chev_results']
+                    sess_df, reslt_df, chev_reslt_df = out['sess_df'], out['reslt_df'], out['chev_reslt_df']
+                    spotpatterns, all_data, report_name = out['spotpatterns'], out['all_data'], out['report_name']
+                    humidity = values['H']
+
+            if session_analysed:
+                #activate buttons
+                window['-CSV_WRITE-'](disabled=False)
+                window['-Submit-'](disabled=False)
+            
+            if os.path.isdir(values['-Logos-']) and session_analysed:
+                db.review_dose(sess_df,reslt_df,values['-Logos-'])
+                progress_bar.update_bar(14)
+                db.review_range(chev_results)
+                progress_bar.update_bar(15)
+                print('Results analysed.')
+            else:
+                #deactivate buttons
+                window['-CSV_WRITE-'](disabled=True)
+                window['-Submit-'](disabled=True)
                 progress_bar.update_bar(0)
-                sg.popup("No Spot Grid Results","Unable to process Spot Grid data, check Logos files")
+            window['-AnalyseS-'](disabled=False)
 
-        if session_analysed:
-            try:
-                ### GENERATE REPORT PDFs
-                ana.spot_report(df_spot, device, report_dir, values, spotE)
-                progress_bar.update_bar(8)
-                ana.chev_report(chev_results, values, 1.0, 0.5, os.path.join(report_dir,'02_chevron_report.pdf'))
-                progress_bar.update_bar(9)
-                report_results = ana.output_results(results)
-                progress_bar.update_bar(10)
-                ana.output_report(report_results, values, 2.0, 0.8, os.path.join(report_dir,'01_output_report.pdf'))
-                progress_bar.update_bar(11)
-                pdf_list = glob.glob(os.path.join(report_dir,'*.pdf'))
-                pdf_list.sort()
-                report_name = os.path.join(report_dir,'_PostISM_Report.pdf')
-                ana.merge_reports(pdf_list, report_name)
-                progress_bar.update_bar(12)
-            except:
-                session_analysed = False
-                print('ERROR: Reports not generated')
-                progress_bar.update_bar(0)
-                sg.popup("Reports not generated","Reports could not be generated, check config files and dependencies")
-
-
-        if session_analysed:
-            #activate buttons
-            window['-CSV_WRITE-'](disabled=False)
-            window['-Submit-'](disabled=False)
-            # convert session and results to dataframes
-            sess_df = pd.DataFrame.from_dict(session)
-            reslt_df = pd.DataFrame.from_dict(
-                {k: results[k] for k in results.keys() & {'Rindex', 'ADate', 'Energy', 'R', 'RGy'}}
-                )
-            reslt_df = reslt_df[['Rindex','ADate','Energy','R','RGy']]
-            chev_reslt_df = pd.DataFrame.from_dict(
-                {k: chev_results[k] for k in chev_results.keys() & {'Energy MeV','D80 mm', 'Diff TPS mm', 'Diff NIST mm', 'Diff Baseline mm'}}
-                )
-            chev_reslt_df['ADate']=values['ADate']
-            chev_reslt_df = chev_reslt_df[['ADate','Energy MeV','D80 mm', 'Diff TPS mm', 'Diff NIST mm', 'Diff Baseline mm']]
-            progress_bar.update_bar(13)
-            
-        if os.path.isdir(values['-Logos-']) and session_analysed:
-            db.review_dose(sess_df,reslt_df,values['-Logos-'])
-            progress_bar.update_bar(14)
-            db.review_range(chev_results)
-            progress_bar.update_bar(15)
-            print('Results analysed.')
-        else:
-            #deactivate buttons
-            window['-CSV_WRITE-'](disabled=True)
-            window['-Submit-'](disabled=True)
-            progress_bar.update_bar(0)
-        window['-AnalyseS-'](disabled=False)
+            if session_analysed:
+                try:
+                    subprocess.Popen([report_name],shell=True)
+                    progress_bar.update_bar(16)
+                except:
+                    print('WARNING: Report could not be opened')
+                    progress_bar.update_bar(0)
+                    sg.popup("Report not displayed","Report could not be displayed, manually inspect the file:\n"+report_name)
 
-        if session_analysed:
+                
+        if event == '-Export-': ### Export results to csv
+            print('Exporting to csv...')
+            export_flag=False
             try:
-                subprocess.Popen([report_name],shell=True)
-                progress_bar.update_bar(16)
+                # create timestamped folder
+                csv_time = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+                csv_dir = values['-Export-']+os.sep+csv_time+'_'+values['-G-']
+                os.makedirs(csv_dir, exist_ok=True)
+                sess_df.to_csv(csv_dir+os.sep+'session.csv', index=False)
+                reslt_df.to_csv(csv_dir+os.sep+'result.csv', index=False)
+                print('Exported.')
+                export_flag=True
             except:
-                print('WARNING: Report could not be opened')
-                progress_bar.update_bar(0)
-                sg.popup("Report not displayed","Report could not be displayed, manually inspect the file:\n"+report_name)
-
-                
-    if event == '-Export-': ### Export results to csv
-        print('Exporting to csv...')
-        export_flag=False
-        try:
-            # create timestamped folder
-            csv_time = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
-            csv_dir = values['-Export-']+os.sep+csv_time+'_'+values['-G-']
-            os.makedirs(csv_dir, exist_ok=True)
-            sess_df.to_csv(csv_dir+os.sep+'session.csv', index=False)
-            reslt_df.to_csv(csv_dir+os.sep+'result.csv', index=False)
-            print('Exported.')
-            export_flag=True
-        except:
-            print('ERROR: Failed to export to csv!')
-        if export_flag:
-            #deactivate buttons
-            window['-Submit-'](disabled=False)
-        else:
-            window['-Submit-'](disabled=True)
+                print('ERROR: Failed to export to csv!')
+            if export_flag:
+                #deactivate buttons
+                window['-Submit-'](disabled=False)
+            else:
+                window['-Submit-'](disabled=True)
 
 
-    if event == '-Submit-': ### Submit data to database
-        db_flag=True
+        if event == '-Submit-': ### Submit data to database
+            db_flag=True
         
-        # update Comments
-        if len(values['-ML-'])<255:
-            session['Comments']=[values['-ML-']]
-        else:
-            session['Comments']=[values['-ML-'][:255]]
-        sess_df['Comments'] = session['Comments']
-
-        try:
-            # write output cons session and results to db
-            if humidity != '':
-                sess_cols = 'ADate,[Op1],[Op2],[T],[P],Electrometer,[V],MachineName,GA,Chamber,kQ,ks,kelec,kpol,NDW,TPC,Humidity,Comments'
+            # update Comments
+            if len(values['-ML-'])<255:
+                session['Comments']=[values['-ML-']]
             else:
-                sess_cols = 'ADate,[Op1],[Op2],[T],[P],Electrometer,[V],MachineName,GA,Chamber,kQ,ks,kelec,kpol,NDW,TPC,Comments'
-            res_cols = 'Rindex,ADate,Energy,[R],RGy'
-            db.write_to_db(sess_df,
-                           reslt_df,
-                           'LogosOPSession',
-                           'LogosOPResults',
-                           sess_cols,
-                           res_cols)
-        except:
-            print('outputs failed to write to DB')
-            db_flag=False
-
-        try:
-            # write chevron results to db
-            sess_cols = 'ADate,[Op1],[Op2],MachineName,GA,Comments'
-            res_cols = 'ADate,Energy,[D80],DiffTPS,DiffNIST,DiffBaseline'
-            db.write_to_db(sess_df[['Adate','Op1','Op2','Gantry','GA','Comments']],
-                           chev_reslt_df,
-                           'ChevronSession',
-                           'ChevronResults',
-                           sess_cols,
-                           res_cols)
-        except:
-            print('chevrons failed to write to DB')
-            db_flag=False
-        
-        try:
-            # write spot grid results to db
-            db.spots_to_db(all_data, spotpatterns, values)
-        except:
-            print ('spot grids failed to write to DB')
-            db_flag=False
-
-        if db_flag:
-            #deactivate buttons
-            print('######### All results written to Database #########')
-            window['-Submit-'](disabled=True)
-            window['ADate'].Update('')
-            values['ADate']=''
-            window['-ML-'].Update('Post-ISM')
-        else:
-            window['-CSV_WRITE-'](disabled=True)
-            window['-Submit-'](disabled=True)
-            progress_bar.update_bar(0)
+                session['Comments']=[values['-ML-'][:255]]
+            sess_df['Comments'] = session['Comments']
+
+            # output, chevron and spot grid sessions and results are written in one transaction
+            sess_cols, _ = db.session_columns(humidity != '')
+            res_cols, _ = db.results_columns()
+            chev_sess_cols = 'ADate,[Op1],[Op2],MachineName,GA,Comments'
+            chev_res_cols = 'ADate,Energy,[D80],DiffTPS,DiffNIST,DiffBaseline'
+            try:
+                spot_sess, spot_res = db.spot_rows(all_data, spotpatterns, values)
+                writes = [
+                    [db.OUTPUT_SESSION_TABLE, sess_cols, sess_df.values.tolist()],
+                    [db.OUTPUT_RESULTS_TABLE, res_cols, reslt_df.values.tolist()],
+                    ['ChevronSession', chev_sess_cols, sess_df[['Adate','Op1','Op2','Gantry','GA','Comments']].values.tolist()],
+                    ['ChevronResults', chev_res_cols, chev_reslt_df.values.tolist()],
+                    ['SpotPositionSession', None, [spot_sess]],
+                    ['SpotPositionResults', None, spot_res],
+                    ]
+                # journalled locally, the background worker writes it to the database
+                submit_queue.put(values['ADate'], values['-G-'], writes)
+            except Exception as e:
+                print('Submit failed, session not queued: '+str(e))
+                sg.popup("Database Submit Error","WARNING: Session could not be queued for the database.",str(e))
+                db_flag=False
+
+            if db_flag:
+                #deactivate buttons
+                print('######### Session queued for the Database #########')
+                window['-Submit-'](disabled=True)
+                window['ADate'].Update('')
+                values['ADate']=''
+                window['-ML-'].Update('Post-ISM')
+            else:
+                window['-CSV_WRITE-'](disabled=True)
+                window['-Submit-'](disabled=True)
+                progress_bar.update_bar(0)
 
 
-    ### Populate Chamber ID list
-    if event == '-Chtype-':   # chamber type dictates chamber list
-        if values['-Chtype-'] == 'Roos':
-            Ch = Roos
-        elif values['-Chtype-'] == 'Semiflex':
-            Ch = Semiflex
-        else:
-            Ch = []
-        window['-Ch-'].update(values=Ch, value='') # update Ch combo box
+        ### Populate Chamber ID list
+        if event == '-Chtype-':   # chamber type dictates chamber list
+            if values['-Chtype-'] == 'Roos':
+                Ch = Roos
+            elif values['-Chtype-'] == 'Semiflex':
+                Ch = Semiflex
+            else:
+                Ch = []
+            window['-Ch-'].update(values=Ch, value='') # update Ch combo box
     
-    ### Update calibration factors on Date change
-    if event == 'ADate':
-        try:
-            kpol, ndw, kelec, ks = db.update_cal(values['ADate'],Roos,Semiflex,El)
-        except:
-            pass
+        ### Update calibration factors on Date change
+        if event == 'ADate':
+            try:
+                kpol, ndw, kelec, ks = db.update_cal(values['ADate'],Roos,Semiflex,El)
+            except:
+                pass
         
-        if values['-G-'] in G:
-            selected_ks=ks[values['-G-']]
-            window['ks'](str(selected_ks))
-        else:
-            window['ks']('')
+            if values['-G-'] in G:
+                selected_ks=ks[values['-G-']]
+                window['ks'](str(selected_ks))
+            else:
+                window['ks']('')
         
-        if values['-Chtype-'] == 'Roos':
-            Ch = Roos
-        elif values['-Chtype-'] == 'Semiflex':
-            Ch = Semiflex
-        else:
-            Ch = []
-        window['-Ch-'].update(values=Ch, value='') # update Ch combo box
-
-        if values['-El-'] in El:
-            selected_kelec=kelec[values['-El-']]
-            window['kelec'](str(selected_kelec)) 
-        else:
-            window['kelec']('') 
-
-        if values['-Ch-'] in Ch:
-            selected_ndw = ndw[values['-Ch-']]
-            selected_kpol = kpol[values['-Ch-']]
-            window['kq'](str(kq)) 
-            window['kpol'](str(selected_kpol))
-            window['ndw'](str(selected_ndw)) 
-        else:
-            window['kq']('') 
-            window['kpol']('')
-            window['ndw']('') 
-
-        for i,_ in enumerate(layers[0]):
-            _=calc_metrics(str(i))
+            if values['-Chtype-'] == 'Roos':
+                Ch = Roos
+            elif values['-Chtype-'] == 'Semiflex':
+                Ch = Semiflex
+            else:
+                Ch = []
+            window['-Ch-'].update(values=Ch, value='') # update Ch combo box
 
-    ### Update calibration factors on Gantry, Chamber & Electrometer changes
-    if event == '-G-':
-        selected_ks = ks[values['-G-']]
-        window['ks'](str(selected_ks)) 
-        for i,_ in enumerate(layers[0]):
-            _=calc_metrics(str(i))
+            if values['-El-'] in El:
+                selected_kelec=kelec[values['-El-']]
+                window['kelec'](str(selected_kelec)) 
+            else:
+                window['kelec']('') 
+
+            if values['-Ch-'] in Ch:
+                selected_ndw = ndw[values['-Ch-']]
+                selected_kpol = kpol[values['-Ch-']]
+                window['kq'](str(kq)) 
+                window['kpol'](str(selected_kpol))
+                window['ndw'](str(selected_ndw)) 
+            else:
+                window['kq']('') 
+                window['kpol']('')
+                window['ndw']('') 
+
+            refresh_metrics()
+
+        ### Database queue status
+        if event == '-DBQueue-':
+            show_queue_status(values[event])
+
+        if event == '-Queue-':
+            entries = submit_queue.entries()
+            lines = ['%s  %s  %s (attempts: %d) %s' % (e['adate'], e['gantry'], e['status'], e['attempts'], e['error'] or '')
+                     for e in entries[-50:]]
+            sg.popup_scrolled(*(lines or ['No sessions submitted']), title='Database queue', size=(100, 20))
+            if any(e['status']==sq.FAILED for e in entries):
+                if sg.popup_yes_no('Retry the failed sessions?', title='Database queue')=='Yes':
+                    submit_queue.retry()
+
+        ### Fresh database data from the background startup load
+        if event == sd.FIELDS_EVENT:
+            Op, Roos, Semiflex, El = values[event]
+            window['-Op1-'].update(values=['']+Op, value=values['-Op1-'])
+            window['-Op2-'].update(values=['']+Op, value=values['-Op2-'])
+            window['-El-'].update(values=El, value=values['-El-'] if values['-El-'] in El else '')
+            if values['-Chtype-'] == 'Roos':
+                Ch = Roos
+            elif values['-Chtype-'] == 'Semiflex':
+                Ch = Semiflex
+            window['-Ch-'].update(values=Ch, value=values['-Ch-'] if values['-Ch-'] in Ch else '')
+
+        if event == sd.CAL_EVENT:
+            # factors for a chosen session date are loaded on the ADate event instead
+            if not values['ADate']:
+                kpol, ndw, kelec, ks = values[event]
+                show_cal_factors()
+                refresh_metrics()
+
+        if event == sd.REF_EVENT:
+            ref_data = values[event]
+            refresh_metrics()
+
+        ### Update calibration factors on Gantry, Chamber & Electrometer changes
+        if event == '-G-':
+            if values['-G-'] in ks:
+                selected_ks = ks[values['-G-']]
+                window['ks'](str(selected_ks)) 
+            refresh_metrics()
     
-    if event == '-Ch-':
-        if values['-Ch-'] in Ch:
-            selected_ndw = ndw[values['-Ch-']]
-            selected_kpol = kpol[values['-Ch-']]
-            window['kq'](str(kq)) 
-            window['kpol'](str(selected_kpol))
-            window['ndw'](str(selected_ndw)) 
-        else:
-            window['kq']('') 
-            window['kpol']('')
-            window['ndw']('') 
-        for i,_ in enumerate(layers[0]):
-            _=calc_metrics(str(i))
-
-    if event == '-El-':
-        if values['-El-'] in El:
-            selected_kelec=kelec[values['-El-']]
-            window['kelec'](str(selected_kelec)) 
-        else:
-            window['kelec']('') 
-        for i,_ in enumerate(layers[0]):
-            _=calc_metrics(str(i))
-
-    ### Update temp and press correction
-    if event in ['Temp','Press'] and re.match('[+-]?([0-9]+([.][0-9]*)?|[.][0-9]+)', values[event]):
-        try:
-            t = float(values['Temp'])
-            p = float(values['Press'])
-            tpc = (t+273.15)/293.15*1013.25/p
-            window['tpc']('%.4f' % tpc)
-            for i,_ in enumerate(layers[0]):
-                _=calc_metrics(str(i))
-        except:
-            window['tpc']('')
+        if event == '-Ch-':
+            if values['-Ch-'] in Ch and values['-Ch-'] in ndw:
+                selected_ndw = ndw[values['-Ch-']]
+                selected_kpol = kpol[values['-Ch-']]
+                window['kq'](str(kq)) 
+                window['kpol'](str(selected_kpol))
+                window['ndw'](str(selected_ndw)) 
+            else:
+                window['kq']('') 
+                window['kpol']('')
+                window['ndw']('') 
+            refresh_metrics()
+
+        if event == '-El-':
+            if values['-El-'] in El and values['-El-'] in kelec:
+                selected_kelec=kelec[values['-El-']]
+                window['kelec'](str(selected_kelec)) 
+            else:
+                window['kelec']('') 
+            refresh_metrics()
+
+        ### Update temp and press correction
+        if event in ['Temp','Press'] and re.match('[+-]?([0-9]+([.][0-9]*)?|[.][0-9]+)', values[event]):
+            try:
+                t = float(values['Temp'])
+                p = float(values['Press'])
+                tpc = (t+273.15)/293.15*1013.25/p
+                window['tpc']('%.4f' % tpc)
+                refresh_metrics()
+            except:
+                window['tpc']('')
     
-    ### Update reference values
-    if event == '-G-' and values['-G-'] in G:
-        refs = [ref_data[values['-G-']],ref_data['Energy']]
-        for i,_ in enumerate(layers[0]):
-            if window['E'+str(i)].get() != '':
-                en = int(window['E'+str(i)].get())
-                idx = refs[1].index(en)
-                window['rr'+str(i)].update("%.4f" % refs[0][idx])
-            _=calc_metrics(str(i))
-
-    ### Calculate average, diff, range and dose on the fly
-    if event in ['r'+str(i)+str(j) for i,_ in enumerate(layers[0]) for j in range(1,3)] and \
-        (re.match('[+-]?([0-9]+([.][0-9]*)?|[.][0-9]+)', values[event]) or values[event]==''):      
-        i = event[1:-1]
-        _ = calc_metrics(i)
+        ### Calculate average, diff, range and dose on the fly
+        if event in reading_keys:
+            metrics.set_reading(int(event[1:-1]), int(event[-1])-1, values[event])
+            metrics.push(window)
+
+    # queued sessions stay in the journal and are written on the next start
+    submit_queue.stop()
@@ -0,0 +1,199 @@
+"""
+Output consistency metrics of the GUI energy layers
+
+The readings of every layer, the reference dose of every layer and the dose
+coefficient (TPC x NDW x kQ x ks x kelec x kpol x RBE) are the inputs of the
+model; mean reading, reading range, mean dose and dose difference of all layers
+are derived NumPy arrays. Setting an input marks the layers that depend on it
+(one layer for a reading, every layer for the coefficient), only those layers
+are recomputed, and only the display cells whose text or colour changed are
+pushed to the window.
+
+Display cells of layer i: rm<i> mean reading, rang<i> range (%), ad<i> mean
+dose (Gy), rr<i> reference dose (Gy), diff<i> dose difference (%).
+"""
+
+import re
+import numpy as np
+
+# readings accepted: unsigned decimal numbers
+READING_RE = re.compile(r'^(?:[0-9]+(?:\.[0-9]*)?)$')
+EPS = np.finfo(float).eps
+# dose difference (%) display thresholds
+DIFF_WARN = 0.8
+DIFF_FAIL = 2.0
+BLANK = 'lightgray'
+
+
+class OutputModel():
+    '''
+        Dependency tracked output consistency metrics of all energy layers.
+
+        input:
+            energies    - (list) energy (MeV) of each layer in GUI order
+            n_readings  - (int) readings per layer
+    '''
+    def __init__(self, energies=(), n_readings=2):
+        self.energies = [int(e) for e in energies]
+        n = len(self.energies)
+        self.readings = np.full((n, n_readings), np.nan)
+        self.dose_ref = np.full(n, np.nan)
+        self.coeff = np.nan
+        # derived values of each layer
+        self.r_mean = np.full(n, np.nan)
+        self.r_range = np.full(n, np.nan)
+        self.d_mean = np.full(n, np.nan)
+        self.d_diff = np.full(n, np.nan)
+        self._dirty = np.ones(n, dtype=bool)
+        # layers recomputed since the last push
+        self._unshown = set()
+        self._ref_data = None
+        self._ref_index = {}
+        # cell key: (text, background colour, text colour) last pushed to the window
+        self._shown = {}
+
+    def set_reading(self, layer=0, j=0, text=''):
+        '''
+            Set reading j (0 based) of layer from its GUI text, readings that are not numbers are ignored
+        '''
+        value = float(text) if READING_RE.fullmatch(text.strip()) else np.nan
+        if not _same(self.readings[layer, j], value):
+            self.readings[layer, j] = value
+            self._dirty[layer] = True
+
+    def clear_readings(self):
+        '''
+            Clear the readings of every layer
+        '''
+        changed = ~np.isnan(self.readings).all(axis=1)
+        self.readings[:] = np.nan
+        self._dirty |= changed
+
+    def set_reference(self, ref_data=None, gantry=None):
+        '''
+            Set the reference dose of every layer from ref_data (see database_df.update_ref) of gantry
+        '''
+        if ref_data is not self._ref_data:
+            # energy: position in the reference lists, built once per ref_data
+            self._ref_data = ref_data
+            self._ref_index = {e: k for k, e in enumerate(ref_data['Energy'])} if ref_data else {}
+        refs = ref_data.get(gantry) if ref_data else None
+        dose_ref = np.full(len(self.energies), np.nan)
+        if refs is not None:
+            for i, e in enumerate(self.energies):
+                k = self._ref_index.get(e)
+                if k is not None and refs[k] is not None:
+                    dose_ref[i] = refs[k]
+        changed = ~_same(self.dose_ref, dose_ref)
+        self.dose_ref = dose_ref
+        self._dirty |= changed
+
+    def set_coefficient(self, *factors):
+        '''
+            Set the dose coefficient from its factors (TPC, NDW, kQ, ks, kelec, kpol, RBE);
+            the coefficient is undefined if any factor is missing or not a number
+        '''
+        try:
+            coeff = float(np.prod([float(f) for f in factors]))*1e-9
+        except (TypeError, ValueError):
+            coeff = np.nan
+        if not _same(self.coeff, coeff):
+            self.coeff = coeff
+            self._dirty[:] = True
+
+    def update(self):
+        '''
+            Recompute the layers whose inputs changed
+            Return list of layer indices recomputed
+        '''
+        layers = np.flatnonzero(self._dirty)
+        if len(layers)==0:
+            return []
+        r = self.readings[layers]
+        count = np.sum(~np.isnan(r), axis=1)
+        has = count > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_mean = np.where(has, np.nansum(r, axis=1)/np.maximum(count, 1), np.nan)
+            r_max = np.where(has, np.max(np.where(np.isnan(r), -np.inf, r), axis=1), np.nan)
+            r_min = np.where(has, np.min(np.where(np.isnan(r), np.inf, r), axis=1), np.nan)
+            self.r_mean[layers] = r_mean
+            self.r_range[layers] = (r_max-r_min)/(r_mean+EPS)*100
+            # the mean dose is the mean reading times the coefficient
+            self.d_mean[layers] = r_mean*self.coeff
+            self.d_diff[layers] = (self.d_mean[layers]-self.dose_ref[layers])/self.dose_ref[layers]*100
+        self._dirty[layers] = False
+        self._unshown.update(int(i) for i in layers)
+        return [int(i) for i in layers]
+
+    def cells(self, layer=0):
+        '''
+            Display cells of layer: dict of key: (text, background colour, text colour)
+        '''
+        i = str(layer)
+        has_ref = not np.isnan(self.dose_ref[layer])
+        has_dose = has_ref and not np.isnan(self.d_mean[layer])
+        diff = self.d_diff[layer]
+        if not has_dose:
+            diff_cell = ('', BLANK, 'black')
+        else:
+            if abs(diff)>=DIFF_FAIL:
+                colour = 'red'
+            elif abs(diff)>=DIFF_WARN:
+                colour = 'orange'
+            else:
+                colour = 'green'
+            diff_cell = ('%.3f' % diff, colour, 'white')
+        return {
+            'rm'+i: (_text('%.4f', self.r_mean[layer]), None, None),
+            'rang'+i: (_text('%.2f', self.r_range[layer]), None, None),
+            'ad'+i: (_text('%.4f', self.d_mean[layer]) if has_dose else '', None, None),
+            'rr'+i: (_text('%.4f', self.dose_ref[layer]), None, None),
+            'diff'+i: diff_cell,
+            }
+
+    def push(self, window=None):
+        '''
+            Recompute the changed layers and update the window cells whose display changed
+        '''
+        self.update()
+        for layer in sorted(self._unshown):
+            for key, cell in self.cells(layer).items():
+                if self._shown.get(key)==cell:
+                    continue
+                text, background, colour = cell
+                if background is None:
+                    window[key](text)
+                else:
+                    window[key](text, background_color=background, text_color=colour)
+                self._shown[key] = cell
+        self._unshown.clear()
+
+    def layer(self, layer=0):
+        '''
+            Metrics of a layer, None where undefined
+            Return:
+                r_mean      mean reading
+                r_range     range between reading max-min (% of the mean)
+                d_mean      mean dose
+                d_diff      percentage difference from the reference dose
+                d           list of calculated dose values
+                r           list of readings
+        '''
+        self.update()
+        r = [float(x) for x in self.readings[layer] if not np.isnan(x)]
+        d = [x*self.coeff for x in r] if not np.isnan(self.coeff) else []
+        return (_value(self.r_mean[layer]), _value(self.r_range[layer]), _value(self.d_mean[layer]),
+                _value(self.d_diff[layer]), d, r)
+
+
+def _same(a, b):
+    # equal, counting NaN as equal to NaN
+    return (a==b) | (np.isnan(a) & np.isnan(b))
+
+
+def _text(fmt, x):
+    return '' if np.isnan(x) else fmt % x
+
+
+def _value(x):
+    return None if np.isnan(x) else float(x)
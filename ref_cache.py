@@ -0,0 +1,216 @@
+"""
+Local read-through cache of the QA database reference tables
+
+The Operators, Assets, Calibration, Outputcons_ks and LogosRef tables change a
+few times a year, so a copy of each is kept in a local SQLite file and every
+read is served from it. A table is revalidated against the QA database once
+its copy is older than ttl seconds: a cheap stamp query (row count and latest
+date) is compared with the stamp of the copy and the table is only downloaded
+again if the stamp changed, or if the copy is older than max_age. Operators and
+Assets have no date column and are a few hundred rows at most, so they are
+read in full and stamped with a hash of their contents, which also catches
+rows edited in place. Expired tables are revalidated on a background thread
+while the current copy is served, and the copy is what the GUI opens with and
+falls back to when the database cannot be reached.
+
+A new cache file starts from an offline snapshot of the Operators and Assets
+tables (SEED), so the dropdowns are filled before the database was ever read;
+the snapshot is replaced by the first download.
+
+Dates are stored as 'YYYY-MM-DD HH:MM:SS' strings so they compare in SQL.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import datetime
+import decimal
+import threading
+import contextlib
+
+DEFAULT_NAME = os.path.join(os.path.expanduser('~'), '.postism', 'ref_cache.sqlite')
+DEFAULT_TTL = 12*3600
+DEFAULT_MAX_AGE = 7*24*3600
+# cached tables: columns copied and the stamp query used to detect changes, None to hash the contents
+TABLES = {
+    'Operators': {
+        'columns': ['Initials'],
+        'stamp': None,
+        },
+    'Assets': {
+        'columns': ['Item', 'Serial Number', 'Model', 'Category'],
+        'stamp': None,
+        },
+    'Calibration': {
+        'columns': ['Equipment', 'CalFactor', 'Kpol', 'Cal Date', 'Operator'],
+        'stamp': 'SELECT COUNT(*), MAX([Cal Date]) FROM Calibration',
+        },
+    'Outputcons_ks': {
+        'columns': ['MachineName', 'CorrFactor', 'CorrFactorVal', 'CalDate'],
+        'stamp': 'SELECT COUNT(*), MAX(CalDate) FROM Outputcons_ks',
+        },
+    'LogosRef': {
+        'columns': ['Energy', 'MachineName', 'RefVal', 'RefDate', 'RefType'],
+        'stamp': 'SELECT COUNT(*), MAX(RefDate) FROM LogosRef',
+        },
+    }
+# offline snapshot a new cache starts from, rows of TABLES columns
+SEED = {
+    'Operators': [[i] for i in ['AB', 'AG', 'AGr', 'AJP', 'AK', 'AM', 'AT', 'AW', 'CB', 'CG', 'LHC', 'PI', 'RM', 'SC',
+                                'SG', 'SavC', 'TNC', 'VMA', 'VR']],
+    'Assets': ([[None, s, 'TW34001SC', None] for s in ['003126', '003128', '003131', '003132']]
+               + [[None, s, 'TW31021', None] for s in ['142438', '142586', '142587']]
+               + [[None, s, 'UnidosE', None] for s in ['92579', '92580', '92581']]),
+    }
+
+
+class RefCache():
+    '''
+        SQLite copy of the reference tables.
+
+        input:
+            fetch       - (callable) fetch(sql) returns all records of a QA database query
+            errors      - (tuple) exception classes raised by fetch when the database cannot be read
+            cache_name  - (str) SQLite file
+            ttl         - (float) seconds before a table is revalidated with its stamp query
+            max_age     - (float) seconds before a table is downloaded again even if its stamp is unchanged
+    '''
+    def __init__(self, fetch=None, errors=(Exception,), cache_name=DEFAULT_NAME, ttl=DEFAULT_TTL, max_age=DEFAULT_MAX_AGE):
+        self.fetch = fetch
+        self.errors = errors
+        self.cache_name = cache_name
+        self.ttl = ttl
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        os.makedirs(os.path.dirname(cache_name), exist_ok=True)
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS _meta (name TEXT PRIMARY KEY, stamp TEXT, loaded REAL, checked REAL)')
+        meta = self.meta()
+        for table, rows in SEED.items():
+            if table not in meta:
+                # never downloaded: loaded 0 marks the snapshot
+                self._store(table, rows, None, 0)
+
+    def query(self, sql=None, params=(), tables=(), refresh=True):
+        '''
+            Run a read query on the local copies of tables and return all records.
+            With refresh True, tables never downloaded (missing or the offline snapshot)
+            are downloaded first and expired tables are revalidated in the background;
+            with refresh False only the local copies are read.
+        '''
+        if refresh:
+            meta = self.meta()
+            for table in tables:
+                if table not in meta or not meta[table]['loaded']:
+                    self.refresh(table)
+                elif time.time()-meta[table]['checked'] > self.ttl:
+                    self.refresh_async(table)
+        with self._connect() as con:
+            try:
+                return con.execute(sql, params).fetchall()
+            except sqlite3.OperationalError:
+                # table not copied yet
+                return []
+
+    def refresh(self, table=None, force=False):
+        '''
+            Revalidate a table against the QA database and download it again if it changed.
+            force revalidates regardless of ttl.
+            Returns True if the local copy is current, False if the database could not be read.
+        '''
+        now = time.time()
+        meta = self.meta().get(table)
+        if meta and not force and now-meta['checked'] <= self.ttl:
+            return True
+        columns = TABLES[table]['columns']
+        sql = 'SELECT %s FROM %s' % (', '.join('['+c+']' for c in columns), table)
+        rows = None
+        try:
+            if TABLES[table]['stamp'] is None:
+                rows = [[sqlite_value(v) for v in row] for row in self.fetch(sql)]
+                stamp = content_stamp(rows)
+            else:
+                stamp = json.dumps([sqlite_value(v) for v in self.fetch(TABLES[table]['stamp'])[0]])
+            if meta and meta['stamp']==stamp and now-meta['loaded'] <= self.max_age:
+                self._set_meta(table, stamp, meta['loaded'], now)
+                return True
+            if rows is None:
+                rows = [[sqlite_value(v) for v in row] for row in self.fetch(sql)]
+        except self.errors as e:
+            print("Reference cache: could not refresh "+table+" ("+str(e)+")")
+            return False
+        self._store(table, rows, stamp, now)
+        print("Reference cache: "+table+" updated ("+str(len(rows))+" rows)")
+        return True
+
+    def refresh_async(self, table=None, force=False):
+        '''
+            Refresh a table on a background thread, unless it is already being refreshed
+        '''
+        with self._lock:
+            if table in self._refreshing:
+                return None
+            self._refreshing.add(table)
+        thread = threading.Thread(target=self._refresh_worker, args=(table, force), daemon=True)
+        thread.start()
+        return thread
+
+    def meta(self):
+        '''
+            Dict of table name: {'stamp', 'loaded', 'checked'} for the tables copied
+        '''
+        with self._connect() as con:
+            records = con.execute('SELECT name, stamp, loaded, checked FROM _meta').fetchall()
+        return {r[0]: {'stamp': r[1], 'loaded': r[2], 'checked': r[3]} for r in records}
+
+    def _refresh_worker(self, table, force):
+        try:
+            self.refresh(table, force)
+        finally:
+            with self._lock:
+                self._refreshing.discard(table)
+
+    def _store(self, table, rows, stamp, now):
+        # replace the copy of table with rows
+        columns = TABLES[table]['columns']
+        with self._lock, self._connect() as con:
+            con.execute('DROP TABLE IF EXISTS "%s"' % table)
+            con.execute('CREATE TABLE "%s" (%s)' % (table, ', '.join('"'+c+'"' for c in columns)))
+            con.executemany('INSERT INTO "%s" VALUES (%s)' % (table, ', '.join(['?']*len(columns))), rows)
+            con.execute('INSERT OR REPLACE INTO _meta VALUES (?, ?, ?, ?)', (table, stamp, now, now))
+
+    def _set_meta(self, table, stamp, loaded, checked):
+        with self._lock, self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO _meta VALUES (?, ?, ?, ?)', (table, stamp, loaded, checked))
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # committed and closed on exit
+        con = sqlite3.connect(self.cache_name, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+
+def content_stamp(rows=None):
+    '''
+        Stamp of a table read in full: hash of its rows in sorted order
+    '''
+    text = json.dumps(sorted(json.dumps(row, default=str) for row in rows))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def sqlite_value(v):
+    # database values to types SQLite stores and compares like Access
+    if isinstance(v, datetime.datetime):
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(v, datetime.date):
+        return v.strftime('%Y-%m-%d 00:00:00')
+    if isinstance(v, decimal.Decimal):
+        return float(v)
+    return v
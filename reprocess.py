@@ -0,0 +1,168 @@
+"""
+Batch reprocessing of archived chevron acquisitions
+
+Finds every chevron folder (5 .bmp images, see chevron.acquisition_type) below a
+root directory, re-runs chevron(...).analyse(gantry) on a process pool and writes
+all ranges to a single CSV or Parquet table.
+
+Completed folders are appended to <out>.partial.csv as they finish, so an
+interrupted run picks up where it stopped when started again with the same
+arguments. The gantry and a hash of the calibration are saved with the partial
+results in <out>.partial.json; partial results of other settings are discarded.
+A finished table is never resumed from, every folder is analysed again.
+
+usage:
+    python reprocess.py ROOT OUT.csv [--gantry "Gantry 1"] [--config logos_config.json] [--workers 8] [--restart]
+"""
+
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import concurrent.futures
+import pandas as pd
+from chevron import chevron, acquisition_type
+from calibration import get_calibration
+
+COLUMNS = ['fldr', 'gantry', 'image', 'MeV', 'BPD', 'Diff_TPS', 'Diff_NIST', 'Diff_Baseline']
+MACHINE_NAMES = ['Gantry 1', 'Gantry 2', 'Gantry 3', 'Gantry 4']
+
+
+def find_chevron_dirs(root=None):
+    '''
+        Walk root and return sorted list of chevron acquisition folders
+    '''
+    chevron_dirs = []
+    for dirpath, _, filenames in os.walk(root):
+        bmps = [f for f in filenames if f.lower().endswith('.bmp')]
+        if acquisition_type(bmps)=='chevron':
+            chevron_dirs.append(os.path.abspath(dirpath))
+    return sorted(chevron_dirs)
+
+
+def gantry_from_path(fldr=None):
+    '''
+        Return 'Gantry N' if a folder name in the path identifies the gantry, else None
+    '''
+    m = re.search(r'gantry\s*_?([1-4])', fldr, re.IGNORECASE)
+    if m:
+        return 'Gantry '+m.group(1)
+    return None
+
+
+def analyse_dir(fldr=None, gantry=None, json_name=None):
+    '''
+        Analyse a single chevron folder, returns list of result rows (one per energy)
+    '''
+    if gantry is None:
+        gantry = gantry_from_path(fldr)
+    r = chevron(fldr).analyse(gantry, json_name)
+    n = len(r['BPD'])
+    # one energy list per image, each the calibration energies
+    energies = r['MeV'][0] if n else []
+    if len(energies)!=n:
+        raise ValueError('%d chevron images but %d calibration energies' % (n, len(energies)))
+    diff_baseline = r.get('Diff_Baseline', [None]*n)
+    rows = []
+    for i in range(n):
+        rows.append([fldr, gantry, i+1, energies[i], r['BPD'][i],
+                     r['Diff_TPS'][i], r['Diff_NIST'][i], diff_baseline[i]])
+    return rows
+
+
+def run_settings(gantry=None, json_name=None):
+    '''
+        Settings the results depend on: gantry and a hash of the calibration contents
+    '''
+    cal = json.dumps(get_calibration(json_name).to_dict(), sort_keys=True)
+    return {'gantry': gantry, 'calibration': hashlib.sha1(cal.encode()).hexdigest()}
+
+
+def reprocess(root=None, out=None, gantry=None, json_name=None, workers=None, resume=True):
+    '''
+        Reprocess all chevron folders below root and write results table to out (.csv or .parquet)
+
+        Returns:
+            df          dataframe of all results
+            failed      dict of folder: error message for folders that could not be analysed
+    '''
+    partial = out+'.partial.csv'
+    settings_name = out+'.partial.json'
+    settings = run_settings(gantry, json_name)
+    previous = [pd.DataFrame(columns=COLUMNS)]
+    if resume and os.path.isfile(partial) and _read_settings(settings_name)==settings:
+        previous.append(_read_table(partial))
+    done = pd.concat(previous, ignore_index=True).drop_duplicates(subset=['fldr', 'image'], keep='last')
+    # partial journal continues from everything already completed with the same settings
+    done.to_csv(partial, index=False)
+    with open(settings_name, 'w') as f:
+        json.dump(settings, f)
+
+    todo = [d for d in find_chevron_dirs(root) if d not in set(done['fldr'])]
+    print('%d chevron folders to process, %d already done' % (len(todo), done['fldr'].nunique()))
+
+    failed = {}
+    if todo:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(analyse_dir, d, gantry, json_name): d for d in todo}
+            for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                fldr = futures[future]
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    failed[fldr] = str(e)
+                    print('[%d/%d] FAILED %s: %s' % (n, len(todo), fldr, e))
+                    continue
+                pd.DataFrame(rows, columns=COLUMNS).to_csv(partial, mode='a', header=False, index=False)
+                print('[%d/%d] %s' % (n, len(todo), fldr))
+
+    df = _read_table(partial).sort_values(['fldr', 'image'], ignore_index=True)
+    _write_table(df, out)
+    os.remove(partial)
+    os.remove(settings_name)
+    return df, failed
+
+
+def _read_settings(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_table(fname):
+    if fname.lower().endswith('.parquet'):
+        return pd.read_parquet(fname)
+    return pd.read_csv(fname)
+
+
+def _write_table(df, fname):
+    if fname.lower().endswith('.parquet'):
+        df.to_parquet(fname, index=False)
+    else:
+        df.to_csv(fname, index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reprocess archived Logos chevron acquisitions.')
+    parser.add_argument('root', help='folder searched recursively for chevron acquisitions')
+    parser.add_argument('out', help='results table (.csv or .parquet)')
+    parser.add_argument('--gantry', choices=MACHINE_NAMES, default=None,
+                        help='gantry for baseline comparison (default: taken from folder names)')
+    parser.add_argument('--config', default=None, help='alternative logos_config.json')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--restart', action='store_true', help='ignore partial results of an interrupted run')
+    args = parser.parse_args(argv)
+
+    _, failed = reprocess(args.root, args.out, args.gantry, args.config, args.workers, not args.restart)
+    if failed:
+        print('%d folders could not be analysed' % len(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
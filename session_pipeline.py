@@ -0,0 +1,277 @@
+"""
+Headless Check Session pipeline
+
+Runs the Check Session stages on a plain session description, without the GUI:
+
+    session     session dict of the description
+    output      output consistency results of every energy layer (see output_model)
+    organise    Logos folder sorting and report directory (analysis.organise_logos_dirs)
+    chevron     chevron ranges (analysis.chevron_results)
+    spot        spot grid positions (analysis.spot_results)
+    reports     spot grid and combined session report PDFs
+    tables      session, results and chevron dataframes
+
+Stage results are cached with stage_cache. Progress is reported through a
+callback progress(step, stage) with the step numbers of the GUI progress bar,
+and a failed stage raises StageError with the message shown to the user.
+
+The session description is a dict of the GUI values (ADate, -Op1-, -Op2-,
+Temp, Press, H, -El-, -V-, -G-, GA, -Ch-, -ML-, -Logos-, readings r<layer><1|2>)
+and the calibration factors kQ, ks, kelec, kpol, NDW, TPC and RBE. From the
+command line, missing calibration factors and TPC are taken from the local copy
+of the QA database reference tables:
+
+usage:
+    python session_pipeline.py SESSION.json [--recompute] [--profile OUT.prof]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import cProfile
+import pandas as pd
+import analysis as ana
+import stage_cache as sc
+import output_model as om
+import database_df as db
+import spotanalysis.constants as cs
+from calibration import get_calibration
+
+# energy layers of the output consistency measurements
+ENERGIES = [240, 200, 150, 100, 70]
+RBE = 1.1
+KQ = 1.001
+FACTORS = ['kQ', 'ks', 'kelec', 'kpol', 'NDW', 'TPC']
+# GUI progress bar step reached at the end of each stage
+STEPS = {'session': 3, 'output': 4, 'organise': 5, 'chevron': 6, 'spot': 7, 'reports': 12, 'tables': 13}
+
+
+class StageError(Exception):
+    '''
+        A pipeline stage failed.
+
+        attributes:
+            stage       - (str) stage name
+            title       - (str) short title of the message for the user
+            message     - (str) what the user should check
+    '''
+    def __init__(self, stage=None, title=None, message=None):
+        super().__init__('%s: %s' % (stage, message))
+        self.stage = stage
+        self.title = title
+        self.message = message
+
+
+def build_session(description=None):
+    '''
+        Session dict (one entry lists, see database_df.SESSION_COLUMNS) of a session description
+    '''
+    session = {}
+    session['Adate']=[description['ADate']]
+    session['Op1']=[description['-Op1-']]
+    session['Op2']=[description['-Op2-']]
+    session['Temp']=[description['Temp']]
+    session['P']=[description['Press']]
+    session['Electrometer']=[description['-El-']]
+    session['V']=[description['-V-']]
+    session['Gantry']=[description['-G-']]
+    session['GA']=[description['GA']]
+    session['Chamber']=[description['-Ch-']]
+    for k in FACTORS:
+        session[k]=[str(description[k])]
+    if description.get('H', '') != '':
+        session['Humidity']=[description['H']]
+    session['Comments']=[description['-ML-'][:255]]
+    return session
+
+
+def build_results(description=None, ref_data=None, energies=ENERGIES):
+    '''
+        Output consistency results dict of every reading of the layers with a dose difference
+    '''
+    metrics = om.OutputModel(energies)
+    for i, _ in enumerate(energies):
+        for j in range(2):
+            # JSON descriptions may hold readings as numbers
+            metrics.set_reading(i, j, str(description.get('r'+str(i)+str(j+1), '')))
+    metrics.set_reference(ref_data, description['-G-'])
+    metrics.set_coefficient(*[description[k] for k in ['TPC', 'NDW', 'kQ', 'ks', 'kelec', 'kpol']],
+                            description.get('RBE', RBE))
+    results = {k: [] for k in ['Rindex', 'ADate', 'Energy', 'R', 'Ravg', 'Rrange prcnt', 'RGy', 'RavgGy', 'Rref', 'Rdelta']}
+    cnt = 0
+    for i, energy in enumerate(energies):
+        r_mean, r_range, d_mean, d_diff, d, r = metrics.layer(i)
+        if d_diff is None:
+            continue
+        for rn, dn in zip(r, d):
+            cnt += 1
+            results['Rindex'].append(str(cnt))
+            results['ADate'].append(description['ADate'])
+            results['Energy'].append(str(energy))
+            results['R'].append(str(rn))
+            results['Ravg'].append(str(r_mean))
+            results['Rrange prcnt'].append(str(r_range))
+            results['RGy'].append(str(dn))
+            results['RavgGy'].append(str(d_mean))
+            results['Rref'].append(str(float(metrics.dose_ref[i])))
+            results['Rdelta'].append(str(d_diff))
+    return results
+
+
+def run_session(description=None, ref_data=None, cache=None, progress=None, energies=ENERGIES, spotE=None,
+                db_cols=cs.db_cols):
+    '''
+        Run every Check Session stage on a session description
+
+        Input:
+            description     session description dict (see module docstring)
+            ref_data        reference doses (see database_df.update_ref)
+            cache           stage_cache.StageCache, None for a new one
+            progress        callable progress(step, stage) called as each stage completes
+            energies        output consistency layer energies
+            spotE           spot grid energies, default from logos_config.json
+
+        Return dict:
+            session, results            session and output consistency results dicts
+            sess_df, reslt_df           session and results dataframes (database columns)
+            chev_results, chev_reslt_df chevron results dict and dataframe
+            df_spot, device, spotpatterns, all_data     spot grid results
+            report_dir, report_name     report folder and combined report PDF
+            timings                     dict of stage: seconds
+
+        Raises StageError if a stage fails
+    '''
+    if cache is None:
+        cache = sc.StageCache()
+    if spotE is None:
+        spotE = get_calibration().SpotE
+    out = {'timings': {}}
+
+    def stage(name, title, message, fn):
+        t0 = time.perf_counter()
+        try:
+            fn()
+        except StageError:
+            raise
+        except Exception as e:
+            print('ERROR: %s (%s)' % (message, e))
+            raise StageError(name, title, message)
+        out['timings'][name] = time.perf_counter()-t0
+        if progress is not None:
+            progress(STEPS[name], name)
+
+    def session_stage():
+        out['session'] = build_session(description)
+
+    def output_stage():
+        out['results'] = build_results(description, ref_data, energies)
+        if len(out['results']['R'])==0:
+            raise StageError('output', "No Results", "Enter some results before clicking Check Session")
+
+    def organise_stage():
+        if not os.path.isdir(description['-Logos-']):
+            raise StageError('organise', "Invalid directory", "Select a folder containing valid Logos data")
+        out['chevron_dir'], out['spot_dirs'], out['report_dir'], out['manifest'] = ana.organise_logos_dirs(description)
+
+    def chevron_stage():
+        key = cache.key('chevron', sc.logos_inputs(out['manifest'], [out['chevron_dir']]),
+                        get_calibration().to_dict(), description['-G-'])
+        out['chev_results'] = cache.run(key, ana.chevron_results, out['chevron_dir'], description, out['manifest'])
+
+    def spot_stage():
+        out['spot_key'] = cache.key('spot', sc.logos_inputs(out['manifest'], out['spot_dirs']),
+                                    spotE, description['-G-'], description['GA'], db_cols)
+        out['df_spot'], out['device'], out['spotpatterns'], out['all_data'] = cache.run(
+            out['spot_key'], ana.spot_results, out['spot_dirs'], spotE, description, db_cols, out['manifest'])
+
+    def reports_stage():
+        report_dir = out['report_dir']
+        report_values = [description[k] for k in ['-G-', 'ADate', '-Op1-', '-Op2-', '-ML-']]
+        spot_report_key = cache.key('spot_report', out['spot_key'], report_values, spotE)
+        cache.run_files(spot_report_key, report_dir, ana.spot_report, out['df_spot'], out['device'], report_dir,
+                        description, spotE)
+        report_results = ana.output_results(out['results'])
+        out['report_name'] = os.path.join(report_dir, '_PostISM_Report.pdf')
+        spot_pdfs = sorted(f for f in glob.glob(os.path.join(report_dir, '*.pdf')) if f != out['report_name'])
+        key = cache.key('session_report', report_results, out['chev_results'], report_values, spot_report_key)
+        cache.run_files(key, report_dir, ana.session_report, report_results, out['chev_results'], description,
+                        out['report_name'], spot_pdfs, (2.0, 0.8), (1.0, 0.5))
+
+    def tables_stage():
+        out['sess_df'] = pd.DataFrame.from_dict(out['session'])
+        out['reslt_df'] = pd.DataFrame.from_dict(out['results'])[['Rindex', 'ADate', 'Energy', 'R', 'RGy']]
+        chev_results = out['chev_results']
+        chev_reslt_df = pd.DataFrame.from_dict(
+            {k: chev_results[k] for k in ['Energy MeV', 'D80 mm', 'Diff TPS mm', 'Diff NIST mm', 'Diff Baseline mm']})
+        chev_reslt_df['ADate'] = description['ADate']
+        out['chev_reslt_df'] = chev_reslt_df[['ADate', 'Energy MeV', 'D80 mm', 'Diff TPS mm', 'Diff NIST mm', 'Diff Baseline mm']]
+
+    stage('session', None, "Session not analysed - check session data is complete", session_stage)
+    stage('output', "Session not analysed", "Check you have entered all information correctly", output_stage)
+    stage('organise', "No Results", "Enter path to valid Logos data before clicking Check Session", organise_stage)
+    stage('chevron', "No Chevron Results", "Unable to process Chevron data, check Logos files", chevron_stage)
+    stage('spot', "No Spot Grid Results", "Unable to process Spot Grid data, check Logos files", spot_stage)
+    stage('reports', "Reports not generated", "Reports could not be generated, check config files and dependencies",
+          reports_stage)
+    stage('tables', None, "Session results could not be tabulated", tables_stage)
+    return out
+
+
+def complete_description(description=None):
+    '''
+        Fill missing calibration factors and TPC of a session description from the local
+        copy of the QA database reference tables, returns the completed copy
+    '''
+    description = dict(description)
+    description.setdefault('kQ', KQ)
+    description.setdefault('RBE', RBE)
+    if 'TPC' not in description:
+        t = float(description['Temp'])
+        p = float(description['Press'])
+        description['TPC'] = (t+273.15)/293.15*1013.25/p
+    if not all(k in description for k in FACTORS):
+        _, roos, semiflex, el = db.populate_fields(cached_only=True)
+        kpol, ndw, kelec, ks = db.update_cal(description['ADate'], roos, semiflex, el, cached_only=True)
+        description.setdefault('ks', ks.get(description['-G-']))
+        description.setdefault('kelec', kelec.get(description['-El-']))
+        description.setdefault('kpol', kpol.get(description['-Ch-']))
+        description.setdefault('NDW', ndw.get(description['-Ch-']))
+    return description
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Check Session on a session description without the GUI.')
+    parser.add_argument('session', help='JSON session description (GUI values and calibration factors)')
+    parser.add_argument('--recompute', action='store_true', help='ignore cached stage results')
+    parser.add_argument('--profile', default=None, help='write cProfile statistics of the run to this file')
+    args = parser.parse_args(argv)
+
+    with open(args.session) as f:
+        description = complete_description(json.load(f))
+    ref_data = description.pop('ref', None) or db.update_ref('DoseGy', cached_only=True)
+    cache = sc.StageCache()
+    cache.refresh = args.recompute
+    progress = lambda step, stage: print('[%d] %s done' % (step, stage))
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        if profiler:
+            profiler.enable()
+        out = run_session(description, ref_data, cache, progress)
+    except StageError as e:
+        print('Check Session failed at stage %s: %s' % (e.stage, e.message))
+        return 1
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    for name, seconds in out['timings'].items():
+        print('%-10s %.2f s' % (name, seconds))
+    print('Report: '+out['report_name'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
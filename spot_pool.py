@@ -0,0 +1,79 @@
+"""
+Process pool construction of spot grid SpotPattern objects
+
+Each spot grid image is an independent image-processing job, so the
+spotanalysis SpotPattern objects are built in worker processes. Whole-number
+image buffers are sent back to the parent as uint8 (lossless, 8x smaller than
+float64) and restored on arrival. If the pool cannot be used the patterns are
+built serially.
+"""
+
+import os
+import concurrent.futures
+import numpy as np
+import spotanalysis.spot_position_mod as spm
+
+# default number of worker processes, None = one per image up to the CPU count, 0 or 1 = serial
+SPOT_WORKERS = None
+# 2D arrays smaller than this are returned as they are
+_PACK_MIN_SIZE = 4096
+
+
+class _PackedArray():
+    '''
+        Picklable uint8 copy of a whole-number image array and its original dtype
+    '''
+    def __init__(self, arr):
+        self.data = arr.astype(np.uint8)
+        self.dtype = arr.dtype
+
+    def unpack(self):
+        return self.data.astype(self.dtype)
+
+
+def build_spot_patterns(bmps=None, workers=SPOT_WORKERS):
+    '''
+        Build SpotPattern objects, on a process pool where possible
+
+        Input:
+            bmps        dict of energy label: bmp filepath
+            workers     number of worker processes (None: one per image up to CPU count, 0/1: serial)
+
+        Return:
+            spotpatterns    dict of energy label: SpotPattern, in the same order as bmps
+    '''
+    labels = list(bmps)
+    if workers is None:
+        workers = min(len(labels), os.cpu_count() or 1)
+    patterns = None
+    if workers > 1 and len(labels) > 1:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                packed = list(pool.map(_build_packed, [bmps[k] for k in labels]))
+            patterns = [_unpack(p) for p in packed]
+        except Exception as e:
+            print("Spot pattern pool failed ("+str(e)+"), processing serially...")
+            patterns = None
+    if patterns is None:
+        patterns = [spm.SpotPattern(bmps[k]) for k in labels]
+    return dict(zip(labels, patterns))
+
+
+def _build_packed(bmp):
+    # worker: build SpotPattern and shrink its image buffers before pickling
+    return _pack(spm.SpotPattern(bmp))
+
+
+def _pack(obj):
+    for k, v in vars(obj).items():
+        if isinstance(v, np.ndarray) and v.ndim==2 and v.size>=_PACK_MIN_SIZE and v.dtype!=np.uint8:
+            if v.min()>=0 and v.max()<=255 and np.array_equal(v, np.round(v)):
+                setattr(obj, k, _PackedArray(v))
+    return obj
+
+
+def _unpack(obj):
+    for k, v in vars(obj).items():
+        if isinstance(v, _PackedArray):
+            setattr(obj, k, v.unpack())
+    return obj
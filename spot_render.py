@@ -0,0 +1,142 @@
+"""
+Parallel rendering of the spot grid figures and report
+
+spotanalysis.figures and spotanalysis.report save their figures under relative
+file names. Every render call is given the absolute report folder and relative
+names passed to savefig are resolved against it, so no process ever changes
+its working directory. Figures are rendered in worker processes with the
+non-interactive Agg backend; the absolute and relative (tolerance 2 and 1)
+variants of each plot are rendered by the same task. If the pool cannot be
+started, or breaks, the figures and report are rendered serially in this
+process. Errors raised while plotting are not retried.
+
+The spotanalysis plot functions create and save their own figure on every
+call, so the two tolerance variants cannot share a figure from this repository.
+"""
+
+import os
+import contextlib
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+# (figures function, tolerances) rendered per task; None = function takes no tolerance
+FIGURES = [
+    ('plot_spot_grid', [2, 1]),
+    ('plot_shifts', [2, 1]),
+    ('plot_shifts_by_energy', [2, 1]),
+    ('plot_shifts_by_pos', [2, 1]),
+    ('plot_distribution', None),
+    ('plot_fwhm', None),
+    ]
+# default number of worker processes, None = one per figure task up to the CPU count, 0 or 1 = serial
+RENDER_WORKERS = None
+
+# worker state set by _init_worker
+_df = None
+_device = None
+
+
+def render_spot_report(df=None, device=None, report_dir=None, op1='', op2='', gr_path=None, prof_path=None,
+                       comments='', energies=[240, 200, 150, 100, 70], workers=RENDER_WORKERS):
+    '''
+        Render spot grid figures concurrently, then the results tables and spot report PDF, into report_dir
+
+        Input:
+            df          spot grid results dataframe (analysis.spot_results)
+            device      spot grid device returned by spot_data
+            report_dir  output folder
+            op1, op2    operator initials
+            gr_path     filepath of def_gradient_ratio.png
+            prof_path   filepath of profiles_per_spot.png
+            comments    session comments
+            energies    spot grid energies
+            workers     number of worker processes (None: one per figure task up to CPU count, 0/1: serial)
+    '''
+    report_dir = os.path.abspath(report_dir)
+    report_args = (op1, op2, report_dir, gr_path, prof_path, comments, energies)
+    if workers is None:
+        workers = min(len(FIGURES), os.cpu_count() or 1)
+    if workers > 1:
+        pool = None
+        try:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                          initargs=(df, device))
+            # worker processes are started as tasks are submitted
+            futures = [pool.submit(_render_figure, name, tolerances, report_dir) for name, tolerances in FIGURES]
+        except (OSError, BrokenProcessPool) as e:
+            print("Spot report pool could not be started ("+str(e)+"), rendering serially...")
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            try:
+                with pool:
+                    # figures are independent of each other
+                    for f in futures:
+                        f.result()
+                    # tables and report embed the figures, render last
+                    pool.submit(_render_report, *report_args).result()
+                return
+            except BrokenProcessPool as e:
+                print("Spot report pool failed ("+str(e)+"), rendering serially...")
+    _render_serial(df, device, report_dir, report_args)
+
+
+def _render_serial(df, device, report_dir, report_args):
+    global _df, _device
+    _df = df
+    _device = device
+    try:
+        for name, tolerances in FIGURES:
+            _render_figure(name, tolerances, report_dir)
+        _render_report(*report_args)
+    finally:
+        _df = None
+        _device = None
+
+
+def _init_worker(df, device):
+    global _df, _device
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+    _df = df
+    _device = device
+
+
+@contextlib.contextmanager
+def _saved_in(out_dir):
+    # relative savefig file names are written to out_dir (plt.savefig calls Figure.savefig)
+    from matplotlib.figure import Figure
+    savefig = Figure.savefig
+
+    def save(fig, fname, *args, **kwargs):
+        if isinstance(fname, (str, os.PathLike)) and not os.path.isabs(fname):
+            fname = os.path.join(out_dir, fname)
+        return savefig(fig, fname, *args, **kwargs)
+
+    Figure.savefig = save
+    try:
+        yield
+    finally:
+        Figure.savefig = savefig
+
+
+def _render_figure(name, tolerances, out_dir):
+    import matplotlib.pyplot as plt
+    import spotanalysis.figures as fg
+    plot = getattr(fg, name)
+    with _saved_in(out_dir):
+        if tolerances is None:
+            plot(_df)
+        else:
+            for tolerance in tolerances:
+                plot(_df, _device, tolerance=tolerance)
+    plt.close('all')
+
+
+def _render_report(op1, op2, report_dir, gr_path, prof_path, comments, energies):
+    import matplotlib.pyplot as plt
+    import spotanalysis.report as rp
+    with _saved_in(report_dir):
+        rp.make_table(_df, energies)
+        rp.spot_report(_df, op1, op2, report_dir, gr_path, prof_path, comments, energies)
+    plt.close('all')
@@ -0,0 +1,207 @@
+"""
+Persistent, content-addressed cache for Check Session pipeline stages
+
+Each stage result is stored under a sha256 key built from the stage name, the
+Logos input files (name, size and mtime from the Logos manifest), the relevant
+config and the GUI values the stage depends on. A stage is skipped when its key
+is already in the cache, so editing e.g. the comments does not redo the chevron
+or spot grid analysis.
+
+Entries are pickles in the cache directory. The least recently used entries are
+evicted once the directory grows beyond max_bytes.
+
+Set environment variable POSTISM_CACHE=0 to disable caching, or
+POSTISM_CACHE_DIR to move the cache directory.
+"""
+
+import os
+import glob
+import json
+import pickle
+import hashlib
+import threading
+
+# bump to invalidate every existing entry when stage outputs change
+CACHE_VERSION = 1
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.postism', 'cache')
+DEFAULT_MAX_BYTES = 1024**3
+# files written next to Logos data that do not affect any result
+_IGNORED_ROLES = ('other',)
+
+
+class StageCache():
+    '''
+        Disk cache of pipeline stage results.
+
+        input:
+            cache_dir   - (str) cache directory
+            max_bytes   - (int) LRU eviction threshold for the total size of the cache
+            enabled     - (bool) False runs every stage without touching the cache
+
+        attributes:
+            refresh     - (bool) when True stages are recomputed and their cache entries overwritten
+    '''
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, enabled=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get('POSTISM_CACHE_DIR', DEFAULT_DIR)
+        if enabled is None:
+            enabled = os.environ.get('POSTISM_CACHE', '1')!='0'
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = False
+        self._lock = threading.Lock()
+        if self.enabled:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError:
+                print("Stage cache disabled, could not create "+cache_dir)
+                self.enabled = False
+
+    def key(self, stage=None, *parts):
+        '''
+            Return the cache key of a stage for the given json serialisable inputs
+        '''
+        h = hashlib.sha256()
+        h.update(json.dumps([CACHE_VERSION, stage, parts], sort_keys=True, default=str).encode())
+        return stage+'-'+h.hexdigest()
+
+    def get(self, key=None):
+        '''
+            Return (True, value) on a cache hit, else (False, None)
+        '''
+        if not self.enabled or self.refresh:
+            return False, None
+        fname = self._path(key)
+        try:
+            with open(fname, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except Exception:
+            # unreadable entry, drop it
+            self._remove(fname)
+            return False, None
+        try:
+            os.utime(fname)  # mark as recently used
+        except OSError:
+            pass
+        return True, value
+
+    def put(self, key=None, value=None):
+        '''
+            Store value under key, returns False if it could not be stored
+        '''
+        if not self.enabled:
+            return False
+        fname = self._path(key)
+        tmp_name = fname+'.%d.tmp' % threading.get_ident()
+        try:
+            with open(tmp_name, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, fname)
+        except Exception as e:
+            print("Stage cache: could not store "+key+" ("+str(e)+")")
+            self._remove(tmp_name)
+            return False
+        self._evict()
+        return True
+
+    def run(self, key=None, fn=None, *args, **kwargs):
+        '''
+            Return cached value for key, or call fn(*args, **kwargs) and cache its result
+        '''
+        hit, value = self.get(key)
+        if hit:
+            print("Stage cache hit: "+key.rsplit('-', 1)[0])
+            return value
+        value = fn(*args, **kwargs)
+        self.put(key, value)
+        return value
+
+    def run_files(self, key=None, out_dir=None, fn=None, *args, **kwargs):
+        '''
+            Cache a stage whose output is files written to out_dir.
+            On a hit the files are restored to out_dir and fn is not called.
+            On a miss every file fn creates or modifies in out_dir is stored.
+        '''
+        hit, files = self.get(key)
+        if hit:
+            print("Stage cache hit: "+key.rsplit('-', 1)[0])
+            for name, data in files.items():
+                with open(os.path.join(out_dir, name), 'wb') as f:
+                    f.write(data)
+            return
+        before = _snapshot(out_dir)
+        fn(*args, **kwargs)
+        if not self.enabled:
+            return
+        files = {}
+        for name, stamp in _snapshot(out_dir).items():
+            if before.get(name)!=stamp:
+                with open(os.path.join(out_dir, name), 'rb') as f:
+                    files[name] = f.read()
+        self.put(key, files)
+
+    def invalidate(self, stage=None):
+        '''
+            Delete cached entries of a stage, or the whole cache if stage is None
+        '''
+        pattern = '*.pkl' if stage is None else stage+'-*.pkl'
+        for fname in glob.glob(os.path.join(self.cache_dir, pattern)):
+            self._remove(fname)
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in glob.glob(os.path.join(self.cache_dir, '*.pkl')))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key+'.pkl')
+
+    def _evict(self):
+        # remove least recently used entries until the cache fits in max_bytes
+        with self._lock:
+            entries = []
+            for fname in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+            total = sum(e[1] for e in entries)
+            for _, size, fname in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(fname)
+                total -= size
+
+    @staticmethod
+    def _remove(fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+
+def logos_inputs(manifest=None, fldrs=None):
+    '''
+        Fingerprint of the Logos files in fldrs: sorted [folder, file, size, mtime] lists from the manifest
+    '''
+    inputs = []
+    for fldr in fldrs:
+        name = os.path.basename(os.path.normpath(fldr))
+        entry = manifest['folders'][name]
+        for fname in sorted(entry['files']):
+            f = entry['files'][fname]
+            if f['role'] not in _IGNORED_ROLES:
+                inputs.append([name, fname, f['size'], f['mtime_ns']])
+    return inputs
+
+
+def _snapshot(out_dir):
+    stamps = {}
+    with os.scandir(out_dir) as it:
+        for f in it:
+            if f.is_file():
+                st = f.stat()
+                stamps[f.name] = (st.st_size, st.st_mtime_ns)
+    return stamps
@@ -0,0 +1,91 @@
+"""
+Background loading of the startup database data
+
+The operator, equipment, calibration factor and reference dose lists come from
+the local copy of the QA database reference tables (see ref_cache), so the
+window is built immediately from that copy. Copies older than the cache TTL are
+then revalidated against the QA database concurrently on background threads
+(copies checked within the TTL are used as they are), and fresh values
+are sent to the event loop with window.write_event_value as each dataset's
+tables are checked:
+
+    FIELDS_EVENT    (Op, Roos, Semiflex, El)
+    CAL_EVENT       (kpol, ndw, kelec, ks)
+    REF_EVENT       ref_data
+"""
+
+import datetime
+import threading
+import concurrent.futures
+import database_df as db
+
+FIELDS_EVENT = '-DBFields-'
+CAL_EVENT = '-DBCal-'
+REF_EVENT = '-DBRef-'
+# reference tables each dataset is read from
+DATASETS = [
+    (FIELDS_EVENT, ['Operators', 'Assets']),
+    (REF_EVENT, ['LogosRef']),
+    (CAL_EVENT, ['Assets', 'Calibration', 'Outputcons_ks']),
+    ]
+
+
+def load_cached(adate=None):
+    '''
+        Return the startup data from the local copy of the reference tables, without contacting the database
+        Return dict:
+            cached['fields']        dict of lists 'Op', 'Roos', 'Semiflex', 'El'
+            cached['cal']           [kpol, ndw, kelec, ks] dicts
+            cached['ref']           ref_data dict (see database_df.update_ref)
+    '''
+    if adate is None:
+        adate = datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S")
+    fields = db.populate_fields(cached_only=True)
+    return {
+        'fields': dict(zip(['Op', 'Roos', 'Semiflex', 'El'], fields)),
+        'cal': list(db.update_cal(adate, *fields[1:], cached_only=True)),
+        'ref': db.update_ref('DoseGy', cached_only=True),
+        }
+
+
+def start_loading(window=None, adate=None):
+    '''
+        Revalidate the expired reference tables concurrently on background threads.
+        Returns immediately; results are posted to window as FIELDS_EVENT, CAL_EVENT and REF_EVENT.
+
+        Input:
+            window      PySimpleGUI window
+            adate       timestamp for the calibration factors (default: now)
+    '''
+    if adate is None:
+        adate = datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S")
+    thread = threading.Thread(target=_load, args=(window, adate), daemon=True)
+    thread.start()
+    return thread
+
+
+def _load(window, adate):
+    tables = sorted(set(t for _, ts in DATASETS for t in ts))
+    done = set()
+    posted = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tables)) as pool:
+        futures = {pool.submit(db.REF_CACHE.refresh, t): t for t in tables}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print("Background database load failed ("+str(e)+")")
+            done.add(futures[future])
+            # post each dataset as soon as its tables are checked
+            for event, ts in DATASETS:
+                if event not in posted and done.issuperset(ts):
+                    posted.add(event)
+                    window.write_event_value(event, _read(event, adate))
+
+
+def _read(event, adate):
+    if event==FIELDS_EVENT:
+        return db.populate_fields(cached_only=True)
+    if event==CAL_EVENT:
+        return db.update_cal(adate, *db.populate_fields(cached_only=True)[1:], cached_only=True)
+    return db.update_ref('DoseGy', cached_only=True)
@@ -0,0 +1,335 @@
+"""
+Write-behind queue of database submissions
+
+Submitted sessions are first appended to a local SQLite journal, so Submit
+returns as soon as the session is on disk, whether or not the QA database can
+be opened (e.g. while the Access file is locked). A background worker drains
+the journal into the database:
+
+    - due sessions are written together in one transaction of up to batch
+      sessions; if that fails each is written on its own so one bad session
+      does not hold back the others
+    - a session that cannot be written is retried after base_delay seconds,
+      doubling on every attempt up to max_delay, and marked failed after
+      max_attempts (failed sessions stay in the journal and can be retried)
+    - the idempotency key of a session is its ADate and gantry: a key that was
+      written is not queued again, and a session found in the database before
+      it is written (e.g. committed just before the application closed) is
+      marked written without writing it twice
+
+The journal is append-only: entries hold the rows of each submission and every
+status change is appended to the events table, the latest event of an entry
+being its status.
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+import contextlib
+import sqlite3
+
+DEFAULT_NAME = os.path.join(os.path.expanduser('~'), '.postism', 'submit_queue.sqlite')
+QUEUED = 'queued'
+WRITTEN = 'written'
+FAILED = 'failed'
+# a newer submission of the same session replaced the entry
+REPLACED = 'replaced'
+STATUSES = [QUEUED, WRITTEN, FAILED, REPLACED]
+
+
+class SubmitQueue():
+    '''
+        Journal of database submissions and the worker writing them to the database.
+
+        input:
+            submit          - (callable) submit(writes) writes a list of [table, cols, rows] in one transaction,
+                              raising if nothing was written (see database_df.submit_session)
+            exists          - (callable) exists(adate, gantry) True if the session is already in the database,
+                              None to skip the check
+            journal_name    - (str) SQLite file
+            batch           - (int) maximum sessions written per transaction
+            base_delay      - (float) seconds before the first retry of a failed write
+            max_delay       - (float) maximum seconds between retries
+            max_attempts    - (int) attempts before a session is marked failed
+            interval        - (float) maximum seconds between worker passes
+    '''
+    def __init__(self, submit=None, exists=None, journal_name=DEFAULT_NAME, batch=5, base_delay=5.0,
+                 max_delay=600.0, max_attempts=20, interval=30.0):
+        self.submit = submit
+        self.exists = exists
+        self.journal_name = journal_name
+        self.batch = batch
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self.on_change = None
+        # journal writes and the entries being written (put does not wait for the database)
+        self._lock = threading.Lock()
+        self._writing = set()
+        # worker passes
+        self._draining = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(os.path.dirname(journal_name), exist_ok=True)
+        with self._connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS entries (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, adate TEXT, gantry TEXT,
+                            writes TEXT, created REAL)''')
+            con.execute('''CREATE TABLE IF NOT EXISTS events (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT, entry INTEGER, status TEXT,
+                            attempts INTEGER, next_try REAL, time REAL, error TEXT)''')
+            con.execute('CREATE INDEX IF NOT EXISTS events_entry ON events (entry, id)')
+
+    def put(self, adate=None, gantry=None, writes=None):
+        '''
+            Append a session to the journal and wake the worker.
+            A queued or failed submission of the same session (ADate and gantry) is replaced.
+            Returns the entry id; raises ValueError if the session was already written or
+            is being written.
+        '''
+        key = session_key(adate, gantry)
+        payload = json.dumps([[table, cols, [list(row) for row in rows]] for table, cols, rows in writes],
+                             default=_encode)
+        now = time.time()
+        with self._lock, self._connect() as con:
+            replaced = []
+            for entry in self._current(con, 'e.key = ?', (key,)):
+                if entry['status']==WRITTEN:
+                    raise ValueError("Session "+key+" has already been written to the database")
+                if entry['id'] in self._writing:
+                    raise ValueError("Session "+key+" is being written to the database")
+                if entry['status'] in (QUEUED, FAILED):
+                    replaced.append(entry['id'])
+            for entry_id in replaced:
+                self._event(con, entry_id, REPLACED, 0, None, now, None)
+            entry_id = con.execute('INSERT INTO entries (key, adate, gantry, writes, created) VALUES (?, ?, ?, ?, ?)',
+                                   (key, str(adate), str(gantry), payload, now)).lastrowid
+            self._event(con, entry_id, QUEUED, 0, now, now, None)
+        self._changed()
+        self._wake.set()
+        return entry_id
+
+    def entries(self, statuses=(QUEUED, FAILED, WRITTEN)):
+        '''
+            Journal entries with a status in statuses, oldest first
+            Return list of dicts:
+                'id', 'key', 'adate', 'gantry', 'created', 'status', 'attempts', 'next_try', 'updated', 'error'
+        '''
+        with self._connect() as con:
+            return [e for e in self._current(con) if e['status'] in statuses]
+
+    def counts(self):
+        '''
+            Dict of status: number of entries
+        '''
+        counts = {s: 0 for s in STATUSES}
+        with self._connect() as con:
+            for entry in self._current(con):
+                counts[entry['status']] += 1
+        return counts
+
+    def retry(self, entry_id=None):
+        '''
+            Queue failed entries (entry_id, or all if None) again with their attempts reset
+        '''
+        now = time.time()
+        with self._lock, self._connect() as con:
+            for entry in self._current(con):
+                if entry['status']==FAILED and entry_id in (None, entry['id']):
+                    self._event(con, entry['id'], QUEUED, 0, now, now, None)
+        self._changed()
+        self._wake.set()
+
+    def start(self, on_change=None):
+        '''
+            Start the background worker. on_change(counts) is called whenever an entry
+            changes status, from the worker thread or the thread calling put or retry.
+        '''
+        self.on_change = on_change
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=5.0):
+        '''
+            Stop the background worker after its current pass, queued entries stay in the journal
+        '''
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def drain(self):
+        '''
+            Write the due queued entries to the database, batch entries at a time.
+            Returns the number of entries written.
+        '''
+        written = 0
+        with self._draining:
+            while not self._stop.is_set():
+                with self._lock, self._connect() as con:
+                    due = [e for e in self._current(con) if e['status']==QUEUED and e['next_try'] <= time.time()]
+                    due = due[:self.batch]
+                    # put cannot replace an entry while it is written
+                    self._writing.update(e['id'] for e in due)
+                if not due:
+                    break
+                try:
+                    n = self._write(due)
+                finally:
+                    with self._lock:
+                        self._writing.difference_update(e['id'] for e in due)
+                written += n
+                if n < len(due):
+                    # leave the rest for the next pass, after their backoff
+                    break
+        return written
+
+    def _write(self, due):
+        # write a batch of entries, one transaction for all, then one each if that fails
+        ok = 0
+        pending = []
+        for entry in due:
+            try:
+                found = self.exists is not None and self.exists(entry['adate'], entry['gantry'])
+            except Exception as e:
+                print("Submit queue: could not check "+entry['key']+" ("+str(e)+")")
+                self._mark(entry, QUEUED, str(e))
+                continue
+            if found:
+                self._mark(entry, WRITTEN, "already in the database")
+                ok += 1
+            else:
+                pending.append(entry)
+        writes = {e['id']: self._writes(e['id']) for e in pending}
+        if len(pending) > 1:
+            try:
+                self.submit([w for e in pending for w in writes[e['id']]])
+            except Exception as e:
+                print("Submit queue: batch of "+str(len(pending))+" sessions failed, writing one at a time ("+str(e)+")")
+            else:
+                for entry in pending:
+                    self._mark(entry, WRITTEN, None)
+                return ok+len(pending)
+        for entry in pending:
+            try:
+                self.submit(writes[entry['id']])
+            except Exception as e:
+                print("Submit queue: "+entry['key']+" not written ("+str(e)+")")
+                self._mark(entry, QUEUED, str(e))
+            else:
+                self._mark(entry, WRITTEN, None)
+                ok += 1
+        return ok
+
+    def _mark(self, entry, status, error):
+        # append a status event, a failed write is queued again after its backoff or marked failed;
+        # nothing is appended if the entry is no longer queued (e.g. replaced by put)
+        now = time.time()
+        attempts = entry['attempts']
+        next_try = None
+        if status==QUEUED:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                status = FAILED
+            else:
+                next_try = now + min(self.base_delay*2**(attempts-1), self.max_delay)
+        with self._lock, self._connect() as con:
+            current = self._current(con, 'e.id = ?', (entry['id'],))
+            if not current or current[0]['status']!=QUEUED:
+                return
+            self._event(con, entry['id'], status, attempts, next_try, now, error)
+        if status==WRITTEN:
+            print("Submit queue: "+entry['key']+" written to the database")
+        self._changed()
+
+    def _writes(self, entry_id):
+        with self._connect() as con:
+            payload = con.execute('SELECT writes FROM entries WHERE id = ?', (entry_id,)).fetchone()[0]
+        return json.loads(payload, object_hook=_decode)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                print("Submit queue: worker error ("+str(e)+")")
+            self._wake.wait(self._wait())
+            self._wake.clear()
+
+    def _wait(self):
+        # seconds until the next queued entry is due, at most interval
+        with self._connect() as con:
+            due = [e['next_try'] for e in self._current(con) if e['status']==QUEUED]
+        if not due:
+            return self.interval
+        return min(max(min(due)-time.time(), 0.5), self.interval)
+
+    def _changed(self):
+        if self.on_change is not None:
+            try:
+                self.on_change(self.counts())
+            except Exception as e:
+                print("Submit queue: status update failed ("+str(e)+")")
+
+    @staticmethod
+    def _event(con, entry_id, status, attempts, next_try, now, error):
+        con.execute('INSERT INTO events (entry, status, attempts, next_try, time, error) VALUES (?, ?, ?, ?, ?, ?)',
+                    (entry_id, status, attempts, next_try, now, error))
+
+    @staticmethod
+    def _current(con, where='1', params=()):
+        # entries with their latest event
+        sql = '''
+            SELECT e.id, e.key, e.adate, e.gantry, e.created, s.status, s.attempts, s.next_try, s.time, s.error
+            FROM entries e
+            INNER JOIN events s
+            ON s.id = (SELECT MAX(id) FROM events WHERE entry = e.id)
+            WHERE %s
+            ORDER BY e.id
+            ''' % where
+        cols = ['id', 'key', 'adate', 'gantry', 'created', 'status', 'attempts', 'next_try', 'updated', 'error']
+        return [dict(zip(cols, r)) for r in con.execute(sql, params).fetchall()]
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # committed and closed on exit
+        con = sqlite3.connect(self.journal_name, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+
+def session_key(adate=None, gantry=None):
+    '''
+        Idempotency key of a session: ADate and gantry
+    '''
+    return str(adate)+'|'+str(gantry)
+
+
+def _encode(v):
+    # journal JSON of values the database driver accepts
+    if isinstance(v, datetime.datetime):
+        return {'__datetime__': v.strftime('%Y-%m-%d %H:%M:%S.%f')}
+    if isinstance(v, datetime.date):
+        return {'__date__': v.strftime('%Y-%m-%d')}
+    if hasattr(v, 'item'):
+        # numpy scalars
+        return v.item()
+    raise TypeError("Cannot journal value of type "+type(v).__name__)
+
+
+def _decode(d):
+    if '__datetime__' in d:
+        return datetime.datetime.strptime(d['__datetime__'], '%Y-%m-%d %H:%M:%S.%f')
+    if '__date__' in d:
+        return datetime.datetime.strptime(d['__date__'], '%Y-%m-%d').date()
+    return d